@@ -1,18 +1,27 @@
 """ This module contains the functionality for running and compiling C functions """
 
 from collections import namedtuple
+import os
 import subprocess
 import platform
 import errno
 import re
 import logging
+import hashlib
+import struct
+import shutil
+import tempfile
+import threading
 import ctypes as C
 import _ctypes
 
 import numpy
 import numpy.ctypeslib
 
-from kernel_tuner.util import get_temp_filename, delete_temp_file, write_file
+from kernel_tuner.util import get_temp_filename, delete_temp_file, write_file, split_prologue, get_relative_source, finalize, has_local_includes, \
+    get_include_dirs, get_local_includes, read_source_file
+from kernel_tuner.cache import FileCache, get_key
+from kernel_tuner.toolchain import get_compiler, get_toolchain, split_options, FortranToolchain
 
 dtype_map = {"int8": C.c_int8,
              "int16": C.c_int16,
@@ -22,36 +31,107 @@ dtype_map = {"int8": C.c_int8,
              "float64": C.c_double}
 
 Argument = namedtuple("Argument", ["type", "shape"])
+CBuild = namedtuple("CBuild", ["kernel_name", "filename", "temporary", "using_openmp", "source", "binary_hash"])
+
+
+def get_binary_hash(filename):
+    """ return a hash of the sections of an ELF shared library that are loaded into memory
+
+    Sections that are not loaded, such as the symbol table that holds the name
+    of the source file, and notes, such as the build ID, are skipped. Libraries
+    that contain the same code therefore have the same hash.
+
+    :param filename: The name of the library.
+    :type filename: string
+
+    :returns: The hash, or None if the file is not an ELF file.
+    :rtype: string
+    """
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+    except IOError:
+        return None
+    if data[:4] != b"\x7fELF" or len(data) < 64:
+        return None
+    endian = "<" if data[5:6] == b"\x01" else ">"
+    if data[4:5] == b"\x02":
+        shoff, = struct.unpack_from(endian + "Q", data, 0x28)
+        shentsize, shnum = struct.unpack_from(endian + "HH", data, 0x3A)
+        section_header = endian + "IIQQQQ"
+    else:
+        shoff, = struct.unpack_from(endian + "I", data, 0x20)
+        shentsize, shnum = struct.unpack_from(endian + "HH", data, 0x2E)
+        section_header = endian + "IIIIII"
+
+    binary_hash = hashlib.sha256()
+    try:
+        for i in range(shnum):
+            _, section_type, flags, address, offset, size = struct.unpack_from(section_header, data, shoff + i*shentsize)
+            #only allocated sections, except notes (7), and without contents for bss (8)
+            if flags & 2 and section_type != 7:
+                binary_hash.update(struct.pack("<IQQ", section_type, address, size))
+                if section_type != 8:
+                    binary_hash.update(data[offset:offset+size])
+    except struct.error:
+        return None
+    return binary_hash.hexdigest()
 
 
 class CFunctions(object):
     """Class that groups the code for running and compiling C functions"""
 
-    def __init__(self, iterations=7, compiler_options=None, compiler=None):
+    def __init__(self, iterations=7, compiler_options=None, compiler=None, cache_dir=None, cache_size=None, temp_dir=None,
+                 precompiled_header=False):
         """instantiate CFunctions object used for interacting with C code
 
         :param iterations: Number of iterations used while benchmarking a kernel, 7 by default.
         :type iterations: int
+
+        :param cache_dir: Directory in which compiled kernels are stored for reuse,
+            None by default to always compile kernels.
+        :type cache_dir: string
+
+        :param cache_size: The maximum size in bytes of the stored compiled kernels,
+            1 GiB by default.
+        :type cache_size: int
+
+        :param temp_dir: Directory in which source files and libraries are created
+            while compiling, the current working directory by default.
+        :type temp_dir: string
+
+        :param precompiled_header: Compile the #include lines at the start of
+            kernels into a precompiled header, which is compiled once for each
+            set of compiler options and included in every kernel.
+        :type precompiled_header: bool
         """
         self.iterations = iterations
         self.max_threads = 1024
+        self.max_shared_memory = None
         self.compiler_options = compiler_options
         self.compiler = compiler or "g++"  # use gcc by default
         self.lib = None
+        self.lib_filename = None
+        self.libs = dict()
         self.using_openmp = False
         self.arg_mapping = dict()
-
-        try:
-            cc_version = str(subprocess.check_output([self.compiler, "--version"]))
-            cc_version = cc_version.splitlines()[0].split(" ")[-1]
-        except OSError as e:
-            raise e
+        self.compile_cache = None
+        self.temp_dir = temp_dir
+        self.precompiled_header = precompiled_header
+        self.precompiled_headers = dict()
+        self.precompiled_header_dir = None
+        self.precompiled_header_lock = threading.Lock()
+        if cache_dir:
+            self.compile_cache = FileCache(os.path.join(cache_dir, "c"), cache_size)
+
+        #versions are only probed once for each compiler executable
+        cc_version = get_toolchain(self.compiler).get_version(cache_dir)
 
         #check if nvcc is available
         self.nvcc_available = False
+        nvcc_version = None
         try:
-            nvcc_version = str(subprocess.check_output(["nvcc", "--version"]))
-            nvcc_version = nvcc_version.splitlines()[-1].split(" ")[-1]
+            nvcc_version = get_toolchain("nvcc").get_version(cache_dir)
             self.nvcc_available = True
         except OSError as e:
             if e.errno != errno.ENOENT:
@@ -66,6 +146,7 @@ class CFunctions(object):
         env["compiler_options"] = compiler_options
         self.env = env
         self.name = platform.processor()
+        self.compiler_versions = (cc_version, nvcc_version)
 
     def ready_argument_list(self, arguments):
         """ready argument list to be passed to the C function
@@ -98,7 +179,7 @@ class CFunctions(object):
         return ctype_args
 
 
-    def compile(self, kernel_name, kernel_string):
+    def compile(self, kernel_name, kernel_string, options=None):
         """call the C compiler to compile the kernel, return the function
 
         :param kernel_name: The name of the kernel to be compiled, used to lookup the
@@ -108,91 +189,307 @@ class CFunctions(object):
         :param kernel_string: The C code that contains the function `kernel_name`
         :type kernel_string: string
 
+        :param options: Compiler options for this kernel, appended to the compiler
+            options of all kernels.
+        :type options: string or list(string)
+
         :returns: An ctypes function that can be called directly.
         :rtype: ctypes._FuncPtr
         """
-        logging.debug('compiling ' + kernel_name)
+        return self.load(kernel_name, self.build(kernel_name, kernel_string, options=options))
+
+    def build(self, kernel_name, kernel_string, lookup=True, options=None):
+        """call the C compiler to compile the kernel into a shared library, without loading it
 
-        if self.lib != None:
-            self.cleanup_lib()
+        Building does not change the library that is currently loaded, kernels may
+        therefore be built in other threads while a kernel is benchmarked.
+
+        :param kernel_name: The name of the kernel to be compiled, used to lookup the
+            function after compilation.
+        :type kernel_name: string
 
-        compiler_options = ["-fPIC"]
+        :param kernel_string: The C code that contains the function `kernel_name`
+        :type kernel_string: string
+
+        :param lookup: Whether to look up the library in the compile cache, if any.
+        :type lookup: bool
+
+        :param options: Compiler options for this kernel, appended to the compiler
+            options of all kernels.
+        :type options: string or list(string)
+
+        :returns: The compiled library, to be passed to load().
+        :rtype: CBuild
+        """
+        logging.debug('compiling ' + kernel_name)
+        source = (kernel_name, kernel_string, options)
 
         #detect openmp
+        using_openmp = False
         if "#include <omp.h>" in kernel_string or "use omp_lib" in kernel_string:
             logging.debug('set using_openmp to true')
-            self.using_openmp = True
-            if self.compiler == "pgfortran":
-                compiler_options.append("-mp")
-            else:
-                compiler_options.append("-fopenmp")
+            using_openmp = True
 
         #detect whether to use nvcc as default instead of g++, may overrule an explicitly passed g++
-        if ("#include <cuda" in kernel_string) or ("__global__" in kernel_string):
-            if self.compiler == "g++" and self.nvcc_available:
-                self.compiler = "nvcc"
-
-        #select right suffix based on compiler
-        suffix = ".cc"
-        if self.compiler in ["gfortran", "pgfortran", "ftn", "ifort"]:
-            suffix = ".F90"
-        if self.compiler == "nvcc":
-            suffix = suffix[:-1] + "u"
-            compiler_options = ["-Xcompiler=" + c for c in compiler_options]
-
-        if ".c" in suffix:
-            if not "extern \"C\"" in kernel_string:
-                kernel_string = "extern \"C\" {\n" + kernel_string + "\n}"
-
-        #copy user specified compiler options to current list
+        #kernels are built concurrently, so the choice is not stored in self.compiler
+        compiler = get_compiler(self.compiler, kernel_string, self.nvcc_available)
+
+        #the toolchain selects the suffix, the options for shared libraries and OpenMP, and the name of the function
+        toolchain = get_toolchain(compiler)
+        suffix = toolchain.suffix
+        compiler_options = toolchain.get_compiler_options(using_openmp)
+        kernel_name = toolchain.get_function_name(kernel_name, kernel_string)
+
+        #headers that are precompiled are included before the extern "C" block
+        prologue = ""
+        if self.precompiled_header and toolchain.precompiled_header_extension:
+            prologue, kernel_string = split_prologue(kernel_string)
+
+        kernel_string = toolchain.prepare_source(kernel_string)
+
+        #copy user specified compiler options to current list, followed by the options of this kernel
         if self.compiler_options:
             compiler_options += self.compiler_options
+        compiler_options += split_options(options)
 
         lib_args = []
-        if "CL/cl.h" in kernel_string:
+        if "CL/cl.h" in kernel_string or "CL/cl.h" in prologue:
             lib_args = ["-lOpenCL"]
 
-        logging.debug('using compiler ' + self.compiler)
+        logging.debug('using compiler ' + compiler)
         logging.debug('compiler_options ' + " ".join(compiler_options))
         logging.debug('lib_args ' + " ".join(lib_args))
 
-        source_file = get_temp_filename(suffix=suffix)
-        filename = ".".join(source_file.split(".")[:-1])
+        lib_extension = ".so"
+        if platform.system() == "Darwin":
+            lib_extension = ".dylib"
 
-        #detect Fortran modules
-        match = re.search(r"\s*module\s+([a-zA-Z_]*)", kernel_string)
-        if match:
-            if self.compiler == "gfortran":
-                kernel_name = "__" + match.group(1) + "_MOD_" + kernel_name
-            elif self.compiler in ["ftn", "ifort"]:
-                kernel_name = match.group(1) + "_mp_" + kernel_name + "_"
-            elif self.compiler == "pgfortran":
-                kernel_name = match.group(1) + "_" + kernel_name + "_"
+        #libraries are stored under a hash of everything that determines the compiled code
+        key = None
+        if self.compile_cache is not None:
+            key = self._get_key(prologue, kernel_string, compiler, compiler_options, lib_args, suffix)
+        if key is not None and lookup and self.compile_cache.lookup(key, lib_extension):
+            filename = self.compile_cache.get_filename(key)
+            return CBuild(kernel_name, filename, False, using_openmp, source, get_binary_hash(filename + lib_extension))
 
+        source_file = get_temp_filename(suffix=suffix, directory=self.temp_dir)
+        filename = ".".join(source_file.split(".")[:-1])
+        #the dynamic loader would return a loaded library that had the same name
+        while filename in self.libs:
+            delete_temp_file(source_file)
+            source_file = get_temp_filename(suffix=suffix, directory=self.temp_dir)
+            filename = ".".join(source_file.split(".")[:-1])
 
         try:
+            header_options = []
+            if prologue:
+                header_options = self._get_precompiled_header(prologue, compiler, compiler_options)
+                if header_options is None:
+                    header_options = []
+                    kernel_string = prologue + kernel_string
+                else:
+                    #keep the line numbers of the kernel in compiler messages
+                    kernel_string = "\n" * prologue.count("\n") + kernel_string
             write_file(source_file, kernel_string)
 
-            lib_extension = ".so"
-            if platform.system() == "Darwin":
-                lib_extension = ".dylib"
-
-            subprocess.check_call([self.compiler, "-c", source_file] + compiler_options + ["-o", filename + ".o"])
-            subprocess.check_call([self.compiler, filename + ".o"] + compiler_options + ["-shared", "-o", filename + lib_extension] + lib_args)
+            subprocess.check_call([compiler, "-c", source_file] + compiler_options + header_options + ["-o", filename + ".o"])
+            subprocess.check_call([compiler, filename + ".o"] + compiler_options + ["-shared", "-o", filename + lib_extension] + lib_args)
 
+            binary_hash = get_binary_hash(filename + lib_extension)
+            if key is not None:
+                self.compile_cache.store(key, filename + lib_extension, lib_extension)
+                return CBuild(kernel_name, self.compile_cache.get_filename(key), False, using_openmp, source, binary_hash)
+            return CBuild(kernel_name, filename, True, using_openmp, source, binary_hash)
 
-            self.lib = numpy.ctypeslib.load_library(filename, '.')
-            func = getattr(self.lib, kernel_name)
-            func.restype = C.c_float
+        except Exception as e:
+            delete_temp_file(filename+".so")
+            delete_temp_file(filename+".dylib")
+            raise e
 
         finally:
             delete_temp_file(source_file)
             delete_temp_file(filename+".o")
-            delete_temp_file(filename+".so")
-            delete_temp_file(filename+".dylib")
+            if key is not None:
+                delete_temp_file(filename+".so")
+                delete_temp_file(filename+".dylib")
 
-        return func
+    def _get_key(self, prologue, kernel_string, compiler, compiler_options, lib_args, suffix):
+        """ return the key of the compiled library in the compile cache, None if it cannot be cached
+
+        The key includes the contents of the local headers that the kernel
+        includes, which are looked up like the compiler does. Kernels that
+        include local headers that cannot be found are not cached.
+        """
+        directories = [self.temp_dir or os.getcwd()] + get_include_dirs(compiler_options)
+        headers, complete = get_local_includes(prologue + kernel_string, directories)
+        if not complete:
+            logging.debug('not all local headers of the kernel were found, not using the compile cache')
+            return None
+        header_hashes = [hashlib.sha256(read_source_file(h).encode("utf-8")).hexdigest() for h in headers]
+        return get_key(prologue + get_relative_source(kernel_string, self.temp_dir), compiler, self.compiler_versions, compiler_options,
+                       lib_args, suffix, header_hashes)
+
+    def _get_precompiled_header(self, prologue, compiler, compiler_options):
+        """ return the options that include the precompiled prologue, or None if it cannot be precompiled
+
+        The header is compiled once for each prologue and set of compiler options,
+        the options that compile the kernels must match those of the header.
+        """
+        key = get_key(prologue, compiler, compiler_options)
+        with self.precompiled_header_lock:
+            if key in self.precompiled_headers:
+                return self.precompiled_headers[key]
+            if self.precompiled_header_dir is None:
+                self.precompiled_header_dir = tempfile.mkdtemp(prefix="temp_pch_", dir=self.temp_dir or ".")
+                finalize(self, shutil.rmtree, self.precompiled_header_dir, True)
+            header = os.path.join(self.precompiled_header_dir, key[:32] + ".h")
+            write_file(header, prologue)
+            extension = get_toolchain(compiler).precompiled_header_extension
+            try:
+                subprocess.check_call([compiler, "-x", "c++-header", header] + compiler_options + ["-o", header + extension])
+                header_options = ["-include", header]
+                logging.debug('precompiled header ' + header + extension)
+            except (OSError, subprocess.CalledProcessError):
+                header_options = None
+                logging.debug('failed to precompile header, including the headers in every kernel')
+            self.precompiled_headers[key] = header_options
+            return header_options
+
+    def load(self, kernel_name, build):
+        """load a library returned by build(), return the function
+
+        The library remains loaded until all functions loaded from it are passed
+        to unload().
+
+        :param kernel_name: The name of the kernel, the name of the function in
+            the library is taken from build.
+        :type kernel_name: string
+
+        :param build: The compiled library as returned by build().
+        :type build: CBuild
+
+        :returns: An ctypes function that can be called directly.
+        :rtype: ctypes._FuncPtr
+        """
+        #variants that were built into the same library are taken from the loaded library
+        if build.filename in self.libs:
+            self.lib = self.libs[build.filename][0]
+            self.lib_filename = build.filename
+            func = self._get_function(build.kernel_name)
+            func.binary_hash = build.binary_hash
+            return func
+
+        if build.using_openmp:
+            self.using_openmp = True
 
+        try:
+            func = self._load_function(build.filename, build.kernel_name)
+            func.binary_hash = build.binary_hash
+            return func
+        except OSError as e:
+            if build.temporary:
+                raise e
+            #the library was evicted from the cache by another process, compile it again
+            logging.debug('failed to load cached library for ' + build.kernel_name)
+            kernel_name, kernel_string, options = build.source
+            return self.load(kernel_name, self.build(kernel_name, kernel_string, False, options)._replace(kernel_name=build.kernel_name))
+        finally:
+            if build.temporary:
+                delete_temp_file(build.filename+".so")
+                delete_temp_file(build.filename+".dylib")
+
+
+    def build_batch(self, kernel_names, kernel_strings, options=None):
+        """compile several kernels into a single shared library, without loading it
+
+        Each kernel is renamed to a unique name and followed by #undef statements
+        for the macros it defines, such that the tunable parameters of each kernel
+        are only visible to that kernel. The compiler is invoked only once for the
+        entire batch. Kernels that define other functions or global variables
+        cannot be combined, in which case compilation fails and the kernels should
+        be built one at a time. Kernels that include local headers with
+        #include "..." cannot be combined either, because a header with an
+        include guard would only be expanded with the macros of the first kernel.
+
+        :param kernel_names: The names of the kernels.
+        :type kernel_names: list(string)
+
+        :param kernel_strings: The C code of each kernel.
+        :type kernel_strings: list(string)
+
+        :param options: Compiler options for all kernels in the batch, appended to
+            the compiler options of all kernels.
+        :type options: string or list(string)
+
+        :returns: A compiled library for each kernel, to be passed to load().
+        :rtype: list(CBuild)
+        """
+        if isinstance(get_toolchain(self.compiler), FortranToolchain):
+            raise ValueError("Building a batch of kernels is not supported for Fortran")
+        #a header with an include guard would only be expanded once, with the macros of the first kernel
+        if any(has_local_includes(kernel_string) for kernel_string in kernel_strings):
+            raise ValueError("Building a batch of kernels that include local headers is not supported")
+
+        names = []
+        variants = []
+        for i, (kernel_name, kernel_string) in enumerate(zip(kernel_names, kernel_strings)):
+            name = kernel_name + "_variant" + str(i)
+            variant = re.sub(r"\b" + re.escape(kernel_name) + r"\b", name, kernel_string)
+            macros = re.findall(r"^\s*#\s*define\s+([A-Za-z_][A-Za-z0-9_]*)", variant, flags=re.MULTILINE)
+            variants.append(variant + "\n" + "".join("#undef " + m + "\n" for m in sorted(set(macros))))
+            names.append(name)
+
+        #the library contains all variants, its hash does not identify the code of a single variant
+        build = self.build(kernel_names[0], "\n".join(variants), options=options)._replace(binary_hash=None)
+        return [build._replace(kernel_name=name) for name in names]
+
+    def get_binary_hash(self, func):
+        """return a hash of the compiled code of the library that contains func, or None if unknown"""
+        return getattr(func, "binary_hash", None)
+
+    def unload(self, func):
+        """unload the library of a function returned by load(), once none of its functions are in use
+
+        :param func: A function returned by load().
+        :type func: ctypes._FuncPtr
+
+        :returns: False if the library remains loaded because it uses OpenMP.
+        :rtype: bool
+        """
+        loaded = self.libs.get(func.lib_filename)
+        if loaded is None:
+            return True
+        loaded[1] -= 1
+        if loaded[1] > 0:
+            return True
+        if self.using_openmp:
+            #the library remains in libs, such that it is reused if the kernel is loaded again
+            return False
+        del self.libs[func.lib_filename]
+        if self.lib_filename == func.lib_filename:
+            self.lib = None
+            self.lib_filename = None
+        logging.debug('unloading shared library ' + func.lib_filename)
+        _ctypes.dlclose(loaded[0]._handle)
+        return True
+
+    def _load_function(self, lib_filename, kernel_name):
+        """ load a shared library, named without its extension, and return the kernel function """
+        #always create a new library object, ctypes.cdll returns the object of an earlier load
+        #of the same file, also when that library has been unloaded with dlclose in the meantime
+        lib_extension = ".dylib" if platform.system() == "Darwin" else ".so"
+        self.lib = C.CDLL(os.path.abspath(lib_filename + lib_extension))
+        self.lib_filename = lib_filename
+        self.libs[lib_filename] = [self.lib, 0]
+        return self._get_function(kernel_name)
+
+    def _get_function(self, kernel_name):
+        """ return a kernel function from the loaded library, counting the number of uses of the library """
+        func = getattr(self.lib, kernel_name)
+        func.restype = C.c_float
+        func.lib_filename = self.lib_filename
+        self.libs[self.lib_filename][1] += 1
+        return func
 
     def benchmark(self, func, c_args, threads, grid, times):
         """runs the kernel repeatedly, returns averaged returned value
@@ -316,11 +613,15 @@ class CFunctions(object):
 
 
     def cleanup_lib(self):
-        """ unload the previously loaded shared library """
+        """ unload all loaded shared libraries """
         if not self.using_openmp:
             #this if statement is necessary because shared libraries that use
             #OpenMP will core dump when unloaded, this is a well-known issue with OpenMP
-            logging.debug('unloading shared library')
-            _ctypes.dlclose(self.lib._handle)
+            logging.debug('unloading shared libraries')
+            for lib, _ in self.libs.values():
+                _ctypes.dlclose(lib._handle)
+            self.libs = dict()
+            self.lib = None
+            self.lib_filename = None
 
     units = {}
@@ -0,0 +1,319 @@
+""" Module for storing build products and compile results on disk for reuse by later runs """
+from __future__ import print_function
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from kernel_tuner import util
+
+default_max_size = 2**30
+
+
+def get_key(*parts):
+    """ return a hexadecimal sha256 hash of the string representations of parts
+
+    :param parts: Everything that determines the contents of a cached file.
+    :type parts: any
+
+    :returns: The key under which the file is stored.
+    :rtype: string
+    """
+    key = hashlib.sha256()
+    for part in parts:
+        key.update(repr(part).encode("utf-8"))
+        key.update(b"\0")
+    return key.hexdigest()
+
+
+class FileCache(object):
+    """Content-addressed directory of files with least recently used eviction
+
+    Files are stored under a key that is a hash of everything that determines
+    their contents, see get_key(). Files are first written to a temporary file in
+    the cache directory and then renamed, such that other processes that use the
+    same directory never see a partially written file. Each hit updates the
+    modification time of the file. The total size of the files is kept in an
+    index file in the directory, which each store updates while holding a lock
+    on the directory where the platform supports it. Only when the total size
+    exceeds max_size is the directory scanned, and the files that have not been
+    used for the longest time are removed until the files fit in 3/4 of
+    max_size, such that the scan is needed only once per many stores.
+    """
+
+    def __init__(self, directory, max_size=None):
+        """ Create a cache in directory
+
+        :param directory: The directory that stores the cached files, created if needed.
+        :type directory: string
+
+        :param max_size: The maximum total size of the cached files in bytes,
+            1 GiB by default.
+        :type max_size: int
+        """
+        self.directory = directory
+        self.max_size = max_size or default_max_size
+        util.create_directory(directory)
+
+    def get_filename(self, key, suffix=""):
+        """ return the name of the file that stores key """
+        return os.path.join(self.directory, key + suffix)
+
+    def lookup(self, key, suffix=""):
+        """ return the name of the file that stores key, or None on a miss
+
+        :param key: The key of the file, as returned by get_key().
+        :type key: string
+
+        :param suffix: The extension of the file.
+        :type suffix: string
+
+        :returns: The name of the cached file or None.
+        :rtype: string
+        """
+        filename = self.get_filename(key, suffix)
+        try:
+            os.utime(filename, None)
+        except OSError:
+            return None
+        logging.debug('cache hit ' + filename)
+        return filename
+
+    def store(self, key, source, suffix=""):
+        """ store a copy of the file source under key
+
+        :param key: The key of the file, as returned by get_key().
+        :type key: string
+
+        :param source: The name of the file to store.
+        :type source: string
+
+        :param suffix: The extension of the file.
+        :type suffix: string
+
+        :returns: The name of the cached file.
+        :rtype: string
+        """
+        filename = self.get_filename(key, suffix)
+        fd, temp_filename = tempfile.mkstemp(suffix=suffix, prefix="temp_", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f, open(source, "rb") as src:
+                shutil.copyfileobj(src, f)
+            os.chmod(temp_filename, os.stat(source).st_mode & 0o777)
+            added = self._replace(temp_filename, filename)
+        finally:
+            util.delete_temp_file(temp_filename)
+        logging.debug('stored ' + filename)
+        self._update_size(added)
+        return filename
+
+    def write(self, key, data, suffix=""):
+        """ store data under key
+
+        :param key: The key of the file, as returned by get_key().
+        :type key: string
+
+        :param data: The contents of the file.
+        :type data: bytes
+
+        :param suffix: The extension of the file.
+        :type suffix: string
+
+        :returns: The name of the cached file.
+        :rtype: string
+        """
+        filename = self.get_filename(key, suffix)
+        fd, temp_filename = tempfile.mkstemp(suffix=suffix, prefix="temp_", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            added = self._replace(temp_filename, filename)
+        finally:
+            util.delete_temp_file(temp_filename)
+        logging.debug('stored ' + filename)
+        self._update_size(added)
+        return filename
+
+    def evict(self, target=None):
+        """ remove the least recently used files until the cache fits in target, max_size by default """
+        with self._lock():
+            self._write_size(self._evict(self.max_size if target is None else target))
+
+    def _replace(self, temp_filename, filename):
+        """ move a written file into place, return by how many bytes the cache grew """
+        try:
+            replaced = os.stat(filename).st_size
+        except OSError:
+            replaced = 0
+        size = os.stat(temp_filename).st_size
+        util.replace_file(temp_filename, filename)
+        return size - replaced
+
+    def _update_size(self, added):
+        """ add to the total size of the cache, evict files when it exceeds max_size """
+        with self._lock():
+            total = self._read_size()
+            total = self._evict(None) if total is None else total + added
+            if total > self.max_size:
+                total = self._evict(self.max_size * 3 // 4)
+            self._write_size(total)
+
+    def _read_size(self):
+        """ return the total size of the cache as stored in the index file, None if it is not known """
+        try:
+            with open(os.path.join(self.directory, ".size"), "r") as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def _write_size(self, total):
+        with open(os.path.join(self.directory, ".size"), "w") as f:
+            f.write(str(max(total, 0)))
+
+    def _evict(self, target):
+        """ scan the directory and remove files until the cache fits in target, return the total size """
+        entries = []
+        for name in os.listdir(self.directory):
+            #skip the lock and index files and files that are still being written
+            if name.startswith(".") or name.startswith("temp_"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        if target is None:
+            return total
+        for _, size, name in sorted(entries):
+            if total <= target:
+                break
+            #files that are in use remain accessible to processes that opened them
+            util.delete_temp_file(os.path.join(self.directory, name))
+            logging.debug('evicted ' + name)
+            total -= size
+        return total
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """ hold an exclusive lock on the directory where the platform supports it """
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class FailureCache(object):
+    """Persistent record of kernel instances that cannot be compiled or launched on a device
+
+    Kernel instances that are skipped, because they use too much shared memory
+    or request too many resources at launch, are recorded in a file per device
+    environment, under a hash of the source of the instance. Later runs skip
+    these instances before compiling them. Each record also stores the tunable
+    parameters of the instance and a hash of the kernel it was created from,
+    such that failed configurations can be excluded from the search space.
+    Records are appended as lines of JSON while holding a lock on the file
+    where the platform supports it.
+    """
+
+    def __init__(self, directory, environment):
+        """ Open the record of failures for a device environment
+
+        :param directory: The directory that stores the records, created if needed.
+        :type directory: string
+
+        :param environment: The environment of the device, as returned by
+            DeviceInterface.get_environment(). The number of iterations is ignored.
+        :type environment: dict
+        """
+        util.create_directory(directory)
+        env_key = get_key(*sorted((k, v) for k, v in environment.items() if k != "iterations"))
+        self.filename = os.path.join(directory, env_key + ".jsonl")
+        self.failures = dict()
+        try:
+            with open(self.filename, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.failures[record["key"]] = record
+        except IOError:
+            pass
+
+    def lookup(self, key):
+        """ return the reason why the instance stored under key failed, or None
+
+        :param key: The hash of the source of the instance.
+        :type key: string
+
+        :returns: The reason of the failure or None.
+        :rtype: string
+        """
+        record = self.failures.get(key)
+        if record is None:
+            return None
+        return record["reason"]
+
+    def add(self, key, kernel, params, reason):
+        """ record that an instance failed
+
+        :param key: The hash of the source of the instance.
+        :type key: string
+
+        :param kernel: A hash of the kernel the instance was created from, or None.
+        :type kernel: string
+
+        :param params: The tunable parameters of the instance.
+        :type params: dict
+
+        :param reason: Why the instance failed.
+        :type reason: string
+        """
+        if key in self.failures:
+            return
+        params = dict((k, v.item() if hasattr(v, "item") else v) for k, v in params.items())
+        record = {"key": key, "kernel": kernel, "params": params, "reason": reason}
+        try:
+            line = json.dumps(record) + "\n"
+        except TypeError:
+            #parameter values that cannot be stored can still be matched on the source
+            record["kernel"] = None
+            record["params"] = dict()
+            line = json.dumps(record) + "\n"
+        self.failures[key] = record
+        with open(self.filename, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_failed_params(self, kernel):
+        """ return the tunable parameters of the failed instances of kernel
+
+        :param kernel: A hash of the kernel the instances were created from.
+        :type kernel: string
+
+        :returns: A list of dictionaries with tunable parameters.
+        :rtype: list(dict)
+        """
+        if kernel is None:
+            return []
+        return [record["params"] for record in self.failures.values() if record["kernel"] == kernel]
@@ -1,22 +1,30 @@
 """ Module for grouping the core functionality needed by most runners """
 from __future__ import print_function
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+import os
 import resource
 import logging
+import warnings
 import numpy
 
 from kernel_tuner.cuda import CudaFunctions
 from kernel_tuner.opencl import OpenCLFunctions
-from kernel_tuner.c import CFunctions
+from kernel_tuner.c import CFunctions, dtype_map
+from kernel_tuner.cache import FailureCache, get_key
+from kernel_tuner.pool import KernelPool
+from kernel_tuner.toolchain import split_options
+from kernel_tuner.workspace import Workspace
 import kernel_tuner.util as util
 
-KernelInstance = namedtuple("KernelInstance", ["name", "kernel_string", "temp_files", "threads", "grid", "params", "arguments"])
+KernelInstance = namedtuple("KernelInstance", ["name", "kernel_string", "temp_files", "threads", "grid", "params", "arguments", "runtime_args", "compiler_options"])
+PreparedKernel = namedtuple("PreparedKernel", ["instance", "build", "error"])
 
 class DeviceInterface(object):
     """Class that offers a High-Level Device Interface to the rest of the Kernel Tuner"""
 
-    def __init__(self, original_kernel, device=0, platform=0, lang=None, quiet=False, compiler=None, compiler_options=None, iterations=7):
+    def __init__(self, original_kernel, device=0, platform=0, lang=None, quiet=False, compiler=None, compiler_options=None, iterations=7, cache_dir=None,
+                 workspace_dir=None, keep_failed=True, precompiled_header=False):
         """ Instantiate the DeviceInterface, based on language in kernel source
 
         :param original_kernel: The source of the kernel as passed to tune_kernel
@@ -46,20 +54,51 @@ class DeviceInterface(object):
         :param times: Return the execution time of all iterations.
         :type times: bool
 
+        :param cache_dir: Directory for storing data that can be reused across runs.
+        :type cache_dir: string
+
+        :param workspace_dir: Directory in which a workspace for temporary files
+            is created, /dev/shm or the system temp directory by default.
+        :type workspace_dir: string
+
+        :param keep_failed: Keep the files of configurations that failed when the
+            workspace is removed.
+        :type keep_failed: bool
+
+        :param precompiled_header: Compile the #include lines at the start of C
+            kernels once into a precompiled header. Ignored for CUDA and OpenCL.
+        :type precompiled_header: bool
+
         """
         logging.debug('DeviceInterface instantiated, lang=%s', lang)
 
         lang = util.detect_language(lang, original_kernel)
+        self.workspace = Workspace(workspace_dir, keep_failed)
+        self.precompiled_header = lang == "C" and bool(precompiled_header)
         if lang == "CUDA":
             dev = CudaFunctions(device, compiler_options=compiler_options, iterations=iterations)
         elif lang == "OpenCL":
-            dev = OpenCLFunctions(device, platform, compiler_options=compiler_options, iterations=iterations)
+            dev = OpenCLFunctions(device, platform, compiler_options=compiler_options, iterations=iterations, cache_dir=cache_dir,
+                                  temp_dir=self.workspace.directory)
         elif lang == "C":
-            dev = CFunctions(compiler=compiler, compiler_options=compiler_options, iterations=iterations)
+            dev = CFunctions(compiler=compiler, compiler_options=compiler_options, iterations=iterations, cache_dir=cache_dir, temp_dir=self.workspace.directory,
+                             precompiled_header=self.precompiled_header)
         else:
             raise Exception("Sorry, support for languages other than CUDA, OpenCL, or C is not implemented yet")
         self.lang = lang
         self.dev = dev
+        self.batch_builds = hasattr(dev, "build_batch")
+        self.kernel_pool = KernelPool(unload=getattr(dev, "unload", None))
+        self.binaries = dict()
+        #times of the configurations benchmarked so far, keyed on the values of the live parameters
+        self.benchmarked = dict()
+        #code returned by code generators during this run, see util.get_kernel_string()
+        self.generated_sources = dict()
+        self.cache_dir = cache_dir
+        #instances that could not be compiled or launched in earlier runs on the same device
+        self.failures = None
+        if cache_dir:
+            self.failures = FailureCache(os.path.join(cache_dir, "failures"), dev.env)
         self.units = dev.units
         self.name = dev.name
         if not quiet:
@@ -73,7 +112,7 @@ class DeviceInterface(object):
 
         time = None
         try:
-            time = self.dev.benchmark(func, gpu_args, instance.threads, instance.grid, times)
+            time = self.dev.benchmark(func, self.get_launch_args(gpu_args, instance), instance.threads, instance.grid, times)
         except Exception as e:
             #some launches may fail because too many registers are required
             #to run the kernel given the current thread block size
@@ -170,59 +209,317 @@ class DeviceInterface(object):
             raise Exception("Error: " + util.get_config_string(params) + " failed correctness check")
         return correct
 
-    def compile_and_benchmark(self, gpu_args, params, kernel_options, tuning_options):
-        """ Compile and benchmark a kernel instance based on kernel strings and parameters """
+    def benchmark_once(self, gpu_args, params, kernel_options, tuning_options, prepared=None):
+        """ Compile and benchmark a kernel instance, unless it only differs in dead parameters from one that was benchmarked
+
+        Configurations that only differ in the values of dead parameters, as listed in
+        tuning_options.dead_params, result in the same kernel. Only the first of these
+        is passed on to compile_and_benchmark(), the others get the same time.
+        """
+        key = util.get_live_key(params, tuning_options.get("dead_params") or [])
+        if key not in self.benchmarked:
+            self.benchmarked[key] = self.compile_and_benchmark(gpu_args, params, kernel_options, tuning_options, prepared)
+        return self.benchmarked[key]
+
+    def is_benchmarked(self, params, tuning_options):
+        """ return True if a configuration that only differs in dead parameters from params has been benchmarked """
+        return util.get_live_key(params, tuning_options.get("dead_params") or []) in self.benchmarked
+
+    def compile_and_benchmark(self, gpu_args, params, kernel_options, tuning_options, prepared=None):
+        """ Compile and benchmark a kernel instance based on kernel strings and parameters
+
+        If the kernel instance was compiled in advance by prepare_kernel(), the
+        result is passed as prepared and the kernel is only loaded.
+        """
 
         instance_string = util.get_instance_string(params)
 
         logging.debug('compile_and_benchmark ' + instance_string)
         mem_usage = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, 1)
         logging.debug('Memory usage : %2.2f MB', mem_usage)
+        logging.debug('Loaded kernels : %d, kernels that could not be unloaded : %d', len(self.kernel_pool), len(self.kernel_pool.leaked))
 
         verbose = tuning_options.verbose
 
-        instance = self.create_kernel_instance(kernel_options, params, verbose)
-        if instance is None:
-            return None
+        if prepared is None:
+            instance = self.create_kernel_instance(kernel_options, params, verbose)
+            if instance is None:
+                return None
+        else:
+            instance = prepared.instance
 
         try:
-            #compile the kernel
-            func = self.compile_kernel(instance, verbose)
-            if func is None:
+            key = self.get_source_key(instance)
+            failure_key = self.get_failure_key(key, instance, kernel_options)
+            if self.is_known_failure(failure_key, instance, verbose):
                 return None
 
+            #reuse a loaded kernel with the same source, or compile the kernel, or load the kernel that was compiled in advance
+            loaded = self.kernel_pool.get(key)
+            if loaded is not None:
+                func, module = loaded
+                #constant memory arguments are copied to the current module
+                if module is not None:
+                    self.dev.current_module = module
+            else:
+                if prepared is None:
+                    func = self.compile_kernel(instance, verbose)
+                else:
+                    func = self.load_kernel(instance, prepared)
+                if func is None:
+                    self.add_failure(failure_key, kernel_options, instance, "too much shared memory used")
+                    return None
+                self.kernel_pool.add(key, func, getattr(self.dev, "current_module", None))
+
             #add constant memory arguments to compiled module
             if kernel_options.cmem_args is not None:
                 self.dev.copy_constant_memory_args(kernel_options.cmem_args)
 
-            #test kernel for correctness and benchmark
-            if tuning_options.answer is not None:
-                self.check_kernel_correctness(func, gpu_args, instance, tuning_options.answer, tuning_options.atol, tuning_options.verify, verbose)
+            #instances that compiled to the same binary, and are launched in the same way, are only benchmarked once
+            binary = self.get_binary_key(func, instance)
+            if binary is not None and binary in self.binaries:
+                equivalent, time = self.binaries[binary]
+                logging.debug(instance_string + ' compiled to the same binary as ' + equivalent)
+                if verbose:
+                    print("skipping config", instance_string, "reason: same binary as", equivalent)
+                params["equivalent_to"] = equivalent
+            else:
+                #test kernel for correctness and benchmark
+                if tuning_options.answer is not None:
+                    self.check_kernel_correctness(func, gpu_args, instance, tuning_options.answer, tuning_options.atol, tuning_options.verify, verbose)
 
-            #benchmark
-            time = self.benchmark(func, gpu_args, instance, tuning_options.times, verbose)
+                #benchmark
+                time = self.benchmark(func, gpu_args, instance, tuning_options.times, verbose)
+                if time is None:
+                    self.add_failure(failure_key, kernel_options, instance, "too many resources requested for launch")
+                if binary is not None:
+                    self.binaries[binary] = (instance_string, time)
 
         except Exception as e:
-            #dump kernel_string to temp file
-            temp_filename = util.get_temp_filename(suffix=".c")
-            util.write_file(temp_filename, instance.kernel_string)
-            print("Error while compiling or benchmarking, see source files: " + temp_filename + " ".join(instance.temp_files.values()))
+            if self.workspace.keep_failed:
+                #dump kernel_string to temp file, which is kept along with the instance files
+                temp_filename = self.workspace.get_temp_filename(suffix=".c")
+                util.write_file(temp_filename, instance.kernel_string)
+                source_files = [temp_filename] + list(instance.temp_files.values())
+                self.workspace.retain(source_files)
+                print("Error while compiling or benchmarking, see source files: " + " ".join(source_files))
+            else:
+                for v in instance.temp_files.values():
+                    util.release_instance_file(v)
             raise e
 
         #clean up any temporary files, if no error occured
         for v in instance.temp_files.values():
-            util.delete_temp_file(v)
+            util.release_instance_file(v)
 
         return time
 
+    def get_binary_key(self, func, instance):
+        """return a key that is the same for kernels with the same binary and launch configuration, or None
+
+        The key is None if the backend cannot provide a hash of the compiled kernel.
+        """
+        if not hasattr(self.dev, "get_binary_hash"):
+            return None
+        binary_hash = self.dev.get_binary_hash(func)
+        if not isinstance(binary_hash, str): #check if not None not enough, the backend could be mocked
+            return None
+        #C functions are called directly, other kernels also depend on how they are launched
+        key = binary_hash
+        if self.lang != "C":
+            key = (binary_hash, instance.threads, instance.grid)
+        if instance.runtime_args:
+            key = (key, tuple(instance.runtime_args))
+        return key
+
+    def get_source_key(self, instance):
+        """return the key of the source of the instance and the options it is compiled with, which is the same in each run
+
+        The names of instance files include the workspace, which differs between runs.
+        """
+        key = get_key(instance.name, util.get_relative_source(instance.kernel_string, self.workspace.directory))
+        if instance.compiler_options:
+            key = get_key(key, instance.compiler_options)
+        return key
+
+    def get_failure_key(self, key, instance, kernel_options):
+        """return the key under which a failure of the instance with source hash key is recorded
+
+        Instances of kernels with runtime parameters share their source, but may
+        fail to launch for some values of the runtime parameters only.
+        """
+        if not kernel_options.get("runtime_params"):
+            return key
+        return get_key(key, instance.threads, instance.grid, instance.runtime_args)
+
+    def is_known_failure(self, key, instance, verbose):
+        """return True if the instance with source hash key failed to compile or launch in an earlier run"""
+        if self.failures is None:
+            return False
+        reason = self.failures.lookup(key)
+        if reason is None:
+            return False
+        logging.debug('skipping ' + instance.name + ' which failed in an earlier run')
+        if verbose:
+            print("skipping config", util.get_instance_string(instance.params), "reason:", reason, "in an earlier run")
+        return True
+
+    def add_failure(self, key, kernel_options, instance, reason):
+        """record that the instance with source hash key cannot be compiled or launched on this device"""
+        if self.failures is not None:
+            self.failures.add(key, self.get_kernel_key(kernel_options), instance.params, reason)
+
+    def get_kernel_key(self, kernel_options):
+        """return a hash of everything that determines the instances of a kernel, except the tunable parameters
+
+        :returns: The hash, or None if the kernel source or problem size is
+            a function, which cannot be hashed reliably.
+        :rtype: string
+        """
+        kernel_source = kernel_options.kernel_string
+        if not isinstance(kernel_source, list):
+            kernel_source = [kernel_source]
+        problem_size = kernel_options.problem_size
+        if not isinstance(problem_size, (list, tuple)):
+            problem_size = [problem_size]
+        if any(callable(k) for k in kernel_source) or any(callable(p) for p in problem_size):
+            return None
+        sources = [(util.read_source_file(k) if util.looks_like_a_filename(k) else None) or k for k in kernel_source]
+        grid_div = (kernel_options.grid_div_x, kernel_options.grid_div_y, kernel_options.grid_div_z)
+        block_size_names = kernel_options.block_size_names or util.default_block_size_names
+        return get_key(kernel_options.kernel_name, sources, problem_size, grid_div, block_size_names)
+
+    def get_failed_configs(self, kernel_options, tune_params):
+        """return the configurations of the kernel that failed to compile or launch on this device in earlier runs
+
+        :returns: A list of tuples with the values of the tunable parameters, in the order of tune_params.
+        :rtype: list(tuple)
+        """
+        if self.failures is None:
+            return []
+        configs = []
+        for params in self.failures.get_failed_params(self.get_kernel_key(kernel_options)):
+            if set(params.keys()) == set(tune_params.keys()):
+                configs.append(tuple(params[k] for k in tune_params.keys()))
+        return configs
+
     def compile_kernel(self, instance, verbose):
         """compile the kernel for this specific instance"""
         logging.debug('compile_kernel ' + instance.name)
 
         #compile kernel_string into device func
+        return self._call_compiler(self.dev.compile, instance, verbose)
+
+    def build_kernel(self, instance, verbose):
+        """compile the kernel for this specific instance, without loading it onto the device"""
+        logging.debug('build_kernel ' + instance.name)
+        return self._call_compiler(self.dev.build, instance, verbose)
+
+    def load_kernel(self, instance, prepared):
+        """load a kernel returned by prepare_kernel(), raise the error if compilation failed"""
+        if prepared.error is not None:
+            raise prepared.error
+        if prepared.build is None:
+            return None
+        return self.dev.load(instance.name, prepared.build)
+
+    def prepare_kernel(self, params, kernel_options, tuning_options):
+        """create the kernel instance and compile it, without loading it onto the device
+
+        Preparing a kernel does not change the state of the device that is used for
+        benchmarking, the next kernel instances may therefore be prepared in other
+        threads while a kernel is benchmarked. Compile errors are stored and raised
+        when the prepared kernel is passed to compile_and_benchmark().
+
+        :returns: The prepared kernel, or None if the instance is skipped.
+        :rtype: PreparedKernel
+        """
+        instance = self.create_kernel_instance(kernel_options, params, tuning_options.verbose)
+        if instance is None or self.is_known_failure(self.get_failure_key(self.get_source_key(instance), instance, kernel_options),
+                                                     instance, tuning_options.verbose):
+            return None
+        try:
+            return PreparedKernel(instance, self.build_kernel(instance, tuning_options.verbose), None)
+        except Exception as e:
+            return PreparedKernel(instance, None, e)
+
+    def prepare_kernels(self, params_list, kernel_options, tuning_options):
+        """create and compile a batch of kernel instances, without loading them onto the device
+
+        If the backend supports it, the kernel instances are compiled together with
+        a single call to the compiler. When that fails, the batch is split in halves
+        until the instances that fail to compile are isolated, which are then
+        handled in the same way as by prepare_kernel().
+
+        :returns: A prepared kernel for each set of parameters, or None for
+            instances that are skipped.
+        :rtype: list(PreparedKernel)
+        """
+        if not self.batch_builds or len(params_list) < 2:
+            return [self.prepare_kernel(params, kernel_options, tuning_options) for params in params_list]
+
+        instances = [self.create_kernel_instance(kernel_options, params, tuning_options.verbose) for params in params_list]
+        valid = [i for i, instance in enumerate(instances) if instance is not None
+                 and not self.is_known_failure(self.get_failure_key(self.get_source_key(instance), instance, kernel_options),
+                                               instance, tuning_options.verbose)]
+        prepared = [None for _ in instances]
+        for i, p in zip(valid, self._build_batch([instances[i] for i in valid], tuning_options.verbose)):
+            prepared[i] = p
+        return prepared
+
+    def _build_batch(self, instances, verbose):
+        """build instances together, bisect the batch to isolate instances that fail to compile"""
+        #instances are only built together with instances that use the same compiler options
+        groups = OrderedDict()
+        for i, instance in enumerate(instances):
+            groups.setdefault(tuple(instance.compiler_options), []).append(i)
+        if self.batch_builds and len(groups) > 1:
+            prepared = [None for _ in instances]
+            for group in groups.values():
+                for i, p in zip(group, self._build_batch([instances[i] for i in group], verbose)):
+                    prepared[i] = p
+            return prepared
+
+        #local headers are only expanded once in a batch, see CFunctions.build_batch()
+        if self.batch_builds and any(util.has_local_includes(i.kernel_string) for i in instances):
+            logging.debug('kernels include local headers, disabling batch builds')
+            self.batch_builds = False
+
+        if not self.batch_builds or len(instances) < 2:
+            prepared = []
+            for instance in instances:
+                try:
+                    prepared.append(PreparedKernel(instance, self.build_kernel(instance, verbose), None))
+                except Exception as e:
+                    prepared.append(PreparedKernel(instance, None, e))
+            return prepared
+
+        try:
+            if instances[0].compiler_options:
+                builds = self.dev.build_batch([i.name for i in instances], [i.kernel_string for i in instances], options=instances[0].compiler_options)
+            else:
+                builds = self.dev.build_batch([i.name for i in instances], [i.kernel_string for i in instances])
+            return [PreparedKernel(instance, build, None) for instance, build in zip(instances, builds)]
+        except Exception as e:
+            logging.debug('build_batch failed for %d kernels: %s', len(instances), str(e))
+
+        half = len(instances) // 2
+        prepared = self._build_batch(instances[:half], verbose) + self._build_batch(instances[half:], verbose)
+
+        #if two kernels that each compile fail to compile together, the kernel cannot be combined
+        if len(instances) == 2 and all(p.error is None and p.build is not None for p in prepared):
+            logging.debug('kernels cannot be built in batches, disabling batch builds')
+            self.batch_builds = False
+        return prepared
+
+    def _call_compiler(self, compile_func, instance, verbose):
+        """call compile_func on the kernel string, return None if the instance is skipped"""
         func = None
         try:
-            func = self.dev.compile(instance.name, instance.kernel_string)
+            if instance.compiler_options:
+                func = compile_func(instance.name, instance.kernel_string, options=instance.compiler_options)
+            else:
+                func = compile_func(instance.name, instance.kernel_string)
         except Exception as e:
             #compiles may fail because certain kernel configurations use too
             #much shared memory for example, the desired behavior is to simply
@@ -265,10 +562,60 @@ class DeviceInterface(object):
         kernel_source = kernel_options.kernel_string
         if not isinstance(kernel_source, list):
             kernel_source = [kernel_source]
-        name, kernel_string, temp_files = util.prepare_list_of_files(kernel_options.kernel_name, kernel_source, params, grid, threads, kernel_options.block_size_names)
+        runtime_params = kernel_options.get("runtime_params") or []
+        compiler_option_params = kernel_options.get("compiler_option_params") or []
+        name, kernel_string, temp_files = util.prepare_list_of_files(kernel_options.kernel_name, kernel_source, params, grid, threads,
+                                                                     kernel_options.block_size_names, self.workspace.directory,
+                                                                     self.precompiled_header, runtime_params, self.generated_sources,
+                                                                     compiler_option_params)
+        runtime_args = util.get_runtime_args(params, runtime_params, kernel_options.block_size_names)
+
+        #the values of compiler option parameters are passed to the compiler, rather than defined in the source
+        compiler_options = split_options([params[k] for k in compiler_option_params])
 
         #collect everything we know about this instance and return it
-        return KernelInstance(name, kernel_string, temp_files, threads, grid, params, kernel_options.arguments)
+        return KernelInstance(name, kernel_string, temp_files, threads, grid, params, kernel_options.arguments, runtime_args, compiler_options)
+
+    def get_device_restrictions(self, tune_params, block_size_names=None, shared_memory_usage=None):
+        """return restrictions that exclude configurations which cannot be launched on this device
+
+        :param tune_params: A dictionary with the tunable parameters.
+        :type tune_params: dict
+
+        :param block_size_names: The names of the thread block dimensions, the defaults
+            are used if not given.
+        :type block_size_names: list(string)
+
+        :param shared_memory_usage: A Python expression that computes the amount of
+            shared memory in bytes used by a kernel configuration. Only applied by
+            backends that report the shared memory of the device, CUDA and OpenCL,
+            a warning is given otherwise.
+        :type shared_memory_usage: string
+
+        :returns: A list of restriction strings.
+        :rtype: list(string)
+        """
+        if not block_size_names:
+            block_size_names = util.default_block_size_names
+        restrictions = []
+
+        #the number of threads per block, using the same defaults as get_thread_block_dimensions
+        max_threads = getattr(self.dev, "max_threads", None)
+        if isinstance(max_threads, (int, numpy.integer)) and any(name in tune_params for name in block_size_names):
+            threads = [name for name in block_size_names if name in tune_params]
+            if block_size_names[0] not in tune_params:
+                threads.append("256")
+            restrictions.append("*".join(threads) + " <= " + str(max_threads))
+
+        max_shared_memory = getattr(self.dev, "max_shared_memory", None)
+        if shared_memory_usage is not None:
+            if isinstance(max_shared_memory, (int, numpy.integer)):
+                restrictions.append("(" + shared_memory_usage + ") <= " + str(max_shared_memory))
+            else:
+                warnings.warn("shared_memory_usage is ignored, the " + self.dev.__class__.__name__ + " backend does not report the shared memory of the device",
+                              UserWarning)
+
+        return restrictions
 
     def get_environment(self):
         """Return dictionary with information about the environment"""
@@ -289,7 +636,7 @@ class DeviceInterface(object):
         logging.debug('grid dims (%d, %d, %d)', *instance.grid)
 
         try:
-            self.dev.run_kernel(func, gpu_args, instance.threads, instance.grid)
+            self.dev.run_kernel(func, self.get_launch_args(gpu_args, instance), instance.threads, instance.grid)
         except Exception as e:
             if "too many resources requested for launch" in str(e) or "OUT_OF_RESOURCES" in str(e):
                 logging.debug('ignoring runtime failure due to too many resources required')
@@ -300,7 +647,20 @@ class DeviceInterface(object):
         return True
 
 
+    def get_launch_args(self, gpu_args, instance):
+        """ return the arguments of the kernel followed by the runtime arguments of the instance """
+        if not instance.runtime_args:
+            return gpu_args
+        runtime_args = instance.runtime_args
+        if self.lang == "C":
+            runtime_args = [dtype_map[str(arg.dtype)](arg) for arg in runtime_args]
+        return list(gpu_args) + runtime_args
+
     def __del__(self):
+        if hasattr(self, 'kernel_pool'):
+            self.kernel_pool.clear()
         if hasattr(self, 'dev'):
             del self.dev
+        if hasattr(self, 'workspace'):
+            self.workspace.cleanup()
 
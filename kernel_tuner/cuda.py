@@ -47,6 +47,7 @@ class CudaFunctions(object):
         #inspect device properties
         devprops = {str(k): v for (k, v) in self.context.get_device().get_attributes().items()}
         self.max_threads = devprops['MAX_THREADS_PER_BLOCK']
+        self.max_shared_memory = devprops.get('MAX_SHARED_MEMORY_PER_BLOCK')
         cc = str(devprops.get('COMPUTE_CAPABILITY_MAJOR', '0')) + str(devprops.get('COMPUTE_CAPABILITY_MINOR', '0'))
         if cc == "00":
             cc = self.context.get_device().compute_capability()
@@ -118,6 +119,24 @@ class CudaFunctions(object):
         :returns: An CUDA kernel that can be called directly.
         :rtype: pycuda.driver.Function
         """
+        return self.load(kernel_name, self.build(kernel_name, kernel_string))
+
+    def build(self, kernel_name, kernel_string):
+        """call the CUDA compiler to compile the kernel into a module
+
+        The context is made current in the calling thread, such that kernels can
+        be built in other threads while a kernel is benchmarked.
+
+        :param kernel_name: The name of the kernel to be compiled.
+        :type kernel_name: string
+
+        :param kernel_string: The CUDA kernel code that contains the function `kernel_name`
+        :type kernel_string: string
+
+        :returns: The compiled module, to be passed to load().
+        :rtype: pycuda.compiler.SourceModule
+        """
+        self.context.push()
         try:
             no_extern_c = 'extern "C"' in kernel_string
 
@@ -125,18 +144,32 @@ class CudaFunctions(object):
             if self.compiler_options:
                 compiler_options += self.compiler_options
 
-            self.current_module = self.source_mod(kernel_string, options=compiler_options + ["-e", kernel_name],
-                                             arch=('compute_' + self.cc) if self.cc != "00" else None,
-                                             code=('sm_' + self.cc) if self.cc != "00" else None,
-                                             cache_dir=False, no_extern_c=no_extern_c)
-
-            func = self.current_module.get_function(kernel_name)
-            return func
+            return self.source_mod(kernel_string, options=compiler_options + ["-e", kernel_name],
+                                   arch=('compute_' + self.cc) if self.cc != "00" else None,
+                                   code=('sm_' + self.cc) if self.cc != "00" else None,
+                                   cache_dir=False, no_extern_c=no_extern_c)
         except drv.CompileError as e:
             if "uses too much shared data" in e.stderr:
                 raise Exception("uses too much shared data")
             else:
                 raise e
+        finally:
+            drv.Context.pop()
+
+    def load(self, kernel_name, module):
+        """make a module returned by build() the current module, return the device function
+
+        :param kernel_name: The name of the kernel, used to lookup the function.
+        :type kernel_name: string
+
+        :param module: The compiled module as returned by build().
+        :type module: pycuda.compiler.SourceModule
+
+        :returns: An CUDA kernel that can be called directly.
+        :rtype: pycuda.driver.Function
+        """
+        self.current_module = module
+        return module.get_function(kernel_name)
 
 
     def benchmark(self, func, gpu_args, threads, grid, times):
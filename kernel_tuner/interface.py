@@ -30,10 +30,13 @@ import importlib
 from datetime import datetime
 import logging
 import sys
+import warnings
 import numpy
 
 import kernel_tuner.util as util
 import kernel_tuner.core as core
+import kernel_tuner.toolchain as toolchain
+from kernel_tuner.searchspace import SearchSpace
 
 from kernel_tuner.strategies import brute_force, random_sample, diff_evo, minimize, basinhopping, genetic_algorithm, pso, simulated_annealing, firefly_algorithm
 
@@ -120,6 +123,28 @@ _kernel_options = Options([
     ("block_size_names", ("""A list of strings that replace the defaults for the names
             that denote the thread block dimensions. If not passed, the behavior
             defaults to ``["block_size_x", "block_size_y", "block_size_z"]``""",
+            "list(string)")),
+    ("runtime_params", ("""A list of names of tunable parameters whose values
+            are not inserted into the kernel as #define, such that all
+            configurations that only differ in these parameters use the same
+            compiled kernel. Runtime parameters that denote thread block
+            dimensions only change how the kernel is launched, the kernel
+            should use blockDim or get_local_size() instead. The values of
+            the other runtime parameters are appended to the arguments of the
+            kernel, in the order of this list, as numpy.int32 for ints,
+            numpy.float32 for floats, or with the type of numpy scalars.
+            Kernels with runtime parameters do not get the grid dimensions
+            as #define. Configurations are enumerated with the runtime
+            parameters varying fastest. The default is None.""",
+            "list(string)")),
+    ("compiler_option_params", ("""A list of names of tunable parameters
+            whose values are compiler options, for example a parameter with the
+            values ["-O2", "-O3"] or ["", "-march=native -ffast-math"]. Each
+            kernel configuration is compiled with the options of its values,
+            in addition to compiler_options, and the values are not defined in
+            the kernel source. Values that the compiler does not accept are
+            removed from the tunable parameters with a warning.
+            Only supported with lang="C". The default is None.""",
             "list(string)"))
     ])
 
@@ -153,7 +178,35 @@ _tuning_options = Options([
         restrictions=["block_size_x==block_size_y*tile_size_y"] limits the
         search to configurations where the block_size_x equals the product
         of block_size_y and tile_size_y.
+        The names of tunable parameters are used as variables in these
+        expressions, which are parsed only once before tuning starts.
+        Restrictions can also be given as functions that take a dictionary
+        with the values of the tunable parameters and return True if the
+        configuration is part of the search space. Functions wrapped with
+        kernel_tuner.util.callable_restriction(func, params, batch=True)
+        receive NumPy arrays with the values of many configurations at once
+        and return a boolean array, which is much faster for large search
+        spaces. A single string or function may be passed instead of a list.
         The default is None.""", "list")),
+    ("conditions", ("""A dictionary that declares conditional tunable
+        parameters, which only affect the kernel for some values of the other
+        parameters. The dictionary maps the name of a tunable parameter to a
+        string containing a boolean expression that is true when the
+        parameter is active. For example:
+        conditions={"unroll_factor": "use_unroll == 1"} declares that
+        unroll_factor only matters when use_unroll is 1. When a parameter is
+        inactive it is pinned to the first value in its list of values, such
+        that configurations that only differ in inactive parameters are
+        benchmarked only once. The default is None.""", "dict(string: string)")),
+    ("shared_memory_usage", ("""A string containing a Python expression
+        that computes the amount of shared memory (local memory in OpenCL)
+        in bytes that a kernel configuration uses, for example:
+        "block_size_x*tile_size_x*4". The names of tunable parameters can be
+        used as variables. Configurations that use more shared memory than
+        the device provides per thread block are excluded from the search
+        space. Only supported for CUDA and OpenCL kernels and not with the
+        Noodles runner, a warning is given when it is ignored. The default
+        is None.""", "string")),
     ("answer", ("""A list of arguments, similar to what you pass to arguments,
         that contains the expected output of the kernel after it has executed
         and contains None for each argument that is input-only. The expected
@@ -187,6 +240,23 @@ _tuning_options = Options([
     ("num_threads", ("""The number of threads to use when using the Noodles
         workflow engine for tuning using multiple threads, 1 by default.
         Requires Noodles, see 'use_noodles' option.""", "int")),
+    ("compile_workers", ("""The number of worker threads that prepare and
+        compile the next kernel configurations while the current configuration
+        is benchmarked, 0 by default to compile and benchmark each
+        configuration in turn. Kernels are still benchmarked one at a time.
+        Cannot be combined with the Noodles runner.""", "int")),
+    ("compile_batch_size", ("""The number of kernel configurations that are
+        compiled together into a single library with one call to the
+        compiler, 1 by default. Only supported for C kernels that define no
+        other functions or global variables, batches that fail to compile are
+        split until the configurations that fail are found. Implies that the
+        kernels are compiled in at least one worker thread.""", "int")),
+    ("detect_dead_params", ("""Detect tunable parameters that do not occur
+        in the kernel sources, the local headers they include, or the problem
+        size and grid divisor expressions. Configurations that differ only in
+        these parameters result in the same kernel, which is benchmarked only
+        once, the others get the same time. Disabled automatically when a local
+        header cannot be found. True by default.""", "bool")),
     ("strategy", ("""Specify the strategy to use for searching through the
         parameter space, choose from:
 
@@ -276,7 +346,31 @@ _device_options = Options([
     ("compiler", ("""A string containing your preferred compiler,
         only effective with lang="C". """, "string")),
     ("compiler_options", ("""A list of strings that specify compiler
-        options.""", "list(string)"))
+        options.""", "list(string)")),
+    ("cache_dir", ("""Directory in which the Kernel Tuner stores data that
+        can be reused by later runs, such as the constructed search space,
+        compiled C kernels and OpenCL program binaries, the versions of the
+        C compilers, and the configurations that could not be compiled
+        or launched on the device, which are excluded from later runs.
+        Processes that use the same directory share this data. Nothing is
+        stored on disk if not set, which is the default.""", "string")),
+    ("workspace_dir", ("""Directory in which a private workspace is created
+        for the temporary files of the run, such as kernel sources, instance
+        files, and compiled C kernels. The workspace is removed when the run
+        is finished. By default the workspace is created in /dev/shm, or in the
+        system temp directory if /dev/shm is not available, rather than in
+        the current working directory.""", "string")),
+    ("keep_failed", ("""Keep the source files of configurations that failed
+        to compile or run in the workspace when it is removed, for
+        debugging. True by default.""", "bool")),
+    ("precompiled_header", ("""Compile the #include lines at the start of
+        a C kernel once into a precompiled header, which is then used for every
+        kernel configuration, rather than parsing the headers again for each
+        configuration. The #define lines of the tunable parameters are inserted
+        after these #include lines, the included headers therefore may not
+        depend on the tunable parameters. Only effective with lang="C" and
+        compilers that support precompiled headers, such as g++ and clang++.
+        False by default.""", "bool"))
     ])
 
 
@@ -307,12 +401,30 @@ def tune_kernel(kernel_name, kernel_string, problem_size, arguments,
                 restrictions=None, answer=None, atol=1e-6, verify=None, verbose=False,
                 lang=None, device=0, platform=0, cmem_args=None,
                 num_threads=1, use_noodles=False, sample_fraction=False, compiler=None, compiler_options=None, log=None,
-                iterations=7, times=False, block_size_names=None, quiet=False, strategy=None, method=None):
+                iterations=7, times=False, block_size_names=None, quiet=False, strategy=None, method=None,
+                cache_dir=None, shared_memory_usage=None, conditions=None, compile_workers=0, compile_batch_size=1,
+                workspace_dir=None, keep_failed=True, precompiled_header=False, runtime_params=None, compiler_option_params=None,
+                detect_dead_params=True):
 
     if log:
         logging.basicConfig(filename=kernel_name + datetime.now().strftime('%Y%m%d-%H:%M:%S') + '.log', level=log)
 
-    _check_user_input(kernel_name, kernel_string, arguments, block_size_names)
+    # runtime parameters vary fastest, configurations that share a compiled kernel are benchmarked consecutively
+    runtime_args = []
+    if runtime_params:
+        tune_params = util.order_runtime_params_last(tune_params, runtime_params)
+        runtime_args = util.get_runtime_args(dict((k, v[0]) for k, v in tune_params.items()), runtime_params, block_size_names)
+
+    _check_user_input(kernel_name, kernel_string, list(arguments) + runtime_args, block_size_names)
+
+    # each configuration is compiled with the compiler options of its compiler option parameters
+    if compiler_option_params:
+        if util.detect_language(lang, kernel_string) != "C":
+            raise ValueError("Compiler option parameters are only supported for C kernels")
+        #the options are checked with the compiler that builds the kernel, which is nvcc for CUDA code
+        sources = [s for s in (kernel_string if isinstance(kernel_string, list) else [kernel_string]) if not callable(s)]
+        kernel_compiler = toolchain.get_compiler(compiler or "g++", "\n".join(util.get_kernel_string(s) for s in sources))
+        tune_params = toolchain.get_supported_params(tune_params, compiler_option_params, kernel_compiler)
 
     # check for forbidden names in tune parameters
     util.check_tune_params_list(tune_params)
@@ -323,6 +435,16 @@ def tune_kernel(kernel_name, kernel_string, problem_size, arguments,
     if iterations < 1:
         raise ValueError("Iterations should be at least one!")
 
+    # inactive conditional parameters are restricted to a single value
+    if conditions is not None:
+        conditions = util.compile_conditions(conditions, tune_params)
+        restrictions = util.compile_restrictions(restrictions or [], tune_params) + \
+                       util.compile_restrictions(util.get_condition_restrictions(conditions), tune_params)
+
+    # parse the restrictions once, rather than for every kernel configuration
+    if restrictions is not None:
+        restrictions = util.compile_restrictions(restrictions, tune_params)
+
     #sort all the options into separate dicts
     opts = locals()
     kernel_options = Options([(k, opts[k]) for k in _kernel_options.keys()])
@@ -373,7 +495,12 @@ def tune_kernel(kernel_name, kernel_string, problem_size, arguments,
     strategy = use_strategy
 
     #select runner based on user options
-    if num_threads == 1 and not use_noodles:
+    if (compile_workers > 0 or compile_batch_size > 1) and use_noodles:
+        raise ValueError("Compiling in worker threads is not supported by the Noodles runner")
+    if num_threads == 1 and not use_noodles and (compile_workers > 0 or compile_batch_size > 1):
+        from kernel_tuner.runners.pipelined import PipelinedRunner
+        runner = PipelinedRunner(kernel_options, device_options, iterations, max(compile_workers, 1), compile_batch_size)
+    elif num_threads == 1 and not use_noodles:
         from kernel_tuner.runners.sequential import SequentialRunner
         runner = SequentialRunner(kernel_options, device_options, iterations)
     elif num_threads > 1 and not use_noodles:
@@ -392,6 +519,37 @@ def tune_kernel(kernel_name, kernel_string, problem_size, arguments,
     else:
         raise ValueError("Somehow no runner was selected, this should not happen, please file a bug report")
 
+    #exclude configurations that cannot be launched on the device from the search space,
+    #the Noodles runner only creates devices in its worker threads and checks this at runtime
+    if runner.dev is not None:
+        device_restrictions = runner.dev.get_device_restrictions(tune_params, block_size_names, shared_memory_usage)
+        if device_restrictions:
+            tuning_options["restrictions"] = util.compile_restrictions((restrictions or []) + device_restrictions, tune_params)
+    elif shared_memory_usage is not None:
+        warnings.warn("shared_memory_usage is ignored by the Noodles runner", UserWarning)
+
+    #configurations that only differ in dead parameters are only benchmarked once
+    grid_div = (grid_div_x, grid_div_y, grid_div_z)
+    tuning_options["dead_params"] = []
+    if detect_dead_params:
+        tuning_options["dead_params"] = util.get_dead_params(kernel_string, tune_params, problem_size, grid_div, block_size_names, runtime_params,
+                                                             compiler_option_params, compiler_options)
+    if tuning_options.dead_params:
+        logging.info('tunable parameters not used by the kernel, benchmarked only once: %s', ", ".join(tuning_options.dead_params))
+        if verbose:
+            print("tunable parameters not used by the kernel:", ", ".join(tuning_options.dead_params))
+
+    #the search space is only enumerated when a strategy first needs it
+    tuning_options["searchspace"] = SearchSpace(tune_params, tuning_options.restrictions, verbose, cache_dir=cache_dir)
+
+    #configurations that failed to compile or launch on this device in earlier runs are excluded
+    if runner.dev is not None:
+        failed = runner.dev.get_failed_configs(kernel_options, tune_params)
+        if failed:
+            tuning_options["searchspace"] = tuning_options.searchspace.exclude(failed)
+    if verbose:
+        print("search space contains", len(tuning_options.searchspace), "of", tuning_options.searchspace.size, "configurations")
+
     #call the strategy to execute the tuning process
     results, env = strategy.tune(runner, kernel_options, device_options, tuning_options)
 
@@ -444,9 +602,11 @@ _run_kernel_docstring = """Compile and run a single kernel
 def run_kernel(kernel_name, kernel_string, problem_size, arguments,
                params, grid_div_x=None, grid_div_y=None, grid_div_z=None,
                lang=None, device=0, platform=0, cmem_args=None, compiler=None, compiler_options=None,
-               block_size_names=None, quiet=False):
+               block_size_names=None, quiet=False, cache_dir=None,
+               workspace_dir=None, keep_failed=True, precompiled_header=False, runtime_params=None,
+               compiler_option_params=None):
 
-    _check_user_input(kernel_name, kernel_string, arguments, block_size_names)
+    _check_user_input(kernel_name, kernel_string, list(arguments) + util.get_runtime_args(params, runtime_params, block_size_names), block_size_names)
 
     #sort options into separate dicts
     opts = locals()
@@ -467,7 +627,7 @@ def run_kernel(kernel_name, kernel_string, problem_size, arguments,
             raise Exception("cannot create kernel instance, too many threads per block")
 
         # see if the kernel arguments have correct type
-        util.check_argument_list(instance.name, instance.kernel_string, arguments)
+        util.check_argument_list(instance.name, instance.kernel_string, list(arguments) + instance.runtime_args)
 
         #compile the kernel
         func = dev.compile_kernel(instance, False)
@@ -481,7 +641,7 @@ def run_kernel(kernel_name, kernel_string, problem_size, arguments,
         #delete temp files
         if instance is not None:
             for v in instance.temp_files.values():
-                util.delete_temp_file(v)
+                util.release_instance_file(v)
 
     #run the kernel
     if not dev.run_kernel(func, gpu_args, instance):
@@ -1,7 +1,13 @@
 """This module contains all OpenCL specific kernel_tuner functions"""
 from __future__ import print_function
+import hashlib
+import logging
+import os
 import numpy
 
+from kernel_tuner.cache import FileCache, get_key
+from kernel_tuner.util import get_relative_source
+
 #embedded in try block to be able to generate documentation
 try:
     import pyopencl as cl
@@ -12,7 +18,7 @@ except ImportError:
 class OpenCLFunctions(object):
     """Class that groups the OpenCL functions on maintains some state about the device"""
 
-    def __init__(self, device=0, platform=0, iterations=7, compiler_options=None):
+    def __init__(self, device=0, platform=0, iterations=7, compiler_options=None, cache_dir=None, cache_size=None, temp_dir=None):
         """Creates OpenCL device context and reads device properties
 
         :param device: The ID of the OpenCL device to use for benchmarking
@@ -20,6 +26,18 @@ class OpenCLFunctions(object):
 
         :param iterations: The number of iterations to run the kernel during benchmarking, 7 by default.
         :type iterations: int
+
+        :param cache_dir: Directory in which the binaries of built programs are stored
+            for reuse, None by default to always build programs from source.
+        :type cache_dir: string
+
+        :param cache_size: The maximum size in bytes of the stored binaries,
+            1 GiB by default.
+        :type cache_size: int
+
+        :param temp_dir: Directory in which the instance files included by kernels
+            are created, which is left out of the keys of stored binaries.
+        :type temp_dir: string
         """
         if not cl:
             raise ImportError("Error: pyopencl not installed, please install e.g. using 'pip install pyopencl'.")
@@ -33,7 +51,9 @@ class OpenCLFunctions(object):
         self.mf = cl.mem_flags
         #inspect device properties
         self.max_threads = self.ctx.devices[0].get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
+        self.max_shared_memory = self.ctx.devices[0].get_info(cl.device_info.LOCAL_MEM_SIZE)
         self.compiler_options = compiler_options or []
+        self.temp_dir = temp_dir
 
         #collect environment information
         dev = self.ctx.devices[0]
@@ -49,6 +69,13 @@ class OpenCLFunctions(object):
         self.env = env
         self.name = dev.name
 
+        #binaries are only valid for the same device and driver
+        self.compile_cache = None
+        self.device_key = None
+        if cache_dir:
+            self.compile_cache = FileCache(os.path.join(cache_dir, "opencl"), cache_size)
+            self.device_key = sorted((k, v) for k, v in env.items() if k not in ["iterations", "compiler_options"])
+
     def ready_argument_list(self, arguments):
         """ready argument list to be passed to the kernel, allocates gpu mem
 
@@ -82,9 +109,73 @@ class OpenCLFunctions(object):
         :returns: An OpenCL kernel that can be called directly.
         :rtype: pyopencl.Kernel
         """
+        return self.load(kernel_name, self.build(kernel_name, kernel_string))
+
+    def build(self, kernel_name, kernel_string):
+        """call the OpenCL compiler to build the program that contains the kernel
+
+        :param kernel_name: The name of the kernel to be compiled.
+        :type kernel_name: string
+
+        :param kernel_string: The OpenCL kernel code that contains the function `kernel_name`
+        :type kernel_string: string
+
+        :returns: The built program, to be passed to load().
+        :rtype: pyopencl.Program
+        """
+        #programs are stored under a hash of the device, the build options, and the source
+        key = None
+        if self.compile_cache is not None:
+            key = get_key(get_relative_source(kernel_string, self.temp_dir), self.compiler_options, self.device_key)
+            filename = self.compile_cache.lookup(key, ".bin")
+            if filename:
+                try:
+                    with open(filename, "rb") as f:
+                        binary = f.read()
+                    return cl.Program(self.ctx, self.ctx.devices, [binary]).build(options=self.compiler_options)
+                except (IOError, cl.Error):
+                    #the binary was evicted by another process, or is rejected by the driver
+                    logging.debug('failed to load cached binary for ' + kernel_name)
+
         prg = cl.Program(self.ctx, kernel_string).build(options=self.compiler_options)
-        func = getattr(prg, kernel_name)
-        return func
+
+        if key is not None:
+            binaries = prg.get_info(cl.program_info.BINARIES)
+            if binaries and binaries[0]:
+                self.compile_cache.write(key, bytes(binaries[0]), ".bin")
+        return prg
+
+    def load(self, kernel_name, prg):
+        """return the kernel in a program returned by build()
+
+        :param kernel_name: The name of the kernel.
+        :type kernel_name: string
+
+        :param prg: The program as returned by build().
+        :type prg: pyopencl.Program
+
+        :returns: An OpenCL kernel that can be called directly.
+        :rtype: pyopencl.Kernel
+        """
+        return getattr(prg, kernel_name)
+
+    def get_binary_hash(self, func):
+        """return a hash of the device binaries of the program that contains the kernel func
+
+        :param func: A kernel returned by load().
+        :type func: pyopencl.Kernel
+
+        :returns: The hash, or None if the binaries are not available.
+        :rtype: string
+        """
+        try:
+            binaries = func.get_info(cl.kernel_info.PROGRAM).get_info(cl.program_info.BINARIES)
+        except cl.Error:
+            return None
+        binary_hash = hashlib.sha256()
+        for binary in binaries:
+            binary_hash.update(bytes(binary))
+        return binary_hash.hexdigest()
 
     def benchmark(self, func, gpu_args, threads, grid, times):
         """runs the kernel and measures time repeatedly, returns average time
@@ -0,0 +1,85 @@
+""" Module for keeping compiled kernels loaded for reuse within a tuning run """
+from __future__ import print_function
+
+from collections import OrderedDict
+import logging
+
+default_pool_size = 16
+
+
+class KernelPool(object):
+    """Least recently used set of loaded kernels, keyed by a hash of their source
+
+    Kernel instances that have the same source, for example because a strategy
+    visits the same configuration again, or because they only differ in
+    parameters that are not used in the source, reuse the loaded kernel
+    rather than compiling it again. When the pool is full the kernel that was
+    used least recently is unloaded. Backends may be unable to unload some
+    kernels, such as C libraries that use OpenMP, these are counted as leaked.
+    """
+
+    def __init__(self, max_size=None, unload=None):
+        """ Create an empty pool
+
+        :param max_size: The maximum number of loaded kernels, 16 by default.
+            The kernel that was added last is always kept loaded.
+        :type max_size: int
+
+        :param unload: A function that unloads a kernel, returns False if the
+            kernel remains loaded. Kernels are only dereferenced if not given.
+        :type unload: callable
+        """
+        self.max_size = max(1, default_pool_size if max_size is None else max_size)
+        self.unload = unload
+        self.kernels = OrderedDict()
+        self.leaked = set()
+        self.hits = 0
+
+    def get(self, key):
+        """ return the kernel stored under key and its module, or None
+
+        :param key: The hash of the source of the kernel.
+        :type key: string
+
+        :returns: The kernel function and the module it was loaded from, as passed to add().
+        :rtype: tuple
+        """
+        entry = self.kernels.get(key)
+        if entry is not None:
+            #move the kernel to the most recently used end, OrderedDict.move_to_end does not exist in Python 2.7
+            self.kernels[key] = self.kernels.pop(key)
+            self.hits += 1
+        return entry
+
+    def add(self, key, func, module=None):
+        """ store a loaded kernel, unload the least recently used kernels if the pool is full
+
+        :param key: The hash of the source of the kernel.
+        :type key: string
+
+        :param func: The loaded kernel function.
+        :type func: any
+
+        :param module: The backend specific module the kernel was loaded from, if any.
+        :type module: any
+        """
+        if key in self.kernels:
+            self._unload(key, self.kernels.pop(key)[0])
+        while len(self.kernels) >= self.max_size:
+            old_key, (old_func, _) = self.kernels.popitem(last=False)
+            self._unload(old_key, old_func)
+        self.kernels[key] = (func, module)
+
+    def clear(self):
+        """ unload all kernels in the pool """
+        while self.kernels:
+            key, (func, _) = self.kernels.popitem(last=False)
+            self._unload(key, func)
+
+    def _unload(self, key, func):
+        if self.unload is not None and self.unload(func) is False:
+            self.leaked.add(key)
+            logging.debug('kernel could not be unloaded, %d kernels leaked', len(self.leaked))
+
+    def __len__(self):
+        return len(self.kernels)
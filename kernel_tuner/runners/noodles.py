@@ -10,6 +10,8 @@ from noodles.run.runners import run_parallel_with_display, run_parallel
 from noodles.display import NCDisplay
 
 from kernel_tuner.core import DeviceInterface
+from kernel_tuner.searchspace import SearchSpace
+from kernel_tuner.util import get_live_key
 
 def _error_filter(errortype, value=None, tb=None):
     if errortype is subprocess.CalledProcessError:
@@ -19,10 +21,27 @@ def _error_filter(errortype, value=None, tb=None):
     return None
 
 def _chunk_list(l, n):
-    """Yield successive n-sized chunks from l."""
+    """Yield successive n-sized chunks from l, slicing a SearchSpace only copies its indices."""
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
+def _first_of_each_group(parameter_space, keys, dead_params):
+    """Return the configurations that differ from all earlier ones in the values of live parameters.
+
+    The parameter space is streamed and only the keys of the groups are stored,
+    a SearchSpace is returned as a SearchSpace that holds only the selected indices.
+    """
+    seen = set()
+    first = numpy.zeros(len(parameter_space), dtype=bool)
+    for i, element in enumerate(parameter_space):
+        key = get_live_key(dict(zip(keys, element)), dead_params)
+        if key not in seen:
+            seen.add(key)
+            first[i] = True
+    if isinstance(parameter_space, SearchSpace):
+        return parameter_space.select(first)
+    return [element for element, f in zip(parameter_space, first) if f]
+
 class NoodlesRunner:
 
     def __init__(self, device_options, max_threads=1):
@@ -34,8 +53,9 @@ class NoodlesRunner:
     def run(self, parameter_space, kernel_options, tuning_options):
         """ Tune all instances in parameter_space using a multiple threads
 
-        :param parameter_space: The parameter space as an iterable.
-        :type parameter_space: iterable
+        :param parameter_space: The parameter space as an iterable, the
+            chunks handed to each thread only hold indices into it.
+        :type parameter_space: kernel_tuner.searchspace.SearchSpace or iterable
 
         :param kernel_options: A dictionary with all options for the kernel.
         :type kernel_options: kernel_tuner.interface.Options
@@ -50,7 +70,17 @@ class NoodlesRunner:
         :rtype: list(dict()), dict()
 
         """
-        workflow = self._parameter_sweep(parameter_space, kernel_options, self.device_options,
+        #configurations that only differ in dead parameters result in the same kernel,
+        #only one configuration of each group is benchmarked
+        dead_params = tuning_options.get("dead_params") or []
+        keys = list(tuning_options.tune_params.keys())
+        benchmarked_space = parameter_space
+        if dead_params:
+            if not isinstance(parameter_space, SearchSpace):
+                parameter_space = list(parameter_space)
+            benchmarked_space = _first_of_each_group(parameter_space, keys, dead_params)
+
+        workflow = self._parameter_sweep(benchmarked_space, kernel_options, self.device_options,
                                          tuning_options)
         if tuning_options.verbose:
             with NCDisplay(_error_filter) as display:
@@ -67,6 +97,19 @@ class NoodlesRunner:
         for chunk in answer:
             result += [d for d in chunk if d['time']]
 
+        #copy the measured times to the other configurations in each group
+        if dead_params:
+            times = dict((get_live_key(dict((k, d[k]) for k in keys), dead_params), d['time']) for d in result)
+            first = set(times.keys())
+            for element in parameter_space:
+                params = dict(zip(keys, element))
+                key = get_live_key(params, dead_params)
+                if key in first:
+                    first.discard(key)
+                elif key in times:
+                    params['time'] = times[key]
+                    result.append(params)
+
         return result, {}
 
 
@@ -78,8 +121,11 @@ class NoodlesRunner:
         results = []
 
         #randomize parameter space to do pseudo load balancing
-        parameter_space = list(parameter_space)
-        random.shuffle(parameter_space)
+        if isinstance(parameter_space, SearchSpace):
+            parameter_space = parameter_space.permutation()
+        else:
+            parameter_space = list(parameter_space)
+            random.shuffle(parameter_space)
 
         #split parameter space into chunks
         work_per_thread = int(numpy.ceil(len(parameter_space) / float(self.max_threads)))
@@ -111,7 +157,7 @@ class NoodlesRunner:
             params = dict(OrderedDict(zip(tuning_options.tune_params.keys(), element)))
 
             try:
-                time = self.dev.compile_and_benchmark(gpu_args, params, kernel_options, tuning_options)
+                time = self.dev.benchmark_once(gpu_args, params, kernel_options, tuning_options)
 
                 params['time'] = time
                 results.append(params)
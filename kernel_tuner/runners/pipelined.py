@@ -0,0 +1,157 @@
+""" The runner that compiles kernels in worker threads while benchmarking sequentially """
+from __future__ import print_function
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from kernel_tuner.util import get_config_string, get_live_key
+from kernel_tuner.core import DeviceInterface
+
+
+class PipelinedRunner(object):
+    """ PipelinedRunner overlaps the compilation of the next kernel configurations with benchmarking
+
+    Kernel sources are prepared and compiled in a pool of worker threads, which
+    mostly wait for the compiler processes. The compiled kernels are loaded and
+    benchmarked one at a time in the calling thread, in the order of the parameter
+    space, such that measurements do not interfere with each other.
+
+    Each worker compiles batches of configurations. If the backend supports it,
+    all kernels in a batch are compiled into a single library with one call to
+    the compiler.
+    """
+
+    def __init__(self, kernel_options, device_options, iterations, compile_workers, compile_batch_size=1):
+        """ Instantiate the PipelinedRunner
+
+        :param kernel_options: A dictionary with all options for the kernel.
+        :type kernel_options: kernel_tuner.interface.Options
+
+        :param device_options: A dictionary with all options for the device
+            on which the kernel should be tuned.
+        :type device_options: kernel_tuner.interface.Options
+
+        :param iterations: The number of iterations used for benchmarking
+            each kernel instance.
+        :type iterations: int
+
+        :param compile_workers: The number of batches of kernel configurations that
+            are compiled ahead of the one being benchmarked.
+        :type compile_workers: int
+
+        :param compile_batch_size: The number of kernel configurations that are
+            compiled together, 1 by default.
+        :type compile_batch_size: int
+        """
+
+        #detect language and create high-level device interface
+        self.dev = DeviceInterface(kernel_options.kernel_string, iterations=iterations, **device_options)
+        self.units = self.dev.units
+        self.quiet = device_options.quiet
+        self.compile_workers = compile_workers
+        self.compile_batch_size = compile_batch_size
+
+        #move data to the GPU
+        self.gpu_args = self.dev.ready_argument_list(kernel_options.arguments)
+
+
+    def run(self, parameter_space, kernel_options, tuning_options):
+        """ Iterate through the entire parameter space, compiling ahead in worker threads
+
+        :param parameter_space: The parameter space as an iterable.
+        :type parameter_space: kernel_tuner.searchspace.SearchSpace or iterable
+
+        :param kernel_options: A dictionary with all options for the kernel.
+        :type kernel_options: kernel_tuner.interface.Options
+
+        :param tuning_options: A dictionary with all options regarding the tuning
+            process.
+        :type tuning_options: kernel_tuner.iterface.Options
+
+        :returns: A list of dictionaries for executed kernel configurations and their
+            execution times. And a dictionary that contains a information
+            about the hardware/software environment on which the tuning took place.
+        :rtype: list(dict()), dict()
+
+        """
+        logging.debug('pipelined runner started for ' + kernel_options.kernel_name)
+
+        results = []
+
+        #configurations that only differ in dead parameters result in the same kernel
+        dead_params = tuning_options.get("dead_params") or []
+        keys = list(tuning_options.tune_params.keys())
+        live = [i for i, k in enumerate(keys) if k not in dead_params]
+        #configurations that only differ in runtime parameters share a compiled kernel
+        runtime_params = kernel_options.get("runtime_params") or []
+        compiled = [i for i in live if keys[i] not in runtime_params]
+
+        elements = iter(parameter_space)
+        pending = deque()
+        submitted = set()
+        prepared_kernels = set()
+
+        with ThreadPoolExecutor(max_workers=self.compile_workers) as executor:
+
+            def submit_next():
+                """start preparing the next batch of configurations whose kernels are not yet benchmarked or being prepared"""
+                entries = []
+                batch = []
+                for element in elements:
+                    params = OrderedDict(zip(keys, element))
+                    key = get_live_key(params, dead_params)
+                    kernel_key = tuple(element[i] for i in compiled)
+                    if key in submitted or self.dev.is_benchmarked(params, tuning_options):
+                        entries.append((params, key, None))
+                    elif kernel_key in prepared_kernels:
+                        #the kernel is prepared for an earlier configuration and reused when this one is benchmarked
+                        entries.append((params, key, -1))
+                        submitted.add(key)
+                    else:
+                        entries.append((params, key, len(batch)))
+                        batch.append(params)
+                        submitted.add(key)
+                        prepared_kernels.add(kernel_key)
+                    if len(batch) == self.compile_batch_size:
+                        break
+                future = None
+                if batch:
+                    future = executor.submit(self.dev.prepare_kernels, batch, kernel_options, tuning_options)
+                pending.extend((params, key, future, i) for params, key, i in entries)
+
+            #keep the workers busy with the configurations after the one that is benchmarked
+            for _ in range(self.compile_workers + 1):
+                submit_next()
+
+            while pending:
+                params, key, future, i = pending.popleft()
+                #start the next batch when the benchmarking of a batch starts
+                if i == 0 or not pending:
+                    submit_next()
+
+                #configurations that only differ in dead parameters from one that is benchmarked get its time
+                prepared = None
+                if i is not None and i >= 0:
+                    prepared = future.result()[i]
+                time = self.dev.benchmark_once(self.gpu_args, params, kernel_options, tuning_options, prepared)
+                if i is not None:
+                    submitted.discard(key)
+
+                if time is None:
+                    logging.debug('received time is None, kernel configuration was skipped silently due to compile or runtime failure')
+                    continue
+
+                #print and append to results
+                params['time'] = time
+                output_string = get_config_string(params, self.units)
+                logging.debug(output_string)
+                if not self.quiet:
+                    print(output_string)
+                results.append(params)
+
+        return results, self.dev.get_environment()
+
+    def __del__(self):
+        if hasattr(self, 'dev'):
+            del self.dev
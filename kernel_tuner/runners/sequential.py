@@ -39,7 +39,7 @@ class SequentialRunner(object):
         """ Iterate through the entire parameter space using a single Python process
 
         :param parameter_space: The parameter space as an iterable.
-        :type parameter_space: iterable
+        :type parameter_space: kernel_tuner.searchspace.SearchSpace or iterable
 
         :param kernel_options: A dictionary with all options for the kernel.
         :type kernel_options: kernel_tuner.interface.Options
@@ -62,7 +62,8 @@ class SequentialRunner(object):
         for element in parameter_space:
             params = OrderedDict(zip(tuning_options.tune_params.keys(), element))
 
-            time = self.dev.compile_and_benchmark(self.gpu_args, params, kernel_options, tuning_options)
+            #configurations that only differ in dead parameters result in the same kernel, which is benchmarked once
+            time = self.dev.benchmark_once(self.gpu_args, params, kernel_options, tuning_options)
 
             if time is None:
                 logging.debug('received time is None, kernel configuration was skipped silently due to compile or runtime failure')
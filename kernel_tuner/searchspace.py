@@ -0,0 +1,780 @@
+""" Module for representing the search space spanned by the tunable parameters """
+from __future__ import print_function
+
+from collections import OrderedDict
+import ast
+import copy
+import hashlib
+import itertools
+import logging
+import math
+import os
+import random
+import tempfile
+import numpy
+from scipy.spatial import cKDTree
+
+from kernel_tuner import util
+
+#largest number of neighbors stored in a neighbor index, 512 MiB of positions
+max_neighbor_index_size = 2**26
+
+
+class SearchSpace(object):
+    """Lazy, randomly indexable representation of the search space
+
+    The search space is stored as a mixed-radix index space, in which each
+    point of the Cartesian product of the tunable parameters is identified by
+    a single integer. The last parameter varies fastest, the order of points
+    is therefore the same as that of itertools.product. Kernel configurations
+    are only created as tuples of parameter values when they are requested.
+
+    The points that meet the restrictions are stored as an int64 array of
+    indices into the Cartesian product, which is only built when it is first
+    needed. If there are no restrictions no such array is stored at all.
+    Points that are excluded later on are stored separately, as a sorted array
+    of their positions among these points, such that the stored points are
+    never copied.
+
+    The valid points are enumerated one parameter at a time, in an order in
+    which each restriction can be checked as soon as all parameters it uses
+    are bound. Partial assignments that fail a restriction are dropped before
+    the remaining parameters are bound, such that most of the Cartesian product
+    is never generated when restrictions couple only a few parameters.
+
+    Restrictions are evaluated on blocks of at most block_size assignments at a
+    time, using NumPy arrays that hold the values of each parameter in the block.
+    Restrictions that cannot be evaluated on arrays are evaluated per point.
+
+    If a cache directory is given, the array of valid indices is stored there
+    as a .npy file, keyed by the parameter values and restrictions. Later runs
+    open this file as a read-only memory map, which allows processes that use
+    the same search space to share its pages.
+    """
+
+    def __init__(self, tune_params, restrictions=None, verbose=False, block_size=2**20, cache_dir=None):
+        """ Create the search space for the given tunable parameters
+
+        :param tune_params: A dictionary with the tunable parameters.
+        :type tune_params: dict( string : [...] )
+
+        :param restrictions: A list of restrictions, as strings or as returned
+            by util.compile_restrictions().
+        :type restrictions: list
+
+        :param verbose: Whether to report configurations that fail the restrictions.
+        :type verbose: bool
+
+        :param block_size: The maximum number of (partial) assignments for which
+            the restrictions are evaluated at once.
+        :type block_size: int
+
+        :param cache_dir: Directory in which constructed search spaces are stored,
+            None by default to not store anything.
+        :type cache_dir: string
+        """
+        self.tune_params = tune_params
+        self.keys = list(tune_params.keys())
+        self.values = [list(v) for v in tune_params.values()]
+        self.radices = [len(v) for v in self.values]
+
+        #stride of each dimension, the last parameter varies fastest
+        self.strides = [1 for _ in self.radices]
+        for i in reversed(range(len(self.radices)-1)):
+            self.strides[i] = self.strides[i+1] * self.radices[i+1]
+        self.size = int(numpy.prod(self.radices, dtype=object))
+
+        self.value_index = [dict((v, i) for i, v in reversed(list(enumerate(values)))) for values in self.values]
+
+        self.restrictions = None
+        self._indices = None
+        self._pending = False
+        self._excluded = None
+        self._neighbor_index = dict()
+        self._kdtree = None
+        if restrictions:
+            self.restrictions = util.compile_restrictions(restrictions, tune_params)
+            self.block_size = block_size
+            self.arrays = [_values_to_array(values) for values in self.values]
+            self.vector_funcs = [_vectorize_restriction(restrict, self.arrays) for restrict in self.restrictions]
+            self._cache_dir = cache_dir
+            self._verbose = verbose
+            self._pending = True
+
+    @property
+    def indices(self):
+        """ int64 array with the indices of the valid points in the Cartesian product, None if all points are valid """
+        if self._pending:
+            self._indices = self._load_or_enumerate_valid(self._cache_dir, self._verbose)
+            self._pending = False
+        return self._indices
+
+    @indices.setter
+    def indices(self, indices):
+        self._indices = indices
+        self._pending = False
+
+    def __len__(self):
+        length = self.size if self.indices is None else len(self.indices)
+        if self._excluded is not None:
+            length -= len(self._excluded)
+        return length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._subset(self._take(numpy.arange(*key.indices(len(self)), dtype=numpy.int64)))
+        key = int(key)
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("search space index out of range")
+        return self.get_config(int(self._take(key)))
+
+    def __iter__(self):
+        if self.indices is None and self._excluded is None:
+            return itertools.product(*self.values)
+        return self._iter_indices(self.indices, self._excluded)
+
+    def __contains__(self, config):
+        try:
+            self.index(config)
+        except ValueError:
+            return False
+        return True
+
+    def get_config(self, flat_index):
+        """ return the configuration at a position in the full Cartesian product
+
+        :param flat_index: Index into the full Cartesian product of the parameters.
+        :type flat_index: int
+
+        :returns: A tuple with the values of the tunable parameters.
+        :rtype: tuple
+        """
+        config = []
+        for values, stride, radix in zip(self.values, self.strides, self.radices):
+            config.append(values[(flat_index // stride) % radix])
+        return tuple(config)
+
+    def get_flat_index(self, config):
+        """ return the position of a configuration in the full Cartesian product
+
+        :param config: The values of the tunable parameters, in the order of tune_params.
+        :type config: iterable
+
+        :returns: Index into the full Cartesian product of the parameters.
+        :rtype: int
+        """
+        config = list(config)
+        if len(config) != len(self.keys):
+            raise ValueError("configuration does not match the number of tunable parameters")
+        flat_index = 0
+        for value, value_index, stride in zip(config, self.value_index, self.strides):
+            try:
+                flat_index += value_index[value] * stride
+            except (KeyError, TypeError):
+                raise ValueError(str(value) + " is not a value of this search space")
+        return flat_index
+
+    def get_indices(self):
+        """ return the indices in the full Cartesian product of all points in this space """
+        indices = self.indices
+        if indices is None:
+            indices = numpy.arange(self.size, dtype=numpy.int64)
+        if self._excluded is not None:
+            indices = numpy.delete(indices, self._excluded)
+        return indices
+
+    def index(self, config):
+        """ return the position of a configuration in this search space
+
+        :param config: The values of the tunable parameters, in the order of tune_params.
+        :type config: iterable
+
+        :returns: The index of config, such that space[index] == config.
+        :rtype: int
+        """
+        position = self._position(self.get_flat_index(config))
+        if position is None:
+            raise ValueError(str(tuple(config)) + " is not in the search space")
+        return position
+
+    def sample(self, num_samples):
+        """ return a random sample of this search space, drawn without replacement
+
+        Only the indices of the sampled points are drawn and stored, the space is
+        never materialized. When only a small fraction of the space is drawn,
+        positions are drawn one at a time until enough distinct positions are
+        found, such that the memory used does not depend on the size of the space.
+
+        :param num_samples: The number of points to draw.
+        :type num_samples: int
+
+        :returns: A search space containing only the sampled points.
+        :rtype: SearchSpace
+        """
+        length = len(self)
+        if num_samples * 4 < length:
+            drawn = set()
+            while len(drawn) < num_samples:
+                drawn.add(random.randrange(length))
+            positions = sorted(drawn)
+        else:
+            positions = sorted(random.sample(range(length), num_samples))
+        return self._subset(self._take(numpy.array(positions, dtype=numpy.int64)))
+
+    def select(self, mask):
+        """ return a search space with only the points of this space for which mask is True
+
+        :param mask: A boolean array with an element for each point in this space.
+        :type mask: numpy.ndarray
+
+        :returns: A search space containing only the selected points.
+        :rtype: SearchSpace
+        """
+        return self._subset(self._take(numpy.flatnonzero(mask)))
+
+    def get_feasibility_mask(self, infeasible):
+        """ return a boolean array that is False for the points of this space that are infeasible
+
+        :param infeasible: Configurations that are known to fail, in the order of
+            tune_params. Configurations that are not in this space are ignored.
+        :type infeasible: iterable
+
+        :returns: An array with an element for each point in this space.
+        :rtype: numpy.ndarray
+        """
+        mask = numpy.ones(len(self), dtype=bool)
+        for config in infeasible:
+            try:
+                mask[self.index(config)] = False
+            except ValueError:
+                continue
+        return mask
+
+    def exclude(self, infeasible):
+        """ return a search space without the configurations in infeasible
+
+        The returned space shares the stored points with this space, implicit
+        or memory mapped, and only stores the positions of the excluded points.
+
+        :param infeasible: Configurations that are known to fail, in the order of tune_params.
+        :type infeasible: iterable
+
+        :returns: A search space containing only the other points.
+        :rtype: SearchSpace
+        """
+        excluded = set()
+        for config in infeasible:
+            try:
+                position = self._find(self.get_flat_index(config))
+            except ValueError:
+                continue
+            if position is not None:
+                excluded.add(position)
+        if self._excluded is not None:
+            excluded.update(self._excluded.tolist())
+
+        space = copy.copy(self)
+        space._neighbor_index = dict()
+        space._kdtree = None
+        if excluded:
+            space._excluded = numpy.array(sorted(excluded), dtype=numpy.int64)
+        return space
+
+    def permutation(self):
+        """ return a search space with the same points in random order """
+        return self._subset(numpy.random.permutation(self.get_indices()))
+
+    def get_neighbor_index(self, kind="adjacent"):
+        """ return the neighbors of all points in this space in compressed sparse row layout
+
+        Adjacent neighbors differ from a point in a single parameter, which takes
+        the previous or next value in its list of values. Hamming neighbors differ
+        in a single parameter, which may take any of its other values. Only points
+        that are part of this space are neighbors. The index is built once, using
+        the indices of the points rather than their values, and then reused.
+
+        The index stores up to two adjacent neighbors for each parameter, or
+        len(values)-1 Hamming neighbors for each parameter, for every point,
+        and uses 8 bytes per neighbor. Building it temporarily needs about three
+        times as much memory. Indices that would store more than
+        max_neighbor_index_size neighbors are not built.
+
+        :param kind: The kind of neighbors, either "adjacent" or "hamming".
+        :type kind: string
+
+        :returns: Two int64 arrays indptr and neighbors. The positions in this space
+            of the neighbors of the point at position i are neighbors[indptr[i]:indptr[i+1]].
+            None if the index would be too large, see get_neighbors().
+        :rtype: numpy.ndarray, numpy.ndarray
+        """
+        if kind not in ("adjacent", "hamming"):
+            raise ValueError("kind should be either 'adjacent' or 'hamming'")
+        if kind not in self._neighbor_index:
+            per_point = sum(min(radix-1, 2) if kind == "adjacent" else radix-1 for radix in self.radices)
+            if len(self) * per_point > max_neighbor_index_size:
+                logging.debug('neighbor index too large, neighbors are computed for each point')
+                self._neighbor_index[kind] = None
+            else:
+                self._neighbor_index[kind] = self._build_neighbor_index(kind == "adjacent")
+        return self._neighbor_index[kind]
+
+    def get_neighbors(self, position, kind="adjacent"):
+        """ return the positions in this space of the neighbors of the point at position
+
+        The neighbors are taken from the neighbor index, or computed for this
+        point only if the index is too large to be built, see get_neighbor_index().
+
+        :param position: The position of a point in this space.
+        :type position: int
+
+        :param kind: The kind of neighbors, either "adjacent" or "hamming".
+        :type kind: string
+
+        :returns: An int64 array with the positions of the neighbors.
+        :rtype: numpy.ndarray
+        """
+        index = self.get_neighbor_index(kind)
+        if index is None:
+            return self._compute_neighbors(position, kind == "adjacent")
+        indptr, neighbors = index
+        return neighbors[indptr[position]:indptr[position+1]]
+
+    def get_nearest(self, coordinates):
+        """ return the position of the point in this space that is nearest to coordinates
+
+        Coordinates are expressed in the index space of the parameters, in which
+        the coordinate of a parameter is the index of its value in the list of
+        values, such that each parameter is scaled to the same unit distance
+        between its values. A KD-tree over the points in this space is built when
+        this method is first called, after which each lookup is sub-linear.
+
+        :param coordinates: A coordinate for each tunable parameter.
+        :type coordinates: list(float)
+
+        :returns: The position in this space of the nearest point.
+        :rtype: int
+        """
+        if len(self) == 0:
+            raise ValueError("search space is empty")
+        if self._kdtree is None:
+            flat = numpy.asarray(self.get_indices(), dtype=numpy.int64)
+            digits = [(flat // stride) % radix for stride, radix in zip(self.strides, self.radices)]
+            self._kdtree = cKDTree(numpy.column_stack(digits).astype(numpy.float64))
+        _, position = self._kdtree.query(numpy.asarray(coordinates, dtype=numpy.float64))
+        return int(position)
+
+    def get_cache_filename(self, cache_dir):
+        """ return the name of the file in cache_dir that stores this search space """
+        key = hashlib.sha256()
+        key.update(repr(list(zip(self.keys, self.values))).encode("utf-8"))
+        key.update(repr([_get_restriction_key(restrict) for restrict in self.restrictions or []]).encode("utf-8"))
+        return os.path.join(cache_dir, "searchspace_" + key.hexdigest() + ".npy")
+
+    def _load_or_enumerate_valid(self, cache_dir, verbose):
+        """ load the valid indices from the cache, enumerate and store them on a miss """
+        if cache_dir is None:
+            return self._enumerate_valid(verbose)
+        #functions can not be used as key, spaces with user restriction functions are not cached
+        if any(_get_restriction_key(r) is None for r in self.restrictions):
+            logging.info('search space is not stored in cache_dir, it has restriction functions')
+            return self._enumerate_valid(verbose)
+        filename = self.get_cache_filename(cache_dir)
+        try:
+            indices = numpy.load(filename, mmap_mode="r")
+            logging.debug('loaded search space from ' + filename)
+            return indices
+        except (IOError, OSError, ValueError):
+            pass
+
+        indices = self._enumerate_valid(verbose)
+
+        #write to a temporary file first, such that other processes never see a partial file
+        util.create_directory(cache_dir)
+        fd, temp_filename = tempfile.mkstemp(suffix=".npy", prefix="temp_", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.save(f, indices)
+            util.replace_file(temp_filename, filename)
+        finally:
+            util.delete_temp_file(temp_filename)
+        logging.debug('stored search space in ' + filename)
+        return numpy.load(filename, mmap_mode="r")
+
+    def _enumerate_valid(self, verbose):
+        """ return the indices of all points in the product that meet the restrictions """
+        order, checks = self._get_enumeration_order()
+
+        #restrictions that do not use any parameters either allow or forbid everything
+        for restrict in self.restrictions:
+            if not restrict.params and not restrict.func():
+                return numpy.zeros(0, dtype=numpy.int64)
+
+        #columns are only kept for as long as a restriction at a later level uses them,
+        #or to report the partial assignments that are dropped in verbose mode
+        needed = [set() for _ in order]
+        for level in reversed(range(len(order)-1)):
+            needed[level] = needed[level+1] | set(i for restrict, _ in checks[level+1] for i in restrict.indices)
+        if verbose:
+            needed = [set(order) for _ in order]
+
+        valid = list(self._expand(numpy.zeros(1, dtype=numpy.int64), {}, 0, order, checks, needed, verbose))
+        if not valid:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.sort(numpy.concatenate(valid))
+
+    def _get_enumeration_order(self):
+        """ order the parameters such that restrictions can be checked as early as possible
+
+        Returns the order in which the parameters are bound and, for each level
+        in that order, the restrictions whose parameters are all bound at that level.
+        Parameters that are not used in any restriction are bound last.
+        """
+        pending = [restrict for restrict in self.restrictions if restrict.params]
+        unbound = [i for i in range(len(self.keys)) if any(i in restrict.indices for restrict in pending)]
+        bound = set()
+        order = []
+        while unbound:
+            def score(i):
+                completes = sum(1 for restrict in pending if i in restrict.indices and set(restrict.indices) <= bound | set([i]))
+                involved = sum(1 for restrict in pending if i in restrict.indices)
+                return (completes, involved, -self.radices[i], -i)
+            best = max(unbound, key=score)
+            unbound.remove(best)
+            bound.add(best)
+            order.append(best)
+        order += [i for i in range(len(self.keys)) if i not in bound]
+
+        level_of = dict((dim, level) for level, dim in enumerate(order))
+        checks = [[] for _ in order]
+        for restrict, vector_func in zip(self.restrictions, self.vector_funcs):
+            if restrict.params:
+                checks[max(level_of[i] for i in restrict.indices)].append((restrict, vector_func))
+        return order, checks
+
+    def _expand(self, offsets, columns, level, order, checks, needed, verbose):
+        """ bind the parameter at level for all partial assignments, yield indices of full assignments
+
+        Partial assignments are represented by their offset into the Cartesian
+        product and the value indices of the bound parameters that later
+        restrictions use. Partial assignments that fail a restriction are
+        dropped, together with all points of the product they would lead to.
+        """
+        if level == len(order):
+            yield offsets
+            return
+        dim = order[level]
+        radix = self.radices[dim]
+        values = numpy.arange(radix, dtype=numpy.int64)
+
+        #expand at most block_size points at a time
+        rows_per_block = max(1, self.block_size // radix)
+        for start in range(0, len(offsets), rows_per_block):
+            rows = offsets[start:start+rows_per_block]
+            new_offsets = (rows[:, None] + values[None, :] * self.strides[dim]).ravel()
+            new_columns = dict((i, numpy.repeat(column[start:start+rows_per_block], radix)) for i, column in columns.items())
+            new_columns[dim] = numpy.tile(values, len(rows))
+
+            for restrict, vector_func in checks[level]:
+                mask = self._evaluate(restrict, vector_func, [new_columns[i] for i in restrict.indices], new_offsets.size)
+                if verbose:
+                    self._report_pruned(order[:level+1], new_columns, ~mask)
+                new_offsets = new_offsets[mask]
+                new_columns = dict((i, column[mask]) for i, column in new_columns.items())
+                if new_offsets.size == 0:
+                    break
+
+            if new_offsets.size > 0:
+                new_columns = dict((i, column) for i, column in new_columns.items() if i in needed[level])
+                for valid in self._expand(new_offsets, new_columns, level+1, order, checks, needed, verbose):
+                    yield valid
+
+    def _report_pruned(self, bound, columns, failed):
+        """ print the partial assignments that fail a restriction """
+        for row in numpy.flatnonzero(failed):
+            params = OrderedDict((self.keys[i], self.values[i][columns[i][row]]) for i in sorted(bound))
+            print("skipping configs with", util.get_config_string(params), "reason: config fails restriction")
+
+    def _evaluate(self, restrict, vector_func, value_indices, size):
+        """ evaluate a restriction on columns of value indices, return a boolean mask """
+        if vector_func is not None:
+            try:
+                columns = dict((k, self.arrays[i][col]) for k, i, col in zip(restrict.params, restrict.indices, value_indices))
+                with numpy.errstate(all="ignore"):
+                    mask = numpy.asarray(vector_func(columns))
+                #a scalar result from array arguments means the expression was not evaluated element-wise
+                if mask.shape == () and not restrict.params:
+                    return numpy.full(size, bool(mask))
+                if mask.shape == (size,):
+                    return mask.astype(bool)
+            except Exception:
+                pass
+        #expression could not be evaluated on arrays, fall back to evaluating it per point
+        if not restrict.params:
+            return numpy.full(size, bool(restrict.func()))
+        columns = [[self.values[i][j] for j in col.tolist()] for i, col in zip(restrict.indices, value_indices)]
+        return numpy.fromiter((bool(restrict.func(*args)) for args in zip(*columns)), dtype=bool, count=size)
+
+    def _compute_neighbors(self, position, adjacent):
+        """ return the sorted positions of the neighbors of a single point, see get_neighbor_index() """
+        flat = int(self._take(numpy.array([position], dtype=numpy.int64))[0])
+        neighbors = []
+        for stride, radix in zip(self.strides, self.radices):
+            digit = (flat // stride) % radix
+            for other in ([digit-1, digit+1] if adjacent else range(radix)):
+                if other == digit or other < 0 or other >= radix:
+                    continue
+                neighbor = self._position(flat + (other - digit) * stride)
+                if neighbor is not None:
+                    neighbors.append(neighbor)
+        return numpy.array(sorted(neighbors), dtype=numpy.int64)
+
+    def _position(self, flat_index):
+        """ return the position in this space of the point at flat_index, None if it is not in this space """
+        position = self._find(flat_index)
+        if position is not None and self._excluded is not None:
+            excluded = int(numpy.searchsorted(self._excluded, position))
+            if excluded < len(self._excluded) and self._excluded[excluded] == position:
+                return None
+            position -= excluded
+        return position
+
+    def _build_neighbor_index(self, adjacent):
+        """ build the neighbor index, see get_neighbor_index() """
+        flat = numpy.asarray(self.get_indices(), dtype=numpy.int64)
+        positions = numpy.arange(flat.size, dtype=numpy.int64)
+        restricted = self.indices is not None or self._excluded is not None
+        if restricted:
+            order = positions if self._sorted else numpy.argsort(flat, kind="mergesort")
+            sorted_flat = flat[order]
+
+        rows = []
+        cols = []
+        for stride, radix in zip(self.strides, self.radices):
+            digits = (flat // stride) % radix
+            for shift in ([-1, 1] if adjacent else range(1, radix)):
+                if adjacent:
+                    new_digits = digits + shift
+                    in_range = (new_digits >= 0) & (new_digits < radix)
+                else:
+                    new_digits = (digits + shift) % radix
+                    in_range = numpy.ones(flat.size, dtype=bool)
+                targets = flat[in_range] + (new_digits[in_range] - digits[in_range]) * stride
+                sources = positions[in_range]
+
+                #look up the positions of the neighbors, dropping those that are not in this space
+                if restricted:
+                    found = numpy.minimum(numpy.searchsorted(sorted_flat, targets), max(sorted_flat.size-1, 0))
+                    valid = sorted_flat[found] == targets if sorted_flat.size else numpy.zeros(targets.size, dtype=bool)
+                    sources = sources[valid]
+                    targets = order[found[valid]]
+                rows.append(sources)
+                cols.append(targets)
+
+        rows = numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=numpy.int64)
+        cols = numpy.concatenate(cols) if cols else numpy.zeros(0, dtype=numpy.int64)
+        order = numpy.lexsort((cols, rows))
+        indptr = numpy.zeros(flat.size+1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows, minlength=flat.size), out=indptr[1:])
+        return indptr, cols[order].astype(numpy.int64)
+
+    def _iter_indices(self, indices, excluded=None, block_size=4096):
+        """ iterate over configurations at indices in the full product, decoding blocks at a time
+
+        If indices is None all points of the product are used, positions in excluded are skipped.
+        """
+        length = self.size if indices is None else len(indices)
+        for start in range(0, length, block_size):
+            stop = min(start+block_size, length)
+            if indices is None:
+                block = numpy.arange(start, stop, dtype=numpy.int64)
+            else:
+                block = numpy.asarray(indices[start:stop], dtype=numpy.int64)
+            if excluded is not None:
+                first, last = numpy.searchsorted(excluded, [start, stop])
+                block = numpy.delete(block, excluded[first:last] - start)
+            columns = [(block // stride) % radix for stride, radix in zip(self.strides, self.radices)]
+            for row in zip(*columns):
+                yield tuple(values[i] for values, i in zip(self.values, row))
+
+    def _take(self, positions):
+        """ return the indices in the full product of the points at positions in this space """
+        #skip the excluded points, the number of excluded points before the k-th one is k
+        if self._excluded is not None:
+            shifted = self._excluded - numpy.arange(len(self._excluded), dtype=numpy.int64)
+            positions = positions + numpy.searchsorted(shifted, positions, side="right")
+        if self.indices is None:
+            return positions
+        return self.indices[positions]
+
+    def _find(self, flat_index):
+        """ return the position among the stored points of the point at flat_index, None if it is not stored """
+        if self.indices is None:
+            return flat_index
+        if self._sorted:
+            pos = int(numpy.searchsorted(self.indices, flat_index))
+            if pos < len(self.indices) and self.indices[pos] == flat_index:
+                return pos
+        else:
+            pos = numpy.flatnonzero(self.indices == flat_index)
+            if pos.size > 0:
+                return int(pos[0])
+        return None
+
+    def _subset(self, indices):
+        """ return a search space that shares the parameters, but holds only indices """
+        space = copy.copy(self)
+        space._neighbor_index = dict()
+        space._kdtree = None
+        space._excluded = None
+        space.indices = numpy.asarray(indices, dtype=numpy.int64)
+        space._sorted = bool(numpy.all(space.indices[1:] >= space.indices[:-1]))
+        return space
+
+    _sorted = True
+
+
+def _get_restriction_key(restrict):
+    """ return the string that identifies a restriction in the cache, None for functions without a key """
+    if isinstance(restrict.expression, util.RestrictionFunction):
+        return restrict.expression.key
+    return restrict.expression
+
+
+def _values_to_array(values):
+    """ return the values of a parameter as a 1D NumPy array for vectorized evaluation """
+    array = numpy.array(values)
+    if array.ndim != 1 or not (array.dtype.kind in "biuf" or all(isinstance(v, str) for v in values)):
+        array = numpy.empty(len(values), dtype=object)
+        for i, v in enumerate(values):
+            array[i] = v
+    return array
+
+
+class _VectorizeTransformer(ast.NodeTransformer):
+    """ rewrite boolean operators, chained comparisons and conditional expressions to NumPy calls """
+
+    @staticmethod
+    def _numpy_call(name, args):
+        func = ast.Attribute(value=ast.Name(id="numpy", ctx=ast.Load()), attr=name, ctx=ast.Load())
+        return ast.Call(func=func, args=args, keywords=[])
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        name = "logical_and" if isinstance(node.op, ast.And) else "logical_or"
+        result = node.values[0]
+        for value in node.values[1:]:
+            result = self._numpy_call(name, [result, value])
+        return result
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return self._numpy_call("logical_not", [node.operand])
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        left = node.left
+        result = None
+        for op, right in zip(node.ops, node.comparators):
+            compare = ast.Compare(left=left, ops=[op], comparators=[right])
+            result = compare if result is None else self._numpy_call("logical_and", [result, compare])
+            left = right
+        return result
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return self._numpy_call("where", [node.test, node.body, node.orelse])
+
+
+#largest magnitude up to which int64 and float64 arithmetic match the arithmetic of Python ints
+_EXACT_LIMIT = 2**53
+
+_CONSTANTS = tuple(getattr(ast, name) for name in ("Constant", "Num", "Str", "NameConstant") if hasattr(ast, name))
+
+
+def _magnitude_bound(node, bounds):
+    """ return an upper bound on the magnitude of all subexpressions of node, None if there is none
+
+    bounds maps parameter names to the largest magnitude of their values.
+    """
+    def walk(node):
+        if isinstance(node, ast.Expression):
+            return walk(node.body)
+        if isinstance(node, ast.Name):
+            return 1 if node.id in ("True", "False", "None") else bounds.get(node.id)
+        if isinstance(node, _CONSTANTS):
+            value = getattr(node, "value", getattr(node, "n", None))
+            return abs(value) if isinstance(value, (int, float)) else 0
+        if isinstance(node, ast.UnaryOp):
+            return walk(node.operand)
+        if isinstance(node, ast.BinOp):
+            left, right = walk(node.left), walk(node.right)
+            if left is None or right is None:
+                return None
+            if isinstance(node.op, (ast.Add, ast.Sub, ast.BitOr, ast.BitXor)):
+                return left + right
+            if isinstance(node.op, ast.Mult):
+                return left * right
+            if isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod, ast.RShift, ast.BitAnd)):
+                return max(left, right)
+            if isinstance(node.op, (ast.Pow, ast.LShift)):
+                base = 2 if isinstance(node.op, ast.LShift) else left
+                if base <= 1:
+                    return max(left, right, 1)
+                if right * math.log(base, 2) >= 64:
+                    return None
+                return max(left * base ** right if isinstance(node.op, ast.LShift) else base ** right, right)
+            return None
+        if isinstance(node, (ast.BoolOp, ast.Compare, ast.IfExp)):
+            children = list(ast.iter_child_nodes(node))
+            children = [c for c in children if not isinstance(c, (ast.boolop, ast.cmpop))]
+            values = [walk(c) for c in children]
+            return None if None in values else max(values)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ("abs", "min", "max", "int", "float", "round") \
+                and not node.keywords and node.args:
+            values = [walk(arg) for arg in node.args]
+            return None if None in values else max(values)
+        return None
+    return walk(node)
+
+
+def _vectorize_restriction(restrict, arrays):
+    """ return a function that evaluates a restriction on a dict of NumPy arrays
+
+    Batch restriction functions are used as is, restriction strings are
+    rewritten to NumPy calls. Returns None if the restriction cannot be
+    evaluated on arrays, in which case it is evaluated per point.
+
+    Integer arrays wrap around silently on overflow, where Python ints do not.
+    If the values of a restriction string may grow beyond the range in which
+    int64 and float64 arithmetic is exact, the integer arrays are evaluated as
+    arrays of Python ints instead.
+    """
+    if isinstance(restrict.expression, util.RestrictionFunction):
+        return restrict.expression.func if restrict.expression.batch else None
+    try:
+        tree = ast.parse("(" + restrict.expression + "\n)", mode="eval")
+        bounds = dict((k, _max_magnitude(arrays[i])) for k, i in zip(restrict.params, restrict.indices))
+        bound = _magnitude_bound(tree, bounds)
+        tree = ast.fix_missing_locations(_VectorizeTransformer().visit(tree))
+        code = compile(tree, "<restriction>", "eval")
+    except Exception:
+        return None
+    if bound is None or bound >= _EXACT_LIMIT:
+        def exact(columns):
+            columns = dict((k, v.astype(object) if v.dtype.kind in "biuf" else v) for k, v in columns.items())
+            return eval(code, vars(util), columns)
+        return exact
+    return lambda columns: eval(code, vars(util), columns)
+
+
+def _max_magnitude(array):
+    """ return the largest magnitude of the values in an array, 0 for arrays that are not numeric """
+    if array.dtype.kind not in "biuf" or array.size == 0:
+        return 0
+    return abs(array.astype(object)).max()
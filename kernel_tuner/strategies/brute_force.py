@@ -1,10 +1,6 @@
 """ The default strategy that iterates through the whole parameter space """
 from __future__ import print_function
 
-import itertools
-
-from kernel_tuner import util
-
 def tune(runner, kernel_options, device_options, tuning_options):
     """ Tune all instances in the parameter space
 
@@ -29,16 +25,8 @@ def tune(runner, kernel_options, device_options, tuning_options):
 
     """
 
-    tune_params = tuning_options.tune_params
-    restrictions = tuning_options.restrictions
-    verbose = tuning_options.verbose
-
-    #compute cartesian product of all tunable parameters
-    parameter_space = itertools.product(*tune_params.values())
-
-    #check for search space restrictions
-    if restrictions is not None:
-        parameter_space = filter(lambda p: util.check_restrictions(restrictions, p, tune_params.keys(), verbose), parameter_space)
+    #the search space of all configurations that meet the restrictions
+    parameter_space = tuning_options.searchspace
 
     results, env = runner.run(parameter_space, kernel_options, tuning_options)
 
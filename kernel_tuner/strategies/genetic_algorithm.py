@@ -34,9 +34,13 @@ def tune(runner, kernel_options, device_options, tuning_options):
     generations = 100
     tuning_options["scaling"] = False
 
-    tune_params = tuning_options.tune_params
+    param_values = list(tuning_options.tune_params.values())
 
-    population = random_population(dna_size, pop_size, tune_params)
+    #no configuration meets the restrictions, there is nothing to evolve
+    if len(tuning_options.searchspace) == 0:
+        return [], runner.dev.get_environment()
+
+    population = random_population(pop_size, tuning_options.searchspace)
 
     best_time = 1e20
     all_results = []
@@ -67,8 +71,8 @@ def tune(runner, kernel_options, device_options, tuning_options):
 
             ind1, ind2 = crossover(ind1, ind2)
 
-            population.append(mutate(ind1, dna_size, tune_params))
-            population.append(mutate(ind2, dna_size, tune_params))
+            population.append(mutate(ind1, dna_size, param_values))
+            population.append(mutate(ind2, dna_size, param_values))
 
     return all_results, runner.dev.get_environment()
 
@@ -82,28 +86,21 @@ def weighted_choice(population):
     ind = min(max(ind, 0), len(population)-1)
     return population[ind][0]
 
-def random_population(dna_size, pop_size, tune_params):
-    """create a random population"""
+def random_population(pop_size, searchspace):
+    """create a random population of configurations that meet the restrictions"""
     population = []
     for _ in range(pop_size):
-        dna = []
-        for i in range(dna_size):
-            dna.append(random_val(i, tune_params))
+        dna = list(searchspace[random.randrange(len(searchspace))])
         population.append(dna)
     return population
 
-def random_val(index, tune_params):
-    """return a random value for a parameter"""
-    key = list(tune_params.keys())[index]
-    return random.choice(tune_params[key])
-
-def mutate(dna, dna_size, tune_params):
+def mutate(dna, dna_size, param_values):
     """Mutate DNA with 1/mutation_chance chance"""
     dna_out = []
     mutation_chance = 10
     for i in range(dna_size):
         if int(random.random()*mutation_chance) == 1:
-            dna_out.append(random_val(i, tune_params))
+            dna_out.append(random.choice(param_values[i]))
         else:
             dna_out.append(dna[i])
     return dna_out
@@ -74,6 +74,19 @@ def _cost_func(x, kernel_options, tuning_options, runner, results, cache):
     else:
         params = snap_to_nearest_config(x, tuning_options.tune_params)
 
+    #inactive conditional parameters do not change the kernel, evaluate the canonical configuration
+    if tuning_options.get("conditions"):
+        params = util.apply_conditions(tuning_options.conditions, params)
+
+    #move configurations that fail the restrictions, or failed in earlier runs, to the nearest configuration that does not
+    searchspace = tuning_options.get("searchspace")
+    if searchspace is not None and 0 < len(searchspace) < searchspace.size and params not in searchspace:
+        if tuning_options.scaling:
+            coordinates = [xi/tuning_options.eps - 0.5 for xi in x]
+        else:
+            coordinates = [numpy.abs(numpy.array(values)-xi).argmin() for values, xi in zip(searchspace.values, x)]
+        params = list(searchspace[searchspace.get_nearest(coordinates)])
+
     logging.debug('params ' + str(params))
 
     x_int = ",".join([str(i) for i in params])
@@ -1,11 +1,8 @@
 """ Iterate over a random sample of the parameter space """
 from __future__ import print_function
 
-import itertools
 import numpy
 
-from kernel_tuner import util
-
 def tune(runner, kernel_options, device_options, tuning_options):
     """ Tune a random sample of sample_fraction fraction in the parameter space
 
@@ -30,24 +27,12 @@ def tune(runner, kernel_options, device_options, tuning_options):
 
     """
 
-    tune_params = tuning_options.tune_params
-
-    #compute cartesian product of all tunable parameters
-    parameter_space = itertools.product(*tune_params.values())
-
-    #check for search space restrictions
-    if tuning_options.restrictions is not None:
-        parameter_space = filter(lambda p: util.check_restrictions(tuning_options.restrictions, p,
-                                                                   tune_params.keys(),
-                                                                   tuning_options.verbose),
-                                 parameter_space)
+    #the search space of all configurations that meet the restrictions
+    parameter_space = tuning_options.searchspace
 
     #reduce parameter space to a random sample using sample_fraction
-    parameter_space = numpy.array(list(parameter_space))
-    size = len(parameter_space)
-    fraction = int(numpy.ceil(size * float(tuning_options.sample_fraction)))
-    sample_indices = numpy.random.choice(range(size), size=fraction, replace=False)
-    parameter_space = parameter_space[sample_indices]
+    fraction = int(numpy.ceil(len(parameter_space) * float(tuning_options.sample_fraction)))
+    parameter_space = parameter_space.sample(fraction)
 
     #call the runner
     results, env = runner.run(parameter_space, kernel_options, tuning_options)
@@ -5,7 +5,6 @@ import random
 import numpy as np
 
 from kernel_tuner.strategies.minimize import _cost_func
-from kernel_tuner.strategies.genetic_algorithm import random_val
 
 def tune(runner, kernel_options, device_options, tuning_options):
     """ Find the best performing kernel configuration in the parameter space
@@ -37,7 +36,6 @@ def tune(runner, kernel_options, device_options, tuning_options):
     # SA works with real parameter values and does not need scaling
     tuning_options["scaling"] = False
     args = (kernel_options, tuning_options, runner, results, cache)
-    tune_params = tuning_options.tune_params
 
     # optimization parameters
     T = 1.0
@@ -45,10 +43,15 @@ def tune(runner, kernel_options, device_options, tuning_options):
     alpha = 0.9
     niter = 20
 
-    # generate random starting point and evaluate cost
-    pos = []
-    for i, _ in enumerate(tune_params.keys()):
-        pos.append(random_val(i, tune_params))
+    # neighbors are looked up by their position in the search space, such that
+    # only configurations that meet the restrictions are considered
+    searchspace = tuning_options.searchspace
+    if len(searchspace) == 0:
+        return results, runner.dev.get_environment()
+
+    # generate random starting point that meets the restrictions and evaluate cost
+    index = random.randrange(len(searchspace))
+    pos = list(searchspace[index])
     old_cost = _cost_func(pos, *args)
 
     if tuning_options.verbose:
@@ -61,7 +64,8 @@ def tune(runner, kernel_options, device_options, tuning_options):
 
         for i in range(niter):
 
-            new_pos = neighbor(pos, tune_params)
+            new_index = neighbor(index, searchspace)
+            new_pos = list(searchspace[new_index])
             new_cost = _cost_func(new_pos, *args)
 
             ap = acceptance_prob(old_cost, new_cost, T)
@@ -70,6 +74,7 @@ def tune(runner, kernel_options, device_options, tuning_options):
             if ap > r:
                 if tuning_options.verbose:
                     print("new position accepted", new_pos, new_cost, 'old:', pos, old_cost, 'ap', ap, 'r', r, 'T', T)
+                index = new_index
                 pos = new_pos
                 old_cost = new_cost
 
@@ -92,26 +97,14 @@ def acceptance_prob(old_cost, new_cost, T):
     return np.exp(((old_cost-new_cost)/old_cost)/T)
 
 
-def neighbor(pos, tune_params):
-    """return a random neighbor of pos"""
-    size = len(pos)
-    pos_out = []
-    # random mutation
-    # expected value is set that values all dimensions attempt to get mutated
-    for i in range(size):
-        key = list(tune_params.keys())[i]
-        values = tune_params[key]
-
-        if random.random() < 0.2:  #replace with random value
-            new_value = random_val(i, tune_params)
-        else: #adjacent value
-            ind = values.index(pos[i])
-            if random.random() > 0.5:
-                ind += 1
-            else:
-                ind -= 1
-            ind = min(max(ind, 0), len(values)-1)
-            new_value = values[ind]
-
-        pos_out.append(new_value)
-    return pos_out
+def neighbor(index, searchspace):
+    """return the position of a random neighbor of the configuration at index"""
+    # replace a random parameter with a random value, or move it to an adjacent value,
+    # the search space only builds the index of hamming neighbors when it is first needed
+    kind = "hamming" if random.random() < 0.2 else "adjacent"
+    neighbors = searchspace.get_neighbors(index, kind)
+    if len(neighbors) == 0 and kind == "adjacent":
+        neighbors = searchspace.get_neighbors(index, "hamming")
+    if len(neighbors) == 0:
+        return index
+    return int(neighbors[random.randrange(len(neighbors))])
@@ -0,0 +1,299 @@
+""" Module for the command line conventions of the compilers that build C, C++, CUDA, and Fortran kernels """
+from __future__ import print_function
+
+from collections import OrderedDict
+import errno
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+import threading
+import warnings
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+from kernel_tuner.cache import FileCache, get_key
+
+fortran_compilers = ["gfortran", "pgfortran", "ftn", "ifort"]
+
+#toolchains are shared by all kernels in a process, such that capabilities are only probed once
+_toolchains = dict()
+_toolchains_lock = threading.Lock()
+
+#compiler versions, keyed by the path, modification time, and size of the compiler
+_versions = dict()
+
+
+def split_options(options):
+    """ return a list of compiler options from a string of options separated by spaces, or a list of such strings
+
+    :param options: The compiler options, None or an empty string for no options.
+    :type options: string or list(string)
+
+    :returns: The separate compiler options.
+    :rtype: list(string)
+    """
+    if not options:
+        return []
+    if isinstance(options, str):
+        return shlex.split(options)
+    return [o for option in options for o in split_options(option)]
+
+
+def get_compiler(compiler, kernel_string, nvcc_available=None):
+    """ return the compiler that builds kernel_string, which is nvcc rather than g++ for kernels that use CUDA
+
+    :param compiler: The compiler command, may be overruled if it is "g++".
+    :type compiler: string
+
+    :param kernel_string: The source code of the kernel.
+    :type kernel_string: string
+
+    :param nvcc_available: Whether nvcc is installed, by default nvcc is looked up on the PATH.
+    :type nvcc_available: bool
+
+    :returns: The compiler command.
+    :rtype: string
+    """
+    if compiler == "g++" and ("#include <cuda" in kernel_string or "__global__" in kernel_string):
+        if nvcc_available is None:
+            nvcc_available = which("nvcc") is not None
+        if nvcc_available:
+            return "nvcc"
+    return compiler
+
+
+def get_toolchain(compiler):
+    """ return the toolchain for a compiler command, based on the name of the compiler
+
+    :param compiler: The compiler command, such as "g++", "clang++", "nvcc", or "gfortran".
+    :type compiler: string
+
+    :returns: The toolchain, the same object for each call with the same compiler.
+    :rtype: Toolchain
+    """
+    with _toolchains_lock:
+        toolchain = _toolchains.get(compiler)
+        if toolchain is None:
+            name = os.path.basename(compiler)
+            if name in fortran_compilers or "fortran" in name:
+                toolchain = FortranToolchain(compiler)
+            elif name.startswith("nvcc"):
+                toolchain = NVCCToolchain(compiler)
+            elif "clang" in name:
+                toolchain = ClangToolchain(compiler)
+            else:
+                toolchain = GNUToolchain(compiler)
+            _toolchains[compiler] = toolchain
+        return toolchain
+
+
+class Toolchain(object):
+    """Command line conventions of a compiler that builds kernels into shared libraries
+
+    Subclasses describe the source file suffix, the options for position
+    independent code and OpenMP, how kernels are made callable from C, and the
+    name of the compiled function. Whether the compiler accepts an option is
+    probed by compiling an empty source file, the first time it is asked for.
+    """
+
+    suffix = ".cc"
+    probe_language = "c++"
+    probe_options = ["-Werror"]
+    precompiled_header_extension = None
+    #the line of the output of --version that ends with the version
+    version_line = 0
+
+    def __init__(self, compiler):
+        """ Create the toolchain for a compiler
+
+        :param compiler: The compiler command.
+        :type compiler: string
+        """
+        self.compiler = compiler
+        self.name = os.path.basename(compiler)
+        self.supported = dict()
+        self.lock = threading.Lock()
+
+    def get_version(self, cache_dir=None):
+        """ return the version of the compiler, running the compiler only once for each version
+
+        The version is stored under the path, modification time, and size of the
+        compiler executable, such that an update of the compiler is noticed.
+
+        :param cache_dir: Directory in which versions are stored for reuse by
+            other processes, None by default to only reuse versions within this process.
+        :type cache_dir: string
+
+        :returns: The version, the last word of the output of --version.
+        :rtype: string
+        """
+        path = which(self.compiler)
+        if path is None:
+            raise OSError(errno.ENOENT, "Compiler not found", self.compiler)
+        stat = os.stat(path)
+        key = (os.path.realpath(path), getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_size)
+        version = _versions.get(key)
+        if version is not None:
+            return version
+
+        cache = None
+        if cache_dir:
+            cache = FileCache(os.path.join(cache_dir, "toolchain"))
+            filename = cache.lookup(get_key(*key), ".json")
+            if filename:
+                try:
+                    with open(filename, "r") as f:
+                        version = json.load(f)["version"]
+                except (IOError, ValueError, KeyError):
+                    version = None
+
+        if version is None:
+            output = subprocess.check_output([path, "--version"]).decode("utf-8", "replace")
+            lines = [line.strip() for line in output.splitlines() if line.strip()]
+            version = lines[self.version_line].split(" ")[-1] if lines else ""
+            logging.debug('compiler ' + path + ' has version ' + version)
+            if cache is not None:
+                cache.write(get_key(*key), json.dumps({"compiler": key[0], "version": version}).encode("utf-8"), ".json")
+        _versions[key] = version
+        return version
+
+    def get_compiler_options(self, using_openmp):
+        """ return the options that are needed to build a kernel into a shared library """
+        options = ["-fPIC"]
+        if using_openmp:
+            options.append("-fopenmp")
+        return options
+
+    def prepare_source(self, kernel_string):
+        """ return the source code that is compiled for the kernel """
+        return kernel_string
+
+    def get_function_name(self, kernel_name, kernel_string):
+        """ return the name of the compiled function for kernel_name """
+        return kernel_name
+
+    def supports(self, options):
+        """ return whether the compiler accepts options, probing the compiler once for each set of options
+
+        :param options: The compiler options, as a list or a string separated by spaces.
+        :type options: string or list(string)
+
+        :returns: True if an empty source file compiles with these options without warnings.
+        :rtype: bool
+        """
+        options = tuple(split_options(options))
+        if not options:
+            return True
+        with self.lock:
+            if options not in self.supported:
+                self.supported[options] = self.probe(list(options))
+            return self.supported[options]
+
+    def probe(self, options):
+        """ compile an empty source file read from stdin with options, return True on success """
+        command = [self.compiler, "-x", self.probe_language] + self.probe_options + options + ["-c", "-", "-o", os.devnull]
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            process.communicate(b"")
+        except OSError:
+            return False
+        logging.debug('compiler ' + self.compiler + (' supports ' if process.returncode == 0 else ' does not support ') + " ".join(options))
+        return process.returncode == 0
+
+
+class GNUToolchain(Toolchain):
+    """The GNU C++ compiler, and compatible compilers"""
+
+    precompiled_header_extension = ".gch"
+
+    def prepare_source(self, kernel_string):
+        if not "extern \"C\"" in kernel_string:
+            kernel_string = "extern \"C\" {\n" + kernel_string + "\n}"
+        return kernel_string
+
+
+class ClangToolchain(GNUToolchain):
+    """The Clang C++ compiler, which looks for precompiled headers with the extension .pch"""
+
+    precompiled_header_extension = ".pch"
+
+
+class NVCCToolchain(GNUToolchain):
+    """The CUDA compiler, which passes options for host code on to the host compiler"""
+
+    suffix = ".cu"
+    probe_language = "cu"
+    #nvcc has no option to turn warnings into errors that also covers the host compiler
+    probe_options = []
+    precompiled_header_extension = None
+    version_line = -1
+
+    def get_compiler_options(self, using_openmp):
+        return ["-Xcompiler=" + c for c in super(NVCCToolchain, self).get_compiler_options(using_openmp)]
+
+
+class FortranToolchain(Toolchain):
+    """Fortran compilers, which decorate the names of functions in modules"""
+
+    suffix = ".F90"
+    probe_language = "f95"
+
+    def get_compiler_options(self, using_openmp):
+        options = ["-fPIC"]
+        if using_openmp:
+            if self.name == "pgfortran":
+                options.append("-mp")
+            else:
+                options.append("-fopenmp")
+        return options
+
+    def get_function_name(self, kernel_name, kernel_string):
+        match = re.search(r"\s*module\s+([a-zA-Z_]*)", kernel_string)
+        if match:
+            if self.name == "gfortran":
+                return "__" + match.group(1) + "_MOD_" + kernel_name
+            if self.name in ["ftn", "ifort"]:
+                return match.group(1) + "_mp_" + kernel_name + "_"
+            if self.name == "pgfortran":
+                return match.group(1) + "_" + kernel_name + "_"
+        return kernel_name
+
+
+def get_supported_params(tune_params, compiler_option_params, compiler):
+    """ return the tunable parameters without the compiler options that the compiler does not accept
+
+    :param tune_params: A dictionary with the tunable parameters.
+    :type tune_params: dict(string: list)
+
+    :param compiler_option_params: The names of the tunable parameters whose
+        values are compiler options.
+    :type compiler_option_params: list(string)
+
+    :param compiler: The compiler command.
+    :type compiler: string
+
+    :returns: The tunable parameters, in the same order.
+    :rtype: OrderedDict
+    """
+    for name in compiler_option_params:
+        if name not in tune_params:
+            raise ValueError("Compiler option parameter " + name + " is not specified in the tunable parameters list!")
+    toolchain = get_toolchain(compiler)
+    supported = OrderedDict()
+    for name, values in tune_params.items():
+        if name not in compiler_option_params:
+            supported[name] = values
+            continue
+        supported[name] = [v for v in values if toolchain.supports(v)]
+        for v in values:
+            if v not in supported[name]:
+                warnings.warn("Compiler " + compiler + " does not support option " + str(v) + " of tunable parameter " + name, UserWarning)
+        if not supported[name]:
+            raise ValueError("Compiler " + compiler + " supports none of the values of tunable parameter " + name)
+    return supported
@@ -1,17 +1,39 @@
 """ Module for kernel tuner utility functions """
 from __future__ import print_function
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+import ast
+import atexit
+import hashlib
 import os
 import errno
 import tempfile
+import threading
 import logging
 import warnings
+import weakref
 import re
 import numpy
 
 default_block_size_names = ["block_size_x", "block_size_y", "block_size_z"]
 
+Restriction = namedtuple("Restriction", ["expression", "params", "indices", "func"])
+RestrictionFunction = namedtuple("RestrictionFunction", ["func", "params", "batch", "key"])
+Condition = namedtuple("Condition", ["param", "index", "default", "active"])
+
+#compiled problem size and grid divisor expressions, and memoized thread block and grid dimensions
+_compiled_expressions = dict()
+_block_and_grid_cache = dict()
+_block_and_grid_cache_size = 2**16
+_missing = object()
+
+#source files that have been read, the maximum number of stored kernel strings for
+#each code generator, and the number of kernel instances that use each instance file
+_source_files = dict()
+_generated_sources_size = 2**12
+_instance_files = dict()
+_instance_files_lock = threading.Lock()
+
 
 def check_argument_type(dtype, kernel_argument, i):
     """check if the numpy.dtype matches the type used in the code"""
@@ -103,16 +125,286 @@ def check_block_size_params_names_list(block_size_names, tune_params):
             warnings.warn("None of the tunable parameters specify thread block dimensions!", UserWarning)
 
 
+def order_runtime_params_last(tune_params, runtime_params):
+    """ return the tunable parameters with the runtime parameters last
+
+    Configurations are enumerated with the last parameters varying fastest,
+    configurations that only differ in runtime parameters, and therefore
+    share the same compiled kernel, are then benchmarked one after the other.
+
+    :param tune_params: A dictionary with the tunable parameters.
+    :type tune_params: dict(string: list)
+
+    :param runtime_params: The names of the runtime parameters.
+    :type runtime_params: list(string)
+
+    :returns: The tunable parameters in the new order.
+    :rtype: OrderedDict
+    """
+    for name in runtime_params:
+        if name not in tune_params:
+            raise ValueError("Runtime parameter " + name + " is not specified in the tunable parameters list!")
+    ordered = OrderedDict((k, v) for k, v in tune_params.items() if k not in runtime_params)
+    ordered.update((k, tune_params[k]) for k in runtime_params)
+    return ordered
+
+def get_runtime_args(params, runtime_params, block_size_names=None):
+    """ return the values of the runtime parameters that are passed to the kernel as arguments
+
+    Runtime parameters that are thread block dimensions only affect how the
+    kernel is launched, the values of the other runtime parameters are appended
+    to the arguments of the kernel, in the order of runtime_params. Python ints
+    and floats are passed as numpy.int32 and numpy.float32, numpy scalars are
+    passed as they are.
+
+    :param params: The values of the tunable parameters of this instance.
+    :type params: dict
+
+    :param runtime_params: The names of the runtime parameters.
+    :type runtime_params: list(string)
+
+    :param block_size_names: The names of the thread block dimensions.
+    :type block_size_names: list(string)
+
+    :returns: The kernel arguments.
+    :rtype: list(numpy.generic)
+    """
+    block_size_names = block_size_names or default_block_size_names
+    args = []
+    for name in runtime_params or []:
+        if name in block_size_names:
+            continue
+        value = params[name]
+        if isinstance(value, numpy.generic):
+            args.append(value)
+        elif isinstance(value, int):
+            args.append(numpy.int32(value))
+        elif isinstance(value, float):
+            args.append(numpy.float32(value))
+        else:
+            raise TypeError("Runtime parameter " + name + " with value " + str(value) + " cannot be passed as a kernel argument")
+    return args
+
+
 def check_restrictions(restrictions, element, keys, verbose):
-    """ check whether a specific instance meets the search space restrictions """
-    params = OrderedDict(zip(keys, element))
+    """ check whether a specific instance meets the search space restrictions
+
+    :param restrictions: The restrictions, either as passed to tune_kernel or as
+        returned by compile_restrictions().
+    :type restrictions: list or list(Restriction)
+
+    :param element: The values of the tunable parameters of this instance, in the
+        same order as keys.
+    :type element: iterable
+
+    :param keys: The names of the tunable parameters.
+    :type keys: iterable
+
+    :param verbose: Whether to report the instance when it fails a restriction.
+    :type verbose: bool
+
+    :returns: True if the instance meets all restrictions.
+    :rtype: bool
+    """
+    element = tuple(element)
+    if not all(isinstance(restrict, Restriction) for restrict in restrictions):
+        restrictions = compile_restrictions(restrictions, OrderedDict(zip(keys, element)))
     for restrict in restrictions:
-        if not eval(replace_param_occurrences(restrict, params)):
+        if not restrict.func(*[element[i] for i in restrict.indices]):
             if verbose:
+                params = OrderedDict(zip(keys, element))
                 print("skipping config", get_instance_string(params), "reason: config fails restriction")
             return False
     return True
 
+def callable_restriction(func, params=None, batch=False):
+    """ wrap a function to be used as restriction with the parameters it uses
+
+    Functions passed as restrictions are called with a dictionary that maps
+    parameter names to values and should return True if the configuration is
+    part of the search space. Wrapping the function allows to list the
+    parameters it uses, such that it can be checked before the other
+    parameters are enumerated.
+
+    A batch restriction is called with a dictionary that maps parameter names
+    to NumPy arrays, with one element for each configuration in a block of
+    configurations, and should return a boolean array that is True for the
+    configurations that are part of the search space.
+
+    :param func: The restriction function.
+    :type func: callable
+
+    :param params: The names of the parameters used by func, all tunable parameters
+        are passed if not given.
+    :type params: list(string)
+
+    :param batch: Whether func evaluates a batch of configurations at once.
+    :type batch: bool
+
+    :returns: The restriction function along with its parameters.
+    :rtype: RestrictionFunction
+    """
+    return RestrictionFunction(func, list(params) if params is not None else None, batch, None)
+
+def compile_restrictions(restrictions, tune_params):
+    """ compile restrictions into functions of the tunable parameters
+
+    Each restriction string is parsed once and turned into a function that takes
+    the tunable parameters used in the expression as arguments. As a result
+    parameter names are bound as variables, rather than substituted as text, and
+    restrictions can be evaluated without calling eval for every instance.
+    Restriction functions are wrapped such that they can be called in the same way.
+
+    :param restrictions: A list of strings containing boolean expressions,
+        functions, or functions wrapped with callable_restriction().
+    :type restrictions: list
+
+    :param tune_params: A dictionary with the tunable parameters, only the
+        names and their order are used.
+    :type tune_params: dict
+
+    :returns: A list of compiled restrictions, each storing the original expression,
+        the names of the parameters it uses, the positions of those parameters in
+        tune_params, and the compiled function.
+    :rtype: list(Restriction)
+    """
+    keys = list(tune_params.keys())
+    if callable(restrictions) or isinstance(restrictions, (str, RestrictionFunction)):
+        restrictions = [restrictions]
+    compiled = []
+    for restrict in restrictions:
+        if isinstance(restrict, Restriction):
+            compiled.append(restrict)
+            continue
+        if callable(restrict) and not isinstance(restrict, RestrictionFunction):
+            restrict = callable_restriction(restrict)
+        if isinstance(restrict, RestrictionFunction):
+            params = keys if restrict.params is None else restrict.params
+            for k in params:
+                if k not in keys:
+                    raise ValueError("Restriction function uses " + str(k) + ", which is not a tunable parameter")
+            func = _get_restriction_function(restrict, params)
+            compiled.append(Restriction(restrict, params, [keys.index(k) for k in params], func))
+            continue
+        try:
+            tree = ast.parse("(" + restrict + "\n)", mode="eval")
+        except SyntaxError:
+            raise ValueError("Restriction " + str(restrict) + " is not a valid Python expression")
+        names = set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+        params = [k for k in keys if k in names]
+        func = eval("lambda " + ", ".join(params) + ": (" + restrict + "\n)", globals())
+        compiled.append(Restriction(restrict, params, [keys.index(k) for k in params], func))
+    return compiled
+
+def _get_restriction_function(restrict, params):
+    """ return a function that calls a restriction function for a single configuration """
+    if restrict.batch:
+        def func(*values):
+            columns = dict((k, numpy.array([v])) for k, v in zip(params, values))
+            return bool(numpy.asarray(restrict.func(columns)).reshape(-1)[0])
+    else:
+        def func(*values):
+            return restrict.func(dict(zip(params, values)))
+    return func
+
+def compile_conditions(conditions, tune_params):
+    """ compile the activation conditions of conditional tunable parameters
+
+    A conditional parameter only affects the kernel when its condition is true.
+    When the condition is false, the parameter is inactive and pinned to the
+    first value in its list of values.
+
+    :param conditions: A dictionary that maps the names of tunable parameters
+        to strings containing a boolean expression of the other parameters.
+    :type conditions: dict(string: string)
+
+    :param tune_params: A dictionary with the tunable parameters.
+    :type tune_params: dict(string: list)
+
+    :returns: A list of compiled conditions, one for each conditional parameter.
+    :rtype: list(Condition)
+    """
+    keys = list(tune_params.keys())
+    compiled = []
+    for param, condition in conditions.items():
+        if param not in keys:
+            raise ValueError("Condition given for " + str(param) + ", which is not a tunable parameter")
+        if not isinstance(condition, str):
+            raise ValueError("The condition for " + param + " should be a string")
+        active = compile_restrictions([condition], tune_params)[0]
+        if param in active.params:
+            raise ValueError("The condition for " + param + " should not depend on " + param + " itself")
+        compiled.append(Condition(param, keys.index(param), tune_params[param][0], active))
+    return compiled
+
+def get_condition_restrictions(conditions):
+    """ return restrictions that only allow inactive parameters to take their default value
+
+    The default value is bound to the restriction function, rather than written
+    into an expression, such that any value, including NumPy scalars, can be a default.
+
+    :param conditions: The conditions as returned by compile_conditions().
+    :type conditions: list(Condition)
+
+    :returns: A list of batch restriction functions, one for each condition,
+        with a key that identifies the condition.
+    :rtype: list(RestrictionFunction)
+    """
+    restrictions = []
+    for c in conditions:
+        restrict = callable_restriction(_get_condition_function(c), c.active.params + [c.param], batch=True)
+        #the condition is identified by its source, such that search spaces with conditions can be cached
+        restrictions.append(restrict._replace(key="condition " + c.param + " = " + repr(c.default) + " unless " + c.active.expression))
+    return restrictions
+
+def _get_condition_function(condition):
+    """ return a batch restriction function that holds where the condition is active or the parameter has its default """
+    active, param, default = condition.active, condition.param, condition.default
+    def func(columns):
+        size = len(columns[param])
+        try:
+            with numpy.errstate(all="ignore"):
+                is_active = numpy.asarray(evaluate_expression(active.expression, columns))
+            if is_active.shape != (size,):
+                raise ValueError("Condition " + active.expression + " is not evaluated element-wise")
+        except Exception:
+            #expression could not be evaluated on arrays, fall back to evaluating it per point
+            if active.params:
+                values = zip(*[columns[k] for k in active.params])
+                is_active = numpy.fromiter((bool(active.func(*v)) for v in values), dtype=bool, count=size)
+            else:
+                is_active = numpy.full(size, bool(active.func()))
+        return is_active.astype(bool) | (numpy.asarray(columns[param]) == default)
+    return func
+
+def apply_conditions(conditions, element):
+    """ pin the inactive parameters of a configuration to their default value
+
+    Configurations that only differ in the values of inactive parameters are
+    functionally identical, this returns the one configuration among those
+    that is part of the search space.
+
+    :param conditions: The conditions as returned by compile_conditions().
+    :type conditions: list(Condition)
+
+    :param element: The values of the tunable parameters of this instance.
+    :type element: list
+
+    :returns: The values of the tunable parameters with inactive parameters pinned.
+    :rtype: list
+    """
+    element = list(element)
+    #pinning a parameter may deactivate the parameters that depend on it
+    for _ in conditions:
+        changed = False
+        for c in conditions:
+            if element[c.index] != c.default and not c.active.func(*[element[i] for i in c.active.indices]):
+                element[c.index] = c.default
+                changed = True
+        if not changed:
+            break
+    return element
+
 def delete_temp_file(filename):
     """ delete a temporary file, don't complain if is no longer exists """
     try:
@@ -121,6 +413,42 @@ def delete_temp_file(filename):
         if e.errno != errno.ENOENT:
             raise e
 
+def create_directory(path):
+    """ create a directory and its parents, don't complain if it already exists """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise e
+
+def replace_file(source, destination):
+    """ rename source to destination, replacing destination if it exists """
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+    elif os.name != "nt":
+        #rename replaces an existing file atomically on POSIX systems
+        os.rename(source, destination)
+    else:
+        delete_temp_file(destination)
+        os.rename(source, destination)
+
+class _Finalizer(object):
+    """ call func(*args) once, when called, when obj is collected, or at exit, like weakref.finalize """
+
+    def __init__(self, obj, func, *args):
+        self.func = func
+        self.args = args
+        self.ref = weakref.ref(obj, lambda ref: self())
+        atexit.register(self)
+
+    def __call__(self):
+        func, self.func = self.func, None
+        if func is not None:
+            func(*self.args)
+
+#weakref.finalize does not exist in Python 2.7
+finalize = getattr(weakref, "finalize", _Finalizer)
+
 def detect_language(lang, kernel_source):
     """attempt to detect language from the kernel_string if not specified"""
     if lang is None:
@@ -150,6 +478,171 @@ def get_config_string(params, units=None):
     return compact_str
 
 
+def compile_expression(expression):
+    """ compile a Python expression that uses tunable parameters as variables
+
+    Compiled expressions are stored, such that each expression is only parsed once.
+
+    :param expression: A Python expression, for example "block_size_x*tile_size_x".
+    :type expression: string
+
+    :returns: The compiled code and a sorted list of the variable names the expression reads.
+    :rtype: code, list(string)
+    """
+    if expression not in _compiled_expressions:
+        tree = ast.parse("(" + expression + "\n)", mode="eval")
+        names = sorted(set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name)))
+        _compiled_expressions[expression] = (compile(tree, "<expression>", "eval"), names)
+    return _compiled_expressions[expression]
+
+def evaluate_expression(expression, params):
+    """ evaluate an expression using the values in params, which may also be NumPy arrays """
+    code, names = compile_expression(expression)
+    return eval(code, globals(), dict((k, params[k]) for k in names if k in params))
+
+def get_dead_params(kernel_source, tune_params, problem_size=None, grid_div=None, block_size_names=None, runtime_params=None,
+                    compiler_option_params=None, compiler_options=None):
+    """ return the tunable parameters that cannot influence the generated code
+
+    A tunable parameter is dead when its name does not occur in any of the kernel
+    source files or the local headers they include, nor in the problem size and
+    grid divisor expressions, and it is not one of the thread block dimensions,
+    runtime parameters, or compiler option parameters. Configurations that only
+    differ in the values of dead parameters result in the same kernel. When the
+    kernel is generated by a function, or includes a local header that cannot be
+    found, all parameters are considered to be used.
+
+    :param kernel_source: The kernel source as passed to tune_kernel, either a
+        string, a filename, a function, or a list of those.
+    :type kernel_source: string or callable or list
+
+    :param tune_params: A dictionary with the tunable parameters.
+    :type tune_params: dict(string: list)
+
+    :param problem_size: The problem size as passed to tune_kernel.
+    :type problem_size: string, int, or tuple(int or string)
+
+    :param grid_div: The grid divisor lists for the x, y, and z dimensions.
+    :type grid_div: tuple(list(string))
+
+    :param block_size_names: The names of the thread block dimensions.
+    :type block_size_names: list(string)
+
+    :param runtime_params: The names of the runtime parameters, which are
+        passed to the kernel rather than used in its source.
+    :type runtime_params: list(string)
+
+    :param compiler_option_params: The names of the parameters whose values
+        are passed to the compiler.
+    :type compiler_option_params: list(string)
+
+    :param compiler_options: The compiler options, in which directories for
+        included headers are given with -I.
+    :type compiler_options: list(string)
+
+    :returns: The names of the dead tunable parameters.
+    :rtype: list(string)
+    """
+    if not isinstance(kernel_source, list):
+        kernel_source = [kernel_source]
+    if any(callable(source) for source in kernel_source):
+        return []
+    used = set(block_size_names or default_block_size_names)
+    used.update(runtime_params or [])
+    used.update(compiler_option_params or [])
+    include_dirs = get_include_dirs(compiler_options)
+    for source in kernel_source:
+        kernel_string = get_kernel_string(source)
+        directory = os.path.dirname(os.path.abspath(source)) if kernel_string is not source else os.getcwd()
+        headers, complete = get_local_includes(kernel_string, [directory, os.getcwd()] + include_dirs)
+        if not complete:
+            logging.debug('not all local headers of the kernel were found, all tunable parameters are considered used')
+            return []
+        for text in [kernel_string] + [read_source_file(h) for h in headers]:
+            used.update(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", text))
+
+    expressions = []
+    if isinstance(problem_size, (list, tuple)):
+        expressions += problem_size
+    else:
+        expressions.append(problem_size)
+    for divisor_list in grid_div or []:
+        expressions += divisor_list or []
+    for expression in expressions:
+        if isinstance(expression, str):
+            used.update(compile_expression(expression)[1])
+
+    return [k for k in tune_params.keys() if k not in used]
+
+def get_include_dirs(compiler_options):
+    """ return the directories passed with -I or -iquote in compiler_options, in order """
+    directories = []
+    options = list(compiler_options or [])
+    for i, option in enumerate(options):
+        for flag in ("-iquote", "-I"):
+            if option == flag and i+1 < len(options):
+                directories.append(options[i+1])
+            elif option.startswith(flag) and option != flag:
+                directories.append(option[len(flag):].lstrip("="))
+    return directories
+
+def has_local_includes(kernel_string):
+    """ return whether kernel_string includes a header with #include "..." """
+    return re.search(r'^\s*#\s*include\s*"', kernel_string, flags=re.MULTILINE) is not None
+
+def get_local_includes(kernel_string, directories=None):
+    """ return the local headers that kernel_string includes, directly or through other headers
+
+    Headers named in #include "..." directives are looked up in the directory
+    of the header that includes them, and then in directories, like compilers
+    do for the quoted form of #include. Headers included with angle brackets
+    are system headers and are not returned.
+
+    :param kernel_string: The code that includes the headers.
+    :type kernel_string: string
+
+    :param directories: The directories in which included headers are looked up,
+        starting with the directory of the kernel itself.
+    :type directories: list(string)
+
+    :returns: The absolute names of the included headers, and whether every
+        header that is included could be found.
+    :rtype: list(string), bool
+    """
+    headers = []
+    complete = True
+    pending = [(kernel_string, [])]
+    while pending:
+        string, own_directory = pending.pop()
+        for name in re.findall(r'^\s*#\s*include\s*"([^"]+)"', string, flags=re.MULTILINE):
+            candidates = [name] if os.path.isabs(name) else [os.path.join(d, name) for d in own_directory + list(directories or [])]
+            found = [c for c in candidates if os.path.isfile(c)]
+            if not found:
+                complete = False
+                continue
+            header = os.path.abspath(found[0])
+            if header not in headers:
+                headers.append(header)
+                pending.append((read_source_file(header), [os.path.dirname(header)]))
+    return headers, complete
+
+def get_live_key(params, dead_params):
+    """ return a key of the values of the live parameters of a configuration
+
+    Configurations with the same key only differ in dead parameters, see
+    get_dead_params(), and therefore result in the same kernel.
+
+    :param params: The values of the tunable parameters of a configuration.
+    :type params: dict
+
+    :param dead_params: The names of the dead tunable parameters.
+    :type dead_params: list(string)
+
+    :returns: The names and values of the live parameters, sorted by name.
+    :rtype: tuple
+    """
+    return tuple((k, params[k]) for k in sorted(params.keys()) if k not in dead_params)
+
 def get_grid_dimensions(current_problem_size, params, grid_div, block_size_names):
     """compute grid dims based on problem sizes and listed grid divisors"""
     def get_dimension_divisor(divisor_list, default, params):
@@ -158,7 +651,7 @@ def get_grid_dimensions(current_problem_size, params, grid_div, block_size_names
                 divisor_list = [default]
             else:
                 return 1
-        return numpy.prod([int(eval(replace_param_occurrences(s, params))) for s in divisor_list])
+        return numpy.prod([int(evaluate_expression(s, params)) for s in divisor_list])
     divisors = [get_dimension_divisor(d, block_size_names[i], params) for i, d in enumerate(grid_div)]
     return tuple(int(numpy.ceil(float(current_problem_size[i]) / float(d))) for i, d in enumerate(divisors))
 
@@ -168,18 +661,21 @@ def get_instance_string(params):
     """
     return "_".join([str(i) for i in params.values()])
 
-def get_kernel_string(kernel_source, params=None):
+def get_kernel_string(kernel_source, params=None, generated=None):
     """ retrieve the kernel source and return as a string
 
     This function processes the passed kernel_source argument, which could be
     a function, a string with a filename, or just a string with code already.
 
     If kernel_source is a function, the function is called with instance
-    parameters in 'params' as the only argument.
+    parameters in 'params' as the only argument. When a dictionary 'generated'
+    is passed, the returned code is stored in it along with the values of the
+    parameters that the function has read, and reused for instances that have
+    the same values for those parameters.
 
     If kernel_source looks like filename, the file is read in, but if
     the file does not exist, it is assumed that the string is not a filename
-    after all.
+    after all. Files are only read again when they have been modified.
 
     :param kernel_source: One of the sources for the kernel, could be a
         function that generates the kernel code, a string containing a filename
@@ -190,6 +686,11 @@ def get_kernel_string(kernel_source, params=None):
         kernel instance, only needed when kernel_source is a generator.
     :type param: dict
 
+    :param generated: Dictionary in which the code returned by generators is
+        stored, such as one for each tuning run. None by default to call the
+        generator for every instance.
+    :type generated: dict
+
     :returns: A string containing the kernel code.
     :rtype: string
     """
@@ -198,16 +699,144 @@ def get_kernel_string(kernel_source, params=None):
 
     kernel_string = None
     if callable(kernel_source):
-        kernel_string = kernel_source(params)
+        kernel_string = _generate_kernel_string(kernel_source, params, generated)
     elif isinstance(kernel_source, str):
         if looks_like_a_filename(kernel_source):
-            kernel_string = read_file(kernel_source) or kernel_source
+            kernel_string = read_source_file(kernel_source) or kernel_source
         else:
             kernel_string = kernel_source
     else:
         raise TypeError("Error kernel_source is not a string nor a callable function")
     return kernel_string
 
+class _RecordingDict(dict):
+    """ dictionary that records which keys have been read """
+
+    def __init__(self, *args, **kwargs):
+        super(_RecordingDict, self).__init__(*args, **kwargs)
+        self.accessed = set()
+
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        return super(_RecordingDict, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed.add(key)
+        return super(_RecordingDict, self).get(key, default)
+
+    def __contains__(self, key):
+        self.accessed.add(key)
+        return super(_RecordingDict, self).__contains__(key)
+
+    def _read_all(self):
+        self.accessed.update(super(_RecordingDict, self).keys())
+
+    def __iter__(self):
+        self._read_all()
+        return super(_RecordingDict, self).__iter__()
+
+    def keys(self):
+        self._read_all()
+        return super(_RecordingDict, self).keys()
+
+    def values(self):
+        self._read_all()
+        return super(_RecordingDict, self).values()
+
+    def items(self):
+        self._read_all()
+        return super(_RecordingDict, self).items()
+
+    def copy(self):
+        self._read_all()
+        return dict(self)
+
+    def __len__(self):
+        self._read_all()
+        return super(_RecordingDict, self).__len__()
+
+    def __repr__(self):
+        self._read_all()
+        return super(_RecordingDict, self).__repr__()
+
+    def __str__(self):
+        self._read_all()
+        return super(_RecordingDict, self).__str__()
+
+    def __format__(self, format_spec):
+        self._read_all()
+        return format(dict(self), format_spec)
+
+    def __eq__(self, other):
+        self._read_all()
+        return super(_RecordingDict, self).__eq__(other)
+
+    def __ne__(self, other):
+        self._read_all()
+        return super(_RecordingDict, self).__ne__(other)
+
+    __hash__ = None
+
+    def __reduce__(self):
+        self._read_all()
+        return (dict, (dict(self),))
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
+    #the methods of dictionaries in Python 2.7 that read all keys
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def has_key(self, key):
+        return key in self
+
+def _generate_kernel_string(generator, params, generated_sources):
+    """ call a code generator, memoized in generated_sources by the values of the parameters it reads """
+    if params is None or generated_sources is None:
+        return generator(params)
+    try:
+        entries = generated_sources.setdefault(generator, [])
+    except TypeError:
+        return generator(params)
+
+    #each entry stores the parameters read by the generator and the code for each of their values
+    for keys, generated in entries:
+        try:
+            values = tuple(params[k] for k in keys)
+            if values in generated:
+                return generated[values]
+        except (KeyError, TypeError):
+            continue
+
+    recording = _RecordingDict(params)
+    kernel_string = generator(recording)
+    keys = tuple(sorted(k for k in recording.accessed if k in params))
+    #a generator that reads no parameters may read them in a way that is not recorded
+    if not keys:
+        return kernel_string
+    try:
+        values = tuple(params[k] for k in keys)
+        hash(values)
+    except TypeError:
+        return kernel_string
+    for entry_keys, generated in entries:
+        if entry_keys == keys:
+            break
+    else:
+        generated = dict()
+        entries.append((keys, generated))
+    if len(generated) >= _generated_sources_size:
+        generated.clear()
+    generated[values] = kernel_string
+    return kernel_string
+
 def get_problem_size(problem_size, params):
     """compute current problem size"""
     if isinstance(problem_size, (str, int, numpy.integer)):
@@ -215,16 +844,16 @@ def get_problem_size(problem_size, params):
     current_problem_size = [1, 1, 1]
     for i, s in enumerate(problem_size):
         if isinstance(s, str):
-            current_problem_size[i] = int(eval(replace_param_occurrences(s, params)))
+            current_problem_size[i] = int(evaluate_expression(s, params))
         elif isinstance(s, (int, numpy.integer)):
             current_problem_size[i] = s
         else:
             raise TypeError("Error: problem_size should only contain strings or integers")
     return current_problem_size
 
-def get_temp_filename(suffix=None):
-    """ return a string in the form of temp_X, where X is a large integer """
-    file = tempfile.mkstemp(suffix=suffix or "", prefix="temp_", dir=os.getcwd()) # or "" for Python 2 compatibility
+def get_temp_filename(suffix=None, directory=None):
+    """ return a string in the form of temp_X, where X is a large integer, in directory or the current working directory """
+    file = tempfile.mkstemp(suffix=suffix or "", prefix="temp_", dir=directory or os.getcwd()) # or "" for Python 2 compatibility
     os.close(file[0])
     return file[1]
 
@@ -258,7 +887,8 @@ def looks_like_a_filename(kernel_source):
         result = result and any([s in kernel_source for s in (".c", ".opencl", ".F")])
     return result
 
-def prepare_kernel_string(kernel_name, kernel_string, params, grid, threads, block_size_names):
+def prepare_kernel_string(kernel_name, kernel_string, params, grid, threads, block_size_names, prologue_first=False, runtime_params=None,
+                          compiler_option_params=None):
     """ prepare kernel string for compilation
 
     Prepends the kernel with a series of C preprocessor defines specific
@@ -293,26 +923,78 @@ def prepare_kernel_string(kernel_name, kernel_string, params, grid, threads, blo
         may supply different names if they prefer.
     :type block_size_names: tuple(string)
 
+    :param prologue_first: Keep the #include lines at the start of the kernel,
+        as returned by split_prologue(), in front of the defines, such that they
+        can be compiled into a precompiled header. False by default.
+    :type prologue_first: bool
+
+    :param runtime_params: The names of the tunable parameters that are not
+        defined, because they are passed to the kernel or only affect how it
+        is launched. The grid dimensions are also not defined for kernels with
+        runtime parameters, as these may depend on the runtime parameters.
+    :type runtime_params: list(string)
+
+    :param compiler_option_params: The names of the tunable parameters whose
+        values are passed to the compiler as options, which are not defined.
+    :type compiler_option_params: list(string)
+
     :returns: A string containing the source code made specific to this kernel instance.
     :rtype: string
 
     """
     logging.debug('prepare_kernel_string called for %s', kernel_name)
 
+    prologue = ""
+    if prologue_first:
+        prologue, kernel_string = split_prologue(kernel_string)
+
+    runtime_params = runtime_params or []
     grid_dim_names = ["grid_size_x", "grid_size_y", "grid_size_z"]
-    for i, g in enumerate(grid):
-        kernel_string = "#define " + grid_dim_names[i] + " " + str(g) + "\n" + kernel_string
+    if not runtime_params:
+        for i, g in enumerate(grid):
+            kernel_string = "#define " + grid_dim_names[i] + " " + str(g) + "\n" + kernel_string
     for i, g in enumerate(threads):
-        kernel_string = "#define " + block_size_names[i] + " " + str(g) + "\n" + kernel_string
+        if block_size_names[i] not in runtime_params:
+            kernel_string = "#define " + block_size_names[i] + " " + str(g) + "\n" + kernel_string
+    compiler_option_params = compiler_option_params or []
     for k, v in params.items():
-        if k not in block_size_names:
+        if k not in block_size_names and k not in runtime_params and k not in compiler_option_params:
             kernel_string = "#define " + k + " " + str(v) + "\n" + kernel_string
     name = kernel_name
     #name = kernel_name + "_" + get_instance_string(params)
     #kernel_string = kernel_string.replace(kernel_name, name)
-    return name, kernel_string
+    return name, prologue + kernel_string
+
+def split_prologue(kernel_string):
+    """ split the #include lines at the start of a kernel from the rest of the code
+
+    The prologue consists of the lines before the first line that is not an
+    #include, a comment, or empty. It therefore does not include any headers
+    that follow a #define.
 
-def prepare_list_of_files(kernel_name, kernel_file_list, params, grid, threads, block_size_names):
+    :param kernel_string: The source code of the kernel.
+    :type kernel_string: string
+
+    :returns: The prologue, or an empty string if it contains no #include,
+        and the rest of the code.
+    :rtype: string, string
+    """
+    lines = kernel_string.splitlines(True)
+    n = 0
+    for line in lines:
+        stripped = line.strip()
+        if stripped and not stripped.startswith("//") and not re.match(r"#\s*include\b", stripped):
+            break
+        n += 1
+    prologue = "".join(lines[:n])
+    if not re.search(r"^\s*#\s*include\b", prologue, flags=re.MULTILINE):
+        return "", kernel_string
+    if not prologue.endswith("\n"):
+        prologue += "\n"
+    return prologue, "".join(lines[n:])
+
+def prepare_list_of_files(kernel_name, kernel_file_list, params, grid, threads, block_size_names, directory=None, prologue_first=False,
+                          runtime_params=None, generated=None, compiler_option_params=None):
     """ prepare the kernel string along with any additional files
 
     The first file in the list is allowed to include or read in the others
@@ -336,25 +1018,97 @@ def prepare_list_of_files(kernel_name, kernel_file_list, params, grid, threads,
         convenience.
     :type grid: tuple()
 
+    :param directory: The directory in which the temporary files are created,
+        the current working directory by default.
+    :type directory: string
+
+    :param prologue_first: Keep the #include lines at the start of the first
+        file in front of the defines, see prepare_kernel_string().
+    :type prologue_first: bool
+
+    :param runtime_params: The names of the tunable parameters that are not
+        defined, see prepare_kernel_string().
+    :type runtime_params: list(string)
+
+    :param generated: Dictionary in which the code returned by generators is
+        stored, see get_kernel_string().
+    :type generated: dict
+
+    :param compiler_option_params: The names of the tunable parameters that
+        are passed to the compiler, which are not defined.
+    :type compiler_option_params: list(string)
+
     """
     temp_files = dict()
 
-    kernel_string = get_kernel_string(kernel_file_list[0], params)
-    name, kernel_string = prepare_kernel_string(kernel_name, kernel_string, params, grid, threads, block_size_names)
+    kernel_string = get_kernel_string(kernel_file_list[0], params, generated)
+    name, kernel_string = prepare_kernel_string(kernel_name, kernel_string, params, grid, threads, block_size_names, prologue_first, runtime_params,
+                                                compiler_option_params)
 
     if len(kernel_file_list) > 1:
         for f in kernel_file_list[1:]:
-            #generate temp filename with the same extension
-            temp_file = get_temp_filename(suffix="." + f.split(".")[-1])
-            temp_files[f] = temp_file
             #add preprocessor statements to the additional file
-            _, temp_file_string = prepare_kernel_string(kernel_name, get_kernel_string(f, params), params, grid, threads, block_size_names)
-            write_file(temp_file, temp_file_string)
+            _, temp_file_string = prepare_kernel_string(kernel_name, get_kernel_string(f, params, generated), params, grid, threads, block_size_names,
+                                                        runtime_params=runtime_params, compiler_option_params=compiler_option_params)
+            #store it in a file with the same extension, named after its contents
+            temp_file = write_instance_file(f, temp_file_string, directory)
+            temp_files[f] = temp_file
             #replace occurences of the additional file's name in the first kernel_string with the name of the temp file
             kernel_string = kernel_string.replace(f, temp_file)
 
     return name, kernel_string, temp_files
 
+def get_relative_source(kernel_string, directory):
+    """ return the kernel string with the names of the instance files in directory made relative
+
+    Instance files are created in a new workspace in each run, which changes the
+    kernel string that includes them. Keys of compiled kernels and failures are
+    computed on the relative source, such that they are the same in each run.
+
+    :param kernel_string: The kernel string, as returned by prepare_list_of_files().
+    :type kernel_string: string
+
+    :param directory: The directory in which the instance files were created.
+    :type directory: string
+
+    :returns: The kernel string without the directory in the names of instance files.
+    :rtype: string
+    """
+    if not directory:
+        return kernel_string
+    return kernel_string.replace(os.path.join(directory, "temp_"), "temp_")
+
+def read_source_file(filename):
+    """ return the contents of a source file, reading it again only if it has been modified
+
+    :param filename: The name of the file.
+    :type filename: string
+
+    :returns: The contents of the file, or None if the file does not exist.
+    :rtype: string
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    version = (getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_size)
+    cached = _source_files.get(filename)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    contents = read_file(filename)
+    _source_files[filename] = (version, contents)
+    return contents
+
+def release_instance_file(filename):
+    """ delete an instance file written by write_instance_file() once no kernel instance uses it """
+    with _instance_files_lock:
+        count = _instance_files.get(filename, 0) - 1
+        if count > 0:
+            _instance_files[filename] = count
+            return
+        _instance_files.pop(filename, None)
+        delete_temp_file(filename)
+
 def read_file(filename):
     """ return the contents of the file named filename or None if file not found """
     if os.path.isfile(filename):
@@ -368,12 +1122,85 @@ def replace_param_occurrences(string, params):
     return string
 
 def setup_block_and_grid(problem_size, grid_div, params, block_size_names=None):
-    """compute problem size, thread block and grid dimensions for this kernel"""
+    """compute problem size, thread block and grid dimensions for this kernel
+
+    The result is memoized on the values of only those parameters that are read
+    by the problem size and grid divisor expressions, or that set the thread block
+    dimensions. Configurations that differ only in other parameters reuse the result.
+    """
+    context, names = _get_block_and_grid_context(problem_size, grid_div, block_size_names)
+    try:
+        key = (context, tuple(params.get(k, _missing) for k in names))
+        hash(key)
+    except TypeError:
+        key = None
+    #look up once, another thread may clear the cache between a membership test and a lookup
+    if key is not None:
+        result = _block_and_grid_cache.get(key, _missing)
+        if result is not _missing:
+            return result
+
     threads = get_thread_block_dimensions(params, block_size_names)
     current_problem_size = get_problem_size(problem_size, params)
     grid = get_grid_dimensions(current_problem_size, params, grid_div, block_size_names)
+
+    if key is not None:
+        if len(_block_and_grid_cache) >= _block_and_grid_cache_size:
+            _block_and_grid_cache.clear()
+        _block_and_grid_cache[key] = (threads, grid)
     return threads, grid
 
+def _get_block_and_grid_context(problem_size, grid_div, block_size_names):
+    """ return a hashable key for the expressions and the names of the parameters they read """
+    def freeze(x):
+        if isinstance(x, (list, tuple)):
+            return tuple(freeze(i) for i in x)
+        return x
+    context = (freeze(problem_size), freeze(grid_div), freeze(block_size_names))
+    names = set(block_size_names or default_block_size_names)
+    for s in list(context[0]) if isinstance(context[0], tuple) else [context[0]]:
+        if isinstance(s, str):
+            names.update(compile_expression(s)[1])
+    for divisor_list in grid_div:
+        for s in divisor_list or []:
+            names.update(compile_expression(s)[1])
+    return context, tuple(sorted(names))
+
+def write_instance_file(filename, string, directory=None):
+    """ write the instance specific version of an additional source file
+
+    The file is named after a hash of its contents, an existing file with the
+    same contents is reused rather than written again. The same contents are
+    therefore always stored under the same name, which keeps the host code that
+    includes the file the same. In the current working directory, the name also
+    contains the process id, such that processes that share the working directory
+    never remove each other's files. Each call should be paired with a call to release_instance_file().
+
+    :param filename: The name of the original file, only its extension is used.
+    :type filename: string
+
+    :param string: The contents of the instance file.
+    :type string: string
+
+    :param directory: The directory in which the file is created, the current
+        working directory by default.
+    :type directory: string
+
+    :returns: The name of the instance file.
+    :rtype: string
+    """
+    digest = hashlib.sha256(string.encode("utf-8")).hexdigest()[:32]
+    prefix = "temp_" if directory else "temp_" + str(os.getpid()) + "_"
+    instance_file = os.path.join(directory or os.getcwd(), prefix + digest + "." + filename.split(".")[-1])
+    with _instance_files_lock:
+        _instance_files[instance_file] = _instance_files.get(instance_file, 0) + 1
+        if not os.path.isfile(instance_file):
+            #write to a temporary file first, such that compilers never see a partial file
+            temp_file = get_temp_filename(suffix="." + filename.split(".")[-1], directory=directory)
+            write_file(temp_file, string)
+            replace_file(temp_file, instance_file)
+    return instance_file
+
 def write_file(filename, string):
     """dump the contents of string to a file called filename"""
     import sys
@@ -0,0 +1,92 @@
+""" Module for the scratch directory that holds the temporary files of a tuning run """
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import tempfile
+
+from kernel_tuner import util
+
+
+def get_default_directory():
+    """ return /dev/shm if it is a writable tmpfs that allows executables, the system temp directory otherwise
+
+    Compiled C kernels are loaded from the workspace, which is not possible
+    if the file system is mounted with noexec, as /dev/shm often is in containers.
+    """
+    directory = "/dev/shm"
+    try:
+        stat = os.statvfs(directory)
+    except (OSError, AttributeError):
+        return tempfile.gettempdir()
+    if stat.f_flag & getattr(os, "ST_NOEXEC", 8) or not os.access(directory, os.W_OK | os.X_OK):
+        return tempfile.gettempdir()
+    return directory
+
+
+def _remove_workspace(directory, retained):
+    """ remove all files in directory except those in retained, and the directory if it is empty """
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        filename = os.path.join(directory, name)
+        if filename in retained:
+            continue
+        if os.path.isdir(filename):
+            shutil.rmtree(filename, ignore_errors=True)
+        else:
+            util.delete_temp_file(filename)
+    if retained:
+        logging.debug('kept ' + str(len(retained)) + ' files in workspace ' + directory)
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+        logging.debug('removed workspace ' + directory)
+
+
+class Workspace(object):
+    """Private directory for the temporary files of one tuning run
+
+    Kernel sources, instance files, and compiled libraries are created in a
+    new directory that is removed as a whole when the run is finished, or at
+    the latest when the interpreter exits. By default the directory is
+    created in /dev/shm, to avoid slow and shared file systems such as the
+    network file systems that hold the working directory on cluster nodes.
+    Files of configurations that failed can be retained for debugging.
+    """
+
+    def __init__(self, directory=None, keep_failed=True):
+        """ Create a workspace in directory
+
+        :param directory: The directory in which the workspace is created, created
+            if needed. By default /dev/shm if possible, or the system temp directory.
+        :type directory: string
+
+        :param keep_failed: Whether to keep the files passed to retain() when the
+            workspace is removed, True by default.
+        :type keep_failed: bool
+        """
+        base = directory or get_default_directory()
+        util.create_directory(base)
+        self.directory = tempfile.mkdtemp(prefix="kernel_tuner_", dir=base)
+        self.keep_failed = keep_failed
+        self.retained = set()
+        self._finalizer = util.finalize(self, _remove_workspace, self.directory, self.retained)
+        logging.debug('created workspace ' + self.directory)
+
+    def get_temp_filename(self, suffix=None):
+        """ return the name of a new file in the workspace """
+        return util.get_temp_filename(suffix=suffix, directory=self.directory)
+
+    def retain(self, filenames):
+        """ keep filenames, the files of a failed configuration, when the workspace is removed
+
+        :param filenames: The names of the files.
+        :type filenames: list(string)
+        """
+        if self.keep_failed:
+            self.retained.update(os.path.abspath(f) for f in filenames)
+
+    def cleanup(self):
+        """ remove the workspace, except the retained files """
+        self._finalizer()
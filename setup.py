@@ -35,7 +35,8 @@ setup(
     ],
     install_requires=[
         'numpy>=1.13.3',
-        'scipy>=0.18.1'],
+        'scipy>=0.18.1',
+        'futures>=3.0.5; python_version < "3"'],
     extras_require={
         'doc': ['sphinx', 'sphinx_rtd_theme', 'nbsphinx',
                 'noodles', 'ipython'],
@@ -1,5 +1,9 @@
 from __future__ import print_function
 
+import glob
+import os
+import subprocess
+
 import numpy
 import ctypes as C
 from pytest import raises
@@ -10,6 +14,9 @@ except ImportError:
     from unittest.mock import patch, Mock
 
 from kernel_tuner.c import CFunctions, Argument
+from kernel_tuner.cache import FileCache, get_key
+from kernel_tuner.util import prepare_kernel_string, default_block_size_names
+from kernel_tuner.toolchain import get_compiler, get_toolchain, split_options, GNUToolchain, _versions
 
 
 def test_ready_argument_list1():
@@ -92,8 +99,8 @@ def test_byte_array_arguments():
 
 
 @patch('kernel_tuner.c.subprocess')
-@patch('kernel_tuner.c.numpy.ctypeslib')
-def test_compile(npct, subprocess):
+@patch('kernel_tuner.c.C.CDLL')
+def test_compile(cdll, subprocess):
 
     kernel_string = "this is a fake C program"
     kernel_name = "blabla"
@@ -102,14 +109,14 @@ def test_compile(npct, subprocess):
     f = cfunc.compile(kernel_name, kernel_string)
 
     print(subprocess.mock_calls)
-    print(npct.mock_calls)
+    print(cdll.mock_calls)
     print(f)
 
-    assert len(subprocess.mock_calls) == 6
-    assert npct.load_library.called == 1
+    assert subprocess.check_call.call_count == 2
+    assert cdll.called == 1
 
-    args, _ = npct.load_library.call_args_list[0]
-    filename = args[0]
+    args, _ = cdll.call_args_list[0]
+    filename = ".".join(args[0].split(".")[:-1])
     print('filename=' + filename)
 
     #check if temporary files are cleaned up correctly
@@ -119,6 +126,220 @@ def test_compile(npct, subprocess):
     assert not os.path.isfile(filename + ".so")
 
 
+@patch('kernel_tuner.c.subprocess')
+def test_build_selects_compiler_per_kernel(subprocess):
+    cfunc = CFunctions()
+    cfunc.nvcc_available = True
+    cfunc.build("cuda_kernel", "__global__ void cuda_kernel() {}")
+    cfunc.build("c_kernel", "void c_kernel() {}")
+
+    #the compiler chosen for one kernel is not stored for the kernels built after it
+    compilers = [args[0][0] for args, _ in subprocess.check_call.call_args_list]
+    assert compilers == ["nvcc", "nvcc", "g++", "g++"]
+    assert cfunc.compiler == "g++"
+
+
+def test_compile_cache(tmpdir):
+    kernel_string = "float vector_add(float *a) { return 1.0f; }"
+    cache_dir = str(tmpdir.join("cache"))
+
+    with patch('kernel_tuner.c.subprocess.check_call', wraps=subprocess.check_call) as check_call:
+        cfunc = CFunctions(cache_dir=cache_dir)
+        cfunc.compile("vector_add", kernel_string)
+        assert check_call.call_count == 2
+        assert len(os.listdir(os.path.join(cache_dir, "c"))) == 3     #the library, the lock file and the index file
+
+        #the same kernel is loaded from the cache, also by other instances, without leaving temporary files
+        temp_files = set(glob.glob("temp_*"))
+        f = CFunctions(cache_dir=cache_dir).compile("vector_add", kernel_string)
+        assert check_call.call_count == 2
+        assert set(glob.glob("temp_*")) == temp_files
+        assert f() == 1.0
+
+        #a different kernel or compiler option is compiled again
+        cfunc.compile("vector_add", kernel_string.replace("1.0f", "2.0f"))
+        assert check_call.call_count == 4
+        CFunctions(cache_dir=cache_dir, compiler_options=["-O3"]).compile("vector_add", kernel_string)
+        assert check_call.call_count == 6
+
+
+def test_build_batch():
+    kernel_string = "float vector_add(float *a) { return (float) tile_size_x; }"
+    kernel_strings = ["#define tile_size_x " + str(i) + "\n" + kernel_string for i in range(1, 4)]
+
+    with patch('kernel_tuner.c.subprocess.check_call', wraps=subprocess.check_call) as check_call:
+        cfunc = CFunctions()
+        builds = cfunc.build_batch(["vector_add"]*3, kernel_strings)
+        assert check_call.call_count == 2
+
+    #all variants are taken from the same library
+    assert len(set(b.filename for b in builds)) == 1
+    #the library does not identify the code of a single variant
+    assert all(b.binary_hash is None for b in builds)
+    for i, build in enumerate(builds):
+        assert cfunc.load("vector_add", build)() == i + 1
+
+    #kernels that include local headers are built one at a time
+    with raises(ValueError):
+        cfunc.build_batch(["vector_add"]*2, ['#include "tile.h"\n' + s for s in kernel_strings[:2]])
+
+
+def test_unload():
+    kernel_string = "float vector_add(float *a) { return (float) tile_size_x; }"
+    kernel_strings = ["#define tile_size_x " + str(i) + "\n" + kernel_string for i in range(1, 3)]
+
+    cfunc = CFunctions()
+    builds = cfunc.build_batch(["vector_add"]*2, kernel_strings)
+    funcs = [cfunc.load("vector_add", build) for build in builds]
+    other = cfunc.compile("vector_add", "#define tile_size_x 3\n" + kernel_string)
+    assert len(cfunc.libs) == 2
+
+    #libraries remain loaded while any of their functions are in use
+    assert cfunc.unload(funcs[0])
+    assert funcs[1]() == 2
+    assert cfunc.unload(funcs[1])
+    assert len(cfunc.libs) == 1
+    assert other() == 3
+
+    #libraries that use OpenMP are never unloaded
+    cfunc.using_openmp = True
+    assert not cfunc.unload(other)
+    assert len(cfunc.libs) == 1
+
+
+def test_precompiled_header(tmpdir):
+    kernel_string = "#include <vector>\n#include <numeric>\n\nfloat vector_sum(float *a) { std::vector<float> v(a, a + tile_size_x); return std::accumulate(v.begin(), v.end(), 0.0f); }"
+    a = numpy.arange(4).astype(numpy.float32)
+
+    cfunc = CFunctions(temp_dir=str(tmpdir), precompiled_header=True)
+    c_args = cfunc.ready_argument_list([a])
+    for i in range(1, 4):
+        _, instance = prepare_kernel_string("vector_sum", kernel_string, {"tile_size_x": i}, (1, 1, 1), (1, 1, 1), default_block_size_names, True)
+        func = cfunc.compile("vector_sum", instance)
+        assert func(*c_args) == sum(range(i))
+
+    #the header is only compiled once, for the same compiler options
+    assert len(cfunc.precompiled_headers) == 1
+    header_options = list(cfunc.precompiled_headers.values())[0]
+    assert header_options[0] == "-include"
+    assert os.path.isfile(header_options[1] + ".gch")
+
+
+def test_toolchain():
+    assert isinstance(get_toolchain("g++"), GNUToolchain)
+    assert get_toolchain("/usr/bin/clang++").precompiled_header_extension == ".pch"
+    assert get_toolchain("nvcc").get_compiler_options(True) == ["-Xcompiler=-fPIC", "-Xcompiler=-fopenmp"]
+    assert get_toolchain("pgfortran").get_compiler_options(True) == ["-fPIC", "-mp"]
+    assert get_toolchain("gfortran").get_function_name("f", "module vec\ncontains") == "__vec_MOD_f"
+    assert get_toolchain("g++") is get_toolchain("g++")
+    assert split_options(["-O3", "", "-march=native -ffast-math"]) == ["-O3", "-march=native", "-ffast-math"]
+
+    #CUDA code is built with nvcc if available, unless another compiler than g++ is passed
+    assert get_compiler("g++", "__global__ void f() {}", nvcc_available=True) == "nvcc"
+    assert get_compiler("g++", "__global__ void f() {}", nvcc_available=False) == "g++"
+    assert get_compiler("clang++", "#include <cuda_runtime.h>", nvcc_available=True) == "clang++"
+    assert get_compiler("g++", "void f() {}", nvcc_available=True) == "g++"
+
+    #capabilities are probed once
+    toolchain = get_toolchain("g++")
+    with patch.object(toolchain, "probe", wraps=toolchain.probe) as probe:
+        assert toolchain.supports("-O3 -funroll-loops")
+        assert toolchain.supports(["-O3", "-funroll-loops"])
+        assert not toolchain.supports("-fno-such-option")
+        assert toolchain.supports("")
+        assert probe.call_count == 2
+
+
+def test_compiler_version_cache(tmpdir):
+    compiler = str(tmpdir.join("fakecc"))
+    def write_compiler(version):
+        with open(compiler, "w") as f:
+            f.write("#!/bin/sh\necho fakecc " + version + "\necho\necho Copyright\n")
+        os.chmod(compiler, 0o755)
+    write_compiler("1.0")
+    cache_dir = str(tmpdir.join("cache"))
+
+    toolchain = get_toolchain(compiler)
+    with patch('kernel_tuner.toolchain.subprocess.check_output', wraps=subprocess.check_output) as check_output:
+        assert toolchain.get_version(cache_dir) == "1.0"
+        assert toolchain.get_version() == "1.0"
+        assert check_output.call_count == 1
+
+        #other processes read the version from the cache
+        _versions.clear()
+        assert toolchain.get_version(cache_dir) == "1.0"
+        assert check_output.call_count == 1
+
+        #a compiler that changed is probed again
+        write_compiler("1.10")
+        assert toolchain.get_version(cache_dir) == "1.10"
+        assert check_output.call_count == 2
+
+    with raises(OSError):
+        get_toolchain(str(tmpdir.join("missing"))).get_version()
+
+
+def test_compile_options():
+    kernel_string = "float vector_add(float *a) { return OPT_LEVEL; }"
+    cfunc = CFunctions()
+    assert cfunc.compile("vector_add", kernel_string, options="-DOPT_LEVEL=2 -O2")() == 2.0
+    builds = cfunc.build_batch(["vector_add"]*2, [kernel_string]*2, options=["-DOPT_LEVEL=3"])
+    assert cfunc.load("vector_add", builds[0])() == 3.0
+
+
+def test_compile_cache_local_headers(tmpdir):
+    kernel_string = '#include "value.h"\nfloat vector_add(float *a) { return VALUE; }'
+    cache_dir = str(tmpdir.join("cache"))
+    header = str(tmpdir.join("value.h"))
+    options = ["-I" + str(tmpdir)]
+
+    with open(header, "w") as f:
+        f.write("#define VALUE 1.0f\n")
+    assert CFunctions(cache_dir=cache_dir, compiler_options=options).compile("vector_add", kernel_string)() == 1.0
+
+    #a kernel whose header has changed is compiled again
+    with open(header, "w") as f:
+        f.write("#define VALUE 2.0f /* changed */\n")
+    with patch('kernel_tuner.c.subprocess.check_call', wraps=subprocess.check_call) as check_call:
+        assert CFunctions(cache_dir=cache_dir, compiler_options=options).compile("vector_add", kernel_string)() == 2.0
+        assert check_call.call_count == 2
+        assert CFunctions(cache_dir=cache_dir, compiler_options=options).compile("vector_add", kernel_string)() == 2.0
+        assert check_call.call_count == 2
+
+
+def test_file_cache_eviction(tmpdir):
+    cache = FileCache(str(tmpdir.join("cache")), max_size=35)
+    source = str(tmpdir.join("source"))
+    with open(source, "w") as f:
+        f.write("0123456789")
+
+    keys = [get_key("kernel", i) for i in range(4)]
+    cache.store(keys[0], source, ".so")
+    #the directory is only scanned again when the cache is full
+    with patch("kernel_tuner.cache.os.listdir", wraps=os.listdir) as listdir:
+        cache.store(keys[1], source, ".so")
+        cache.store(keys[2], source, ".so")
+        cache.store(keys[2], source, ".so")
+        assert listdir.call_count == 0
+    for i in range(3):
+        os.utime(cache.get_filename(keys[i], ".so"), (i, i))
+    assert cache.lookup(keys[0], ".so")
+
+    #the least recently used files are evicted until the cache fits in 3/4 of max_size
+    cache.store(keys[3], source, ".so")
+    assert cache.lookup(keys[1], ".so") is None
+    assert cache.lookup(keys[2], ".so") is None
+    assert cache.lookup(keys[0], ".so")
+    assert cache.lookup(keys[3], ".so")
+
+    #data can also be stored directly
+    filename = cache.write(keys[1], b"0123456789", ".bin")
+    assert cache.lookup(keys[1], ".bin") == filename
+    with open(filename, "rb") as f:
+        assert f.read() == b"0123456789"
+    assert not [name for name in os.listdir(cache.directory) if name.startswith("temp_")]
+
+
 def test_memset():
     a = [1, 2, 3, 4]
     x = numpy.array(a).astype(numpy.float32)
@@ -5,8 +5,12 @@ try:
 except ImportError:
     from unittest.mock import patch
 
+import warnings
+
 import numpy
 from kernel_tuner import core
+from kernel_tuner.interface import Options
+from kernel_tuner.pool import KernelPool
 
 from .test_interface import mock_config
 
@@ -21,7 +25,7 @@ def test_check_kernel_correctness(dev_func_interface):
     wrong = [numpy.array([1,2,3,4]).astype(numpy.float32)]
     atol = 1e-6
 
-    instance = core.KernelInstance("name", "kernel_string", "temp_files", (256,1,1), (1,1,1), {}, answer)
+    instance = core.KernelInstance("name", "kernel_string", "temp_files", (256,1,1), (1,1,1), {}, answer, [], [])
     test = dev.check_kernel_correctness('func', answer, instance, answer, atol, None, True)
 
     dfi.memset.assert_called_once_with(answer[0], 0, answer[0].nbytes)
@@ -48,3 +52,73 @@ def test_check_kernel_correctness(dev_func_interface):
     except Exception:
         assert True
 
+
+
+@patch('kernel_tuner.core.CudaFunctions')
+def test_get_device_restrictions(dev_func_interface):
+    dev_func_interface.configure_mock(**mock_config)
+    dev = core.DeviceInterface(0, 0, "", lang="CUDA")
+    dev.dev.max_shared_memory = 48*1024
+
+    tune_params = {"block_size_x": [32, 64], "block_size_y": [1, 2], "tile_size_x": [1, 2]}
+    restrictions = dev.get_device_restrictions(tune_params, None, "block_size_x*tile_size_x*4")
+    assert restrictions == ["block_size_x*block_size_y <= 1024", "(block_size_x*tile_size_x*4) <= 49152"]
+
+    #the default block_size_x of 256 threads is used if it is not tunable
+    restrictions = dev.get_device_restrictions({"block_size_y": [1, 2]})
+    assert restrictions == ["block_size_y*256 <= 1024"]
+
+    assert dev.get_device_restrictions({"tile_size_x": [1, 2]}) == []
+
+
+def test_get_device_restrictions_unsupported_shared_memory():
+    dev = core.DeviceInterface("", 0, 0, lang="C", quiet=True)
+    #the C backend does not know how much shared memory there is
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        assert dev.get_device_restrictions({"block_size_x": [32, 64]}, None, "block_size_x*4") == ["block_size_x <= 1024"]
+    assert len(w) == 1
+    assert "shared_memory_usage" in str(w[0].message)
+
+
+def test_kernel_pool():
+    unloaded = []
+    def unload(func):
+        unloaded.append(func)
+        return func != "omp"
+
+    pool = KernelPool(2, unload)
+    pool.add("a", "func_a")
+    pool.add("b", "omp")
+    assert pool.get("a") == ("func_a", None)
+
+    #the least recently used kernel is unloaded
+    pool.add("c", "func_c", "module_c")
+    assert unloaded == ["omp"]
+    assert pool.get("b") is None
+    assert pool.get("c") == ("func_c", "module_c")
+    assert pool.leaked == set(["b"])
+
+    pool.clear()
+    assert len(pool) == 0
+    assert unloaded == ["omp", "func_a", "func_c"]
+
+
+@patch('kernel_tuner.core.CudaFunctions')
+def test_compile_and_benchmark_reuses_kernels(dev_func_interface):
+    dev_func_interface.configure_mock(**mock_config)
+    dev_func_interface.return_value.benchmark.return_value = 1.0
+
+    dev = core.DeviceInterface("", lang="CUDA", quiet=True)
+    dfi = dev.dev
+
+    kernel_options = Options(kernel_name="kernel", kernel_string="__global__ void kernel(int n)", problem_size=(1, 1),
+                             arguments=[numpy.int32(1)], grid_div_x=None, grid_div_y=None, grid_div_z=None,
+                             block_size_names=None, cmem_args=None)
+    tuning_options = Options(verbose=False, answer=None, times=False)
+    for params in [{"block_size_x": 32}, {"block_size_x": 64}, {"block_size_x": 32}]:
+        assert dev.compile_and_benchmark([], params, kernel_options, tuning_options) == 1.0
+
+    #the kernel for block_size_x=32 is loaded only once
+    assert dfi.compile.call_count == 2
+    assert dfi.benchmark.call_count == 3
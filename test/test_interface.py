@@ -5,6 +5,8 @@ try:
 except ImportError:
     from unittest.mock import patch
 
+import inspect
+
 import numpy
 
 from kernel_tuner.interface import tune_kernel, run_kernel
@@ -126,3 +128,45 @@ def test_interface_noodles_checks_noodles(importlibmock):
         assert False
     except ValueError:
         assert True
+
+@patch('kernel_tuner.core.CudaFunctions')
+def test_interface_remembers_failures(dev_interface, tmpdir):
+    dev = dev_interface.return_value
+    dev_interface.configure_mock(**mock_config)
+    dev.env = {"device_name": "fake"}
+    dev.benchmark.return_value = 1.0
+
+    def compile(kernel_name, kernel_string):
+        if "#define block_size_x 256" in kernel_string:
+            raise Exception("uses too much shared data")
+        return "compile"
+    dev.compile.side_effect = compile
+
+    kernel_string = "__global__ void fake_kernel(int number)"
+    tune_params = {"block_size_x": [128, 256, 512]}
+    cache_dir = str(tmpdir.join("cache"))
+    results, _ = tune_kernel("fake_kernel", kernel_string, (1,1), [numpy.int32(0)], tune_params, lang="CUDA", cache_dir=cache_dir)
+    assert dev.compile.call_count == 3
+    assert [r["block_size_x"] for r in results] == [128, 512]
+
+    #the configuration that failed is not compiled again by later runs
+    results, _ = tune_kernel("fake_kernel", kernel_string, (1,1), [numpy.int32(0)], tune_params, lang="CUDA", cache_dir=cache_dir)
+    assert dev.compile.call_count == 5
+    assert [r["block_size_x"] for r in results] == [128, 512]
+
+    #failures are specific to the device
+    dev.env = {"device_name": "other"}
+    tune_kernel("fake_kernel", kernel_string, (1,1), [numpy.int32(0)], tune_params, lang="CUDA", cache_dir=cache_dir)
+    assert dev.compile.call_count == 8
+
+
+def test_signatures_extend_at_the_end():
+    #new options are appended, such that existing positional arguments keep their position
+    tune_kernel_args = ["kernel_name", "kernel_string", "problem_size", "arguments", "tune_params", "grid_div_x", "grid_div_y",
+                        "grid_div_z", "restrictions", "answer", "atol", "verify", "verbose", "lang", "device", "platform", "cmem_args",
+                        "num_threads", "use_noodles", "sample_fraction", "compiler", "compiler_options", "log", "iterations",
+                        "times", "block_size_names", "quiet", "strategy", "method"]
+    assert list(inspect.signature(tune_kernel).parameters)[:len(tune_kernel_args)] == tune_kernel_args
+    run_kernel_args = ["kernel_name", "kernel_string", "problem_size", "arguments", "params", "grid_div_x", "grid_div_y",
+                       "grid_div_z", "lang", "device", "platform", "cmem_args", "compiler", "compiler_options", "block_size_names", "quiet"]
+    assert list(inspect.signature(run_kernel).parameters)[:len(run_kernel_args)] == run_kernel_args
@@ -1,7 +1,13 @@
+import os
+
 import numpy as np
 from .context import skip_if_no_opencl
 
 from kernel_tuner import opencl
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
 try:
     import pyopencl
 except Exception:
@@ -49,6 +55,30 @@ def test_compile():
     assert isinstance(func, pyopencl.Kernel)
 
 
+@skip_if_no_opencl
+def test_compile_cache(tmpdir):
+
+    kernel_string = """
+    __kernel void sum(__global const float *a_g, __global const float *b_g, __global float *res_g) {
+        int gid = get_global_id(0);
+        res_g[gid] = a_g[gid] + b_g[gid];
+    }
+    """
+    cache_dir = str(tmpdir.join("cache"))
+
+    dev = opencl.OpenCLFunctions(0, cache_dir=cache_dir)
+    dev.compile("sum", kernel_string)
+    binaries = os.listdir(os.path.join(cache_dir, "opencl"))
+    assert len([name for name in binaries if name.endswith(".bin")]) == 1
+
+    #a later run builds the program from the stored binary
+    other = opencl.OpenCLFunctions(0, cache_dir=cache_dir)
+    with patch.object(pyopencl, "Program", wraps=pyopencl.Program) as program:
+        cached = other.compile("sum", kernel_string)
+        assert len(program.call_args[0]) == 3
+    assert isinstance(cached, pyopencl.Kernel)
+
+
 def fun_test(queue, a, b, block=0, grid=0):
     profile = type('profile', (object,), {'end': 0.1, 'start': 0})
     return type(
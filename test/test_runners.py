@@ -1,8 +1,23 @@
 from __future__ import print_function
 
+from collections import OrderedDict
+import gc
+import os
+import shutil
+import subprocess
+import warnings
+
 import numpy as np
+from pytest import raises
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
 
 import kernel_tuner
+from kernel_tuner.core import DeviceInterface
+from kernel_tuner.c import CFunctions
 from .context import skip_if_no_cuda, skip_if_no_noodles
 
 
@@ -27,6 +42,67 @@ def test_random_sample():
         assert v['time'] == 1.0
 
 
+def test_empty_searchspace():
+
+    kernel_string = "float test_kernel(float *a) { return 1.0f; }"
+    a = np.arange(4, dtype=np.float32)
+    tune_params = {"block_size_x": [1, 2], "tile": [1, 2, 4]}
+
+    #no configuration meets the restrictions, which is not an error
+    for strategy in [None, "genetic_algorithm", "simulated_annealing"]:
+        result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params,
+                                             restrictions=["tile>5"], strategy=strategy)
+        assert result == []
+    result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params,
+                                         restrictions=["tile>5"], sample_fraction=0.5)
+    assert result == []
+
+
+def test_dead_params():
+
+    kernel_string = "float test_kernel(float *a) { return (float) block_size_x; }"
+    a = np.arange(4, dtype=np.float32)
+
+    tune_params = OrderedDict([("block_size_x", [1, 2]), ("unused", [1, 2, 3])])
+
+    with patch.object(DeviceInterface, "compile_and_benchmark", autospec=True,
+                      side_effect=DeviceInterface.compile_and_benchmark) as compile_and_benchmark:
+        result, _ = kernel_tuner.tune_kernel(
+            "test_kernel", kernel_string, (1, 1), [a], tune_params)
+
+    #only one configuration is benchmarked for each value of block_size_x
+    assert compile_and_benchmark.call_count == 2
+    assert len(result) == 6
+    for v in result:
+        assert v['time'] == v['block_size_x']
+
+    #every configuration is benchmarked when the detection is turned off
+    with patch.object(DeviceInterface, "compile_and_benchmark", autospec=True,
+                      side_effect=DeviceInterface.compile_and_benchmark) as compile_and_benchmark:
+        result, _ = kernel_tuner.tune_kernel(
+            "test_kernel", kernel_string, (1, 1), [a], tune_params, detect_dead_params=False)
+    assert compile_and_benchmark.call_count == 6
+    assert len(result) == 6
+
+
+def test_dead_params_local_header(tmpdir):
+
+    with open(str(tmpdir.join("factor.h")), "w") as f:
+        f.write("#define FACTOR (block_size_x * factor)\n")
+    kernel_string = """#include "factor.h"
+    float test_kernel(float *a) { return (float) FACTOR; }"""
+    a = np.arange(4, dtype=np.float32)
+
+    tune_params = OrderedDict([("block_size_x", [1, 2]), ("factor", [1, 2, 3])])
+
+    #factor is only used in the header
+    result, _ = kernel_tuner.tune_kernel(
+        "test_kernel", kernel_string, (1, 1), [a], tune_params, compiler_options=["-I" + str(tmpdir)])
+    assert len(result) == 6
+    for v in result:
+        assert v['time'] == v['block_size_x'] * v['factor']
+
+
 @skip_if_no_noodles
 @skip_if_no_cuda
 def test_noodles_runner():
@@ -167,3 +243,244 @@ def test_sequential_runner_not_matching_answer2():
     except Exception:
         print("Expected a TypeError to be raised")
         assert False
+
+
+def test_pipelined_runner():
+
+    kernel_string = "float test_kernel(float *a) { return (float) (block_size_x * tile_size_x); }"
+    a = np.arange(4, dtype=np.float32)
+
+    tune_params = OrderedDict([("block_size_x", [1, 2, 4]), ("tile_size_x", [1, 2, 3]), ("unused", [0, 1])])
+    restrictions = ["block_size_x*tile_size_x <= 8"]
+
+    with patch.object(DeviceInterface, "prepare_kernel", autospec=True,
+                      side_effect=DeviceInterface.prepare_kernel) as prepare_kernel:
+        result, _ = kernel_tuner.tune_kernel(
+            "test_kernel", kernel_string, (1, 1), [a], tune_params, restrictions=restrictions,
+            compile_workers=3)
+
+    expected, _ = kernel_tuner.tune_kernel(
+        "test_kernel", kernel_string, (1, 1), [a], tune_params, restrictions=restrictions)
+
+    #results are returned in the same order as the sequential runner, each kernel is compiled once
+    assert result == expected
+    assert prepare_kernel.call_count == 8
+    for v in result:
+        assert v['time'] == v['block_size_x'] * v['tile_size_x']
+
+
+def test_pipelined_runner_batches():
+
+    #configurations with tile_size_x == 3 fail to compile
+    kernel_string = """
+    #if tile_size_x == 3
+    #error unsupported tile size
+    #endif
+    float test_kernel(float *a) { return (float) (block_size_x * tile_size_x); }
+    """
+    a = np.arange(4, dtype=np.float32)
+    tune_params = OrderedDict([("block_size_x", [1, 2, 4]), ("tile_size_x", [1, 2, 3, 4])])
+
+    #the batch is bisected and the compile error is raised as by the sequential runner
+    with raises(Exception):
+        kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, compile_batch_size=4, keep_failed=False)
+
+    tune_params["tile_size_x"] = [1, 2, 4]
+    with patch.object(CFunctions, "build_batch", autospec=True, side_effect=CFunctions.build_batch) as build_batch:
+        result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, compile_batch_size=4)
+    assert build_batch.call_count == 2
+    assert len(result) == 9
+    for v in result:
+        assert v['time'] == v['block_size_x'] * v['tile_size_x']
+
+
+def test_pipelined_runner_unbatchable():
+
+    #kernels that define other functions cannot be combined into one library
+    kernel_string = """
+    float get_time() { return (float) block_size_x; }
+    float test_kernel(float *a) { return get_time(); }
+    """
+    a = np.arange(4, dtype=np.float32)
+    tune_params = {"block_size_x": [1, 2, 3, 4, 5]}
+
+    result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, compile_batch_size=4)
+    assert [v['time'] for v in result] == [1, 2, 3, 4, 5]
+
+
+def test_pipelined_runner_guarded_header(tmpdir):
+
+    #a header with an include guard is expanded only once in a translation unit
+    with open(str(tmpdir.join("tile.h")), "w") as f:
+        f.write("#ifndef TILE_H\n#define TILE_H\nstatic float get_tile() { return (float) tile_size_x; }\n#endif\n")
+    kernel_string = """#include "tile.h"
+    float test_kernel(float *a) { return get_tile(); }
+    """
+    a = np.arange(4, dtype=np.float32)
+    tune_params = OrderedDict([("block_size_x", [1]), ("tile_size_x", [1, 2, 3, 4])])
+
+    with patch.object(CFunctions, "build_batch", autospec=True, side_effect=CFunctions.build_batch) as build_batch:
+        result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, compile_batch_size=4,
+                                             compiler_options=["-I" + str(tmpdir)])
+    assert build_batch.call_count == 0
+    assert [v['time'] for v in result] == [1, 2, 3, 4]
+
+
+def test_workspace(tmpdir):
+
+    kernel_string = """
+    #if tile_size_x == 3
+    #error unsupported tile size
+    #endif
+    float test_kernel(float *a) { return (float) tile_size_x; }
+    """
+    a = np.arange(4, dtype=np.float32)
+    workspace_dir = str(tmpdir.join("workspace"))
+
+    #all temporary files are removed when the run is finished
+    tune_params = {"tile_size_x": [1, 2]}
+    for compile_batch_size in [1, 2]:
+        result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params,
+                                             workspace_dir=workspace_dir, compile_batch_size=compile_batch_size)
+        assert len(result) == 2
+        assert os.listdir(workspace_dir) == []
+
+    #only the source of the configuration that failed is kept
+    tune_params = {"tile_size_x": [1, 2, 3, 4]}
+    with raises(Exception):
+        kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params,
+                                 workspace_dir=workspace_dir, compile_workers=2)
+    gc.collect()
+    workspaces = os.listdir(workspace_dir)
+    assert len(workspaces) == 1
+    kept = os.listdir(os.path.join(workspace_dir, workspaces[0]))
+    assert len(kept) == 1
+    with open(os.path.join(workspace_dir, workspaces[0], kept[0])) as f:
+        assert "#define tile_size_x 3" in f.read()
+    shutil.rmtree(os.path.join(workspace_dir, workspaces[0]))
+
+    with raises(Exception):
+        kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params,
+                                 workspace_dir=workspace_dir, keep_failed=False)
+    gc.collect()
+    assert os.listdir(workspace_dir) == []
+
+
+def test_compile_cache_reuse(tmpdir):
+
+    kernel_string = "float test_kernel(float *a) { return (float) tile_size_x; }"
+    a = np.arange(4, dtype=np.float32)
+    tune_params = {"tile_size_x": [1, 2]}
+    cache_dir = str(tmpdir.join("cache"))
+
+    #libraries from the cache are loaded again by later runs, after the first run unloaded them
+    for _ in range(2):
+        result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, cache_dir=cache_dir)
+        assert [v["time"] for v in result] == [1, 2]
+    answer = kernel_tuner.run_kernel("test_kernel", kernel_string, (1, 1), [a], {"tile_size_x": 2}, cache_dir=cache_dir)
+    assert all(answer[0] == a)
+
+
+def test_compile_cache_multiple_files(tmpdir):
+
+    helper = str(tmpdir.join("helper.cc"))
+    with open(helper, "w") as f:
+        f.write("float helper() { return (float) tile_size_x; }")
+    main = str(tmpdir.join("main.c"))
+    with open(main, "w") as f:
+        f.write('#include "' + helper + '"\nfloat test_kernel(float *a) { return helper(); }')
+    a = np.arange(4, dtype=np.float32)
+    tune_params = {"tile_size_x": [1, 2]}
+    cache_dir = str(tmpdir.join("cache"))
+
+    #the instance files are created in a new workspace in each run, which should not change the keys
+    with patch("kernel_tuner.c.subprocess.check_call", wraps=subprocess.check_call) as check_call:
+        for _ in range(2):
+            result, _ = kernel_tuner.tune_kernel("test_kernel", [main, helper], (1, 1), [a], tune_params, lang="C", cache_dir=cache_dir)
+            assert [v["time"] for v in result] == [1, 2]
+            assert check_call.call_count == 4
+
+
+def test_conditions_numpy_params():
+
+    kernel_string = "float test_kernel(float *a) { return (float) (use_tile * 10 + tile); }"
+    a = np.arange(4, dtype=np.float32)
+    tune_params = OrderedDict([("use_tile", np.array([0, 1])), ("tile", np.array([1, 2, 4]))])
+
+    #the default of tile is a NumPy scalar, inactive tiles are pinned to it
+    result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, conditions={"tile": "use_tile == 1"})
+    assert [(v["use_tile"], v["tile"]) for v in result] == [(0, 1), (1, 1), (1, 2), (1, 4)]
+    for v in result:
+        assert v["time"] == v["use_tile"] * 10 + v["tile"]
+
+
+def test_binary_equivalence():
+
+    #tile_size_x does not change the compiled code
+    kernel_string = "float test_kernel(float *a) { return (float) block_size_x * (tile_size_x > 4 ? 2 : 1); }"
+    a = np.arange(4, dtype=np.float32)
+    tune_params = OrderedDict([("block_size_x", [1, 2]), ("tile_size_x", [1, 2, 3])])
+
+    with patch.object(CFunctions, "benchmark", autospec=True, side_effect=CFunctions.benchmark) as benchmark:
+        result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params)
+    assert benchmark.call_count == 2
+    assert len(result) == 6
+    for v in result:
+        assert v['time'] == v['block_size_x']
+        if v['tile_size_x'] > 1:
+            assert v['equivalent_to'] == str(v['block_size_x']) + "_1"
+        else:
+            assert 'equivalent_to' not in v
+
+
+def test_runtime_params():
+
+    #chunk is passed as an argument and block_size_x only affects the launch, which C kernels ignore
+    kernel_string = "float test_kernel(float *a, int chunk) { return (float) (tile_size_x * 10 + chunk); }"
+    a = np.arange(4, dtype=np.float32)
+    tune_params = OrderedDict([("chunk", [1, 2, 3]), ("block_size_x", [1, 2]), ("tile_size_x", [1, 2])])
+
+    for compile_workers in [0, 1]:
+        with patch.object(CFunctions, "build", autospec=True, side_effect=CFunctions.build) as build:
+            result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, runtime_params=["chunk", "block_size_x"],
+                                                 compile_workers=compile_workers)
+        assert build.call_count == 2
+        assert len(result) == 12
+        #the runtime parameters vary fastest
+        assert list(result[0].keys())[:3] == ["tile_size_x", "chunk", "block_size_x"]
+        assert [v["tile_size_x"] for v in result] == [1]*6 + [2]*6
+        for v in result:
+            assert v["time"] == v["tile_size_x"] * 10 + v["chunk"]
+
+    with raises(ValueError):
+        kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, runtime_params=["unroll"])
+
+
+def test_compiler_option_params():
+
+    kernel_string = "float test_kernel(float *a) { return (float) OPT_LEVEL; }"
+    a = np.arange(4, dtype=np.float32)
+    tune_params = OrderedDict([("opt", ["-DOPT_LEVEL=1 -O1", "-DOPT_LEVEL=2 -O2", "-fno-such-option"]), ("block_size_x", [1, 2])])
+
+    with patch.object(CFunctions, "build", autospec=True, side_effect=CFunctions.build) as build:
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, compiler_option_params=["opt"])
+    assert any("-fno-such-option" in str(warning.message) for warning in w)
+    #the option parameter is not used in the source, but it is live
+    assert build.call_count == 4
+    assert len(result) == 4
+    for v in result:
+        assert v["time"] == float(v["opt"][12])
+
+    #the options are not defined in the source, kernels that only differ in their options are not shared
+    with patch.object(CFunctions, "build", autospec=True, side_effect=CFunctions.build) as build:
+        result, _ = kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, compiler_option_params=["opt"],
+                                             runtime_params=["block_size_x"])
+    assert build.call_count == 2
+    assert len(result) == 4
+    for v in result:
+        assert v["time"] == float(v["opt"][12])
+
+    with raises(ValueError):
+        kernel_tuner.tune_kernel("test_kernel", kernel_string, (1, 1), [a], tune_params, compiler_option_params=["march"])
@@ -0,0 +1,312 @@
+from __future__ import print_function
+
+from collections import OrderedDict
+import copy
+import itertools
+import os
+
+import numpy
+from pytest import raises
+
+from kernel_tuner.searchspace import SearchSpace
+from kernel_tuner.strategies import simulated_annealing
+from kernel_tuner import util
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
+
+def get_tune_params():
+    tune_params = OrderedDict()
+    tune_params["block_size_x"] = [16, 32, 64, 128]
+    tune_params["block_size_y"] = [1, 2, 4]
+    tune_params["tile_size_x"] = [1, 2]
+    return tune_params
+
+
+def test_searchspace_no_restrictions():
+    tune_params = get_tune_params()
+    space = SearchSpace(tune_params)
+
+    expected = list(itertools.product(*tune_params.values()))
+    assert len(space) == len(expected)
+    assert list(space) == expected
+    assert space.indices is None
+
+    for i, config in enumerate(expected):
+        assert space[i] == config
+        assert space.index(config) == i
+    assert space[-1] == expected[-1]
+
+    with raises(IndexError):
+        space[len(expected)]
+
+
+def test_searchspace_restrictions():
+    tune_params = get_tune_params()
+    restrictions = ["block_size_x*block_size_y <= 128", "tile_size_x == 1 or block_size_y == 1"]
+    space = SearchSpace(tune_params, restrictions)
+
+    expected = [p for p in itertools.product(*tune_params.values())
+                if p[0]*p[1] <= 128 and (p[2] == 1 or p[1] == 1)]
+    assert len(space) == len(expected)
+    assert list(space) == expected
+
+    for i, config in enumerate(expected):
+        assert space[i] == config
+        assert space.index(config) == i
+
+    assert (128, 2, 1) not in space
+    assert (128, 1, 2) in space
+    with raises(ValueError):
+        space.index((128, 4, 1))
+    with raises(ValueError):
+        space.index((3, 4, 1))
+
+
+def test_searchspace_slice_and_sample():
+    tune_params = get_tune_params()
+    space = SearchSpace(tune_params, ["block_size_x*block_size_y <= 128"])
+    expected = list(space)
+
+    assert list(space[2:8:3]) == expected[2:8:3]
+    assert list(space[-3:]) == expected[-3:]
+
+    sample = space.sample(5)
+    assert len(sample) == 5
+    assert len(set(sample)) == 5
+    assert all(config in expected for config in sample)
+    assert sorted(space.sample(len(space))) == sorted(expected)
+
+    #a few points are drawn from a large space without building a list of all positions
+    large = SearchSpace(OrderedDict(("p" + str(i), list(range(1000))) for i in range(4)))
+    with patch("kernel_tuner.searchspace.random.sample", side_effect=AssertionError):
+        points = list(large.sample(5))
+    assert len(set(points)) == 5
+
+    permuted = space.permutation()
+    assert sorted(permuted) == sorted(expected)
+    for i, config in enumerate(permuted):
+        assert permuted.index(config) == i
+
+    mask = numpy.array([i % 3 == 0 for i in range(len(space))])
+    assert list(space.select(mask)) == expected[::3]
+    full = SearchSpace(tune_params)
+    assert list(full.select(numpy.arange(len(full)) % 3 == 0)) == list(itertools.product(*tune_params.values()))[::3]
+
+
+def test_searchspace_vectorized_and_fallback():
+    tune_params = OrderedDict()
+    tune_params["a"] = list(range(12))
+    tune_params["b"] = list(range(7))
+    tune_params["c"] = ["x", "yy", 3]
+    restrictions = [["a*b <= 24 or b == 1", "not (0 < b < a)"],    #rewritten to NumPy calls
+                    ["int(a)*b <= 20 if b > 2 else True"],         #int() needs per-point evaluation
+                    ["len(str(c)) == 1"]]                          #scalar result from arrays
+
+    for restrict in restrictions:
+        space = SearchSpace(tune_params, restrict, block_size=50)
+        expected = [p for p in itertools.product(*tune_params.values())
+                    if all(eval(r, dict(zip(tune_params.keys(), p))) for r in restrict)]
+        assert list(space) == expected
+
+
+def test_searchspace_vectorized_overflow():
+    large = [2**31, 2**32, 2**33]
+    cases = [(OrderedDict([("a", list(range(60, 70))), ("b", [1, 2])]), ["2**a > 10**18"]),
+             (OrderedDict([("x", large), ("y", large)]), ["x*y > 2**62"]),
+             (OrderedDict([("x", large), ("y", large)]), ["(x*y*x) % 7 == 1"]),
+             (OrderedDict([("a", list(range(8))), ("b", [1, 2])]), ["a*b > 6", "2**a < 100"])]
+
+    for tune_params, restrict in cases:
+        space = SearchSpace(tune_params, restrict)
+        expected = [p for p in itertools.product(*tune_params.values())
+                    if all(eval(r, dict(zip(tune_params.keys(), p))) for r in restrict)]
+        assert list(space) == expected
+
+
+def test_searchspace_enumeration_order():
+    tune_params = OrderedDict()
+    tune_params["unused"] = [0, 1]
+    tune_params["block_size_x"] = [16, 32, 64]
+    tune_params["tile_size_x"] = [1, 2, 4, 8]
+    tune_params["block_size_y"] = [1, 2]
+    restrictions = ["block_size_x*block_size_y <= 64", "block_size_x*tile_size_x <= 128"]
+
+    space = SearchSpace(tune_params, restrictions, block_size=3)
+    order, checks = space._get_enumeration_order()
+
+    #parameters that are not used in restrictions are bound last
+    assert order[0] == 1
+    assert order[-1] == 0
+    #each restriction is checked at the level where its last parameter is bound
+    for level, level_checks in enumerate(checks):
+        for restrict, _ in level_checks:
+            assert max(order.index(i) for i in restrict.indices) == level
+
+    expected = [p for p in itertools.product(*tune_params.values())
+                if p[1]*p[3] <= 64 and p[1]*p[2] <= 128]
+    assert list(space) == expected
+
+
+def test_searchspace_cache(tmpdir):
+    tune_params = get_tune_params()
+    restrictions = ["block_size_x*block_size_y <= 128"]
+    cache_dir = str(tmpdir.join("cache"))
+
+    space = SearchSpace(tune_params, restrictions, cache_dir=cache_dir)
+    filename = space.get_cache_filename(cache_dir)
+    #the space is only enumerated, and stored, when it is first needed
+    assert not os.path.isfile(filename)
+    assert len(space) > 0
+    assert os.path.isfile(filename)
+
+    cached = SearchSpace(tune_params, restrictions, cache_dir=cache_dir)
+    assert isinstance(cached.indices, numpy.memmap)
+    assert list(cached) == list(space)
+    assert isinstance(cached.exclude([space[0]]).indices, numpy.memmap)
+    assert list(cached.exclude([space[0]])) == list(space)[1:]
+
+    #a different set of restrictions is stored under a different key
+    other = SearchSpace(tune_params, ["block_size_x*block_size_y <= 64"], cache_dir=cache_dir)
+    assert other.get_cache_filename(cache_dir) != filename
+    assert len(other) < len(space)
+
+    #conditions are stored under their source, functions given by the user are not stored
+    conditions = util.compile_conditions({"tile_size_x": "block_size_y > 1"}, tune_params)
+    with_conditions = restrictions + util.get_condition_restrictions(conditions)
+    space = SearchSpace(tune_params, with_conditions, cache_dir=cache_dir)
+    assert space.get_cache_filename(cache_dir) != filename
+    assert len(space) > 0
+    cached = SearchSpace(tune_params, with_conditions, cache_dir=cache_dir)
+    assert isinstance(cached.indices, numpy.memmap)
+    assert list(cached) == list(space)
+    space = SearchSpace(tune_params, restrictions + [lambda p: p["tile_size_x"] == 1], cache_dir=cache_dir)
+    assert not isinstance(space.indices, numpy.memmap)
+
+
+def test_searchspace_restriction_functions():
+    tune_params = get_tune_params()
+    expected = [p for p in itertools.product(*tune_params.values()) if p[0]*p[1] <= 64]
+
+    #per configuration function that takes a dict
+    space = SearchSpace(tune_params, lambda p: p["block_size_x"]*p["block_size_y"] <= 64)
+    assert list(space) == expected
+
+    #batch function that takes a dict of arrays
+    calls = []
+    def batch(p):
+        calls.append(len(p["block_size_x"]))
+        return p["block_size_x"]*p["block_size_y"] <= 64
+    restrict = util.callable_restriction(batch, ["block_size_x", "block_size_y"], batch=True)
+    space = SearchSpace(tune_params, [restrict, "tile_size_x > 0"], block_size=5)
+    assert list(space) == expected
+    assert len(calls) > 0 and all(n > 1 for n in calls)
+
+    #a batch function can also be checked for a single configuration
+    compiled = util.compile_restrictions([restrict], tune_params)
+    assert util.check_restrictions(compiled, (32, 2, 1), tune_params.keys(), False)
+    assert not util.check_restrictions(compiled, (64, 2, 1), tune_params.keys(), False)
+
+    with raises(ValueError):
+        util.compile_restrictions([util.callable_restriction(batch, ["block_size_z"])], tune_params)
+
+
+def test_searchspace_neighbor_index():
+    tune_params = get_tune_params()
+    restricted = SearchSpace(tune_params, ["block_size_x*block_size_y <= 128"])
+
+    for space in [SearchSpace(tune_params), restricted, restricted.permutation()]:
+        configs = list(space)
+        value_index = [dict((v, i) for i, v in enumerate(values)) for values in tune_params.values()]
+        for kind in ["adjacent", "hamming"]:
+            indptr, neighbors = space.get_neighbor_index(kind)
+            assert len(indptr) == len(configs) + 1
+            for i, config in enumerate(configs):
+                expected = []
+                for j, other in enumerate(configs):
+                    diff = [abs(value_index[d][a] - value_index[d][b]) for d, (a, b) in enumerate(zip(config, other)) if a != b]
+                    if len(diff) == 1 and (kind == "hamming" or diff[0] == 1):
+                        expected.append(j)
+                assert list(neighbors[indptr[i]:indptr[i+1]]) == sorted(expected)
+                assert list(space.get_neighbors(i, kind)) == sorted(expected)
+
+    #neighbors are computed for each point when the index would be too large
+    excluded = restricted.exclude([restricted[3]])
+    for space in [SearchSpace(tune_params), restricted, restricted.permutation(), excluded]:
+        for kind in ["adjacent", "hamming"]:
+            indptr, neighbors = space.get_neighbor_index(kind)
+            expected = [list(neighbors[indptr[i]:indptr[i+1]]) for i in range(len(space))]
+            with patch("kernel_tuner.searchspace.max_neighbor_index_size", 0):
+                large = copy.copy(space)
+                large._neighbor_index = dict()
+                assert large.get_neighbor_index(kind) is None
+                assert [list(large.get_neighbors(i, kind)) for i in range(len(large))] == expected
+
+    with raises(ValueError):
+        restricted.get_neighbor_index("diagonal")
+
+
+def test_searchspace_neighbor_index_lazy():
+    space = SearchSpace(get_tune_params())
+
+    #simulated annealing only builds the index of hamming neighbors when it first picks such a move
+    with patch("random.random", return_value=0.5):
+        for i in range(len(space)):
+            assert simulated_annealing.neighbor(i, space) in space.get_neighbors(i)
+    assert "hamming" not in space._neighbor_index
+    with patch("random.random", return_value=0.1):
+        assert simulated_annealing.neighbor(0, space) in space.get_neighbors(0, "hamming")
+    assert "hamming" in space._neighbor_index
+
+
+def test_searchspace_get_nearest():
+    tune_params = get_tune_params()
+    space = SearchSpace(tune_params, ["block_size_x*block_size_y <= 64"])
+
+    #points in the space are their own nearest point
+    for i, config in enumerate(space):
+        coordinates = [values.index(v) for values, v in zip(tune_params.values(), config)]
+        assert space.get_nearest(coordinates) == i
+
+    #(128, 2, 2) fails the restriction, (64, 1, 2) is the nearest point that does not
+    assert space[space.get_nearest([3, 1, 1])] == (64, 1, 2)
+    assert space[space.get_nearest([2.9, 0.8, 0.9])] == (64, 1, 2)
+
+
+def test_searchspace_exclude():
+    tune_params = get_tune_params()
+    space = SearchSpace(tune_params, ["block_size_x*block_size_y <= 128"])
+    infeasible = [(32, 2, 1), (128, 1, 2), (128, 4, 1), (3, 1, 1)]
+
+    mask = space.get_feasibility_mask(infeasible)
+    assert len(mask) == len(space)
+    assert numpy.sum(~mask) == 2
+
+    feasible = space.exclude(infeasible)
+    assert list(feasible) == [config for config in space if config not in infeasible]
+    full = SearchSpace(tune_params)
+    assert list(full.exclude(infeasible)) == [config for config in itertools.product(*tune_params.values())
+                                              if config not in infeasible]
+
+    #the excluded points are stored separately, the stored points are kept as they are
+    assert full.exclude(infeasible).indices is None
+    assert feasible.indices is space.indices
+    for excluded in [full.exclude(infeasible), feasible, feasible.exclude([(16, 1, 1)])]:
+        flat = list(excluded.get_indices())
+        configs = list(excluded)
+        assert len(excluded) == len(configs) == len(flat)
+        assert [excluded[i] for i in range(len(excluded))] == configs
+        assert [excluded.index(config) for config in configs] == list(range(len(configs)))
+        assert [excluded.get_config(i) for i in flat] == configs
+        assert all(config not in excluded for config in infeasible)
+        assert list(excluded[1:4]) == configs[1:4]
+        assert set(excluded.sample(5)) <= set(configs)
+        assert sorted(excluded.permutation()) == sorted(configs)
+        indptr, neighbors = excluded.get_neighbor_index("hamming")
+        for i, config in enumerate(configs):
+            assert [configs[j] for j in neighbors[indptr[i]:indptr[i+1]]] == [c for c in configs if sum(a != b for a, b in zip(c, config)) == 1]
+    assert (16, 1, 1) not in feasible.exclude([(16, 1, 1)])
+    assert (16, 1, 1) in feasible
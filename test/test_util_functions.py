@@ -1,5 +1,9 @@
 from __future__ import print_function
 
+from collections import OrderedDict
+
+import itertools
+import os
 import numpy
 import warnings
 from pytest import raises
@@ -110,6 +114,22 @@ def test_get_grid_dimensions6():
     assert grid[1] == 256
     assert grid[2] == 1
 
+def test_setup_block_and_grid():
+    problem_size = ("n*2", 1024)
+    grid_div = (["block_size_x*tile"], None, [])
+    params = {"n": 1000, "block_size_x": 32, "block_size_y": 4, "tile": 2, "unrelated": 1}
+
+    threads, grid = setup_block_and_grid(problem_size, grid_div, params, block_size_names)
+    assert threads == (32, 4, 1)
+    assert grid == (32, 256, 1)
+
+    #a parameter that is not read by any expression reuses the memoized result
+    params["unrelated"] = 2
+    assert setup_block_and_grid(problem_size, grid_div, params, block_size_names) == (threads, grid)
+
+    params["tile"] = 4
+    assert setup_block_and_grid(problem_size, grid_div, params, block_size_names) == (threads, (16, 256, 1))
+
 def test_get_thread_block_dimensions():
 
     params = {"block_size_x": 123, "block_size_y": 257}
@@ -139,6 +159,46 @@ def test_prepare_kernel_string():
                "this is a weird kernel"
     assert output == expected
 
+def test_split_prologue():
+    kernel = "// vector add\n#include <omp.h>\n\n#  include \"vector.h\"\n#define n 4\n#include <math.h>\nvoid kernel() {}"
+    prologue, rest = split_prologue(kernel)
+    assert prologue == "// vector add\n#include <omp.h>\n\n#  include \"vector.h\"\n"
+    assert rest == "#define n 4\n#include <math.h>\nvoid kernel() {}"
+
+    assert split_prologue("// no includes\nvoid kernel() {}") == ("", "// no includes\nvoid kernel() {}")
+    assert split_prologue("#include <omp.h>") == ("#include <omp.h>\n", "")
+
+    #the defines of the tunable parameters follow the prologue
+    _, output = prepare_kernel_string("kernel", kernel, {"n": 4}, (1, 1), (1, 1, 1), block_size_names, prologue_first=True)
+    assert output.startswith(prologue + "#define n 4\n")
+    assert output.endswith(rest)
+
+def test_runtime_params():
+    tune_params = OrderedDict([("chunk", [1, 2]), ("block_size_x", [32, 64]), ("unroll", [1, 4]), ("alpha", [0.5])])
+    runtime_params = ["alpha", "block_size_x", "chunk"]
+
+    ordered = order_runtime_params_last(tune_params, runtime_params)
+    assert list(ordered.keys()) == ["unroll", "alpha", "block_size_x", "chunk"]
+    with raises(ValueError):
+        order_runtime_params_last(tune_params, ["unknown"])
+
+    params = {"chunk": 2, "block_size_x": 64, "unroll": 4, "alpha": 0.5}
+    args = get_runtime_args(params, runtime_params)
+    assert args == [0.5, 2]
+    assert [type(arg) for arg in args] == [numpy.float32, numpy.int32]
+    assert get_runtime_args(dict(params, chunk=numpy.int64(2)), ["chunk"])[0].dtype == numpy.int64
+
+    #runtime parameters and the grid dimensions are not defined
+    _, output = prepare_kernel_string("kernel", "kernel", params, (3, 1, 1), (64, 1, 1), block_size_names, runtime_params=runtime_params)
+    assert output == "#define unroll 4\n#define block_size_z 1\n#define block_size_y 1\nkernel"
+    assert get_dead_params("kernel(unroll)", tune_params, runtime_params=runtime_params) == []
+
+    #compiler option parameters are passed to the compiler and not defined either
+    _, output = prepare_kernel_string("kernel", "kernel", {"unroll": 4, "opt": "-O3"}, (3, 1, 1), (64, 1, 1), block_size_names,
+                                      compiler_option_params=["opt"])
+    assert "opt" not in output
+    assert "#define unroll 4\n" in output
+
 def test_replace_param_occurrences():
     kernel = "this is a weird kernel"
     params = dict()
@@ -168,6 +228,95 @@ def test_check_restrictions():
         print(answer)
         assert answer == e
 
+def test_compile_restrictions():
+    tune_params = OrderedDict([("tile", [1, 2]), ("tile_size_x", [1, 2, 4]), ("block_size_x", [32, 64])])
+    restrictions = compile_restrictions(["tile_size_x * block_size_x <= 128", "tile == 2"], tune_params)
+
+    assert restrictions[0].params == ["tile_size_x", "block_size_x"]
+    assert restrictions[0].indices == [1, 2]
+    assert restrictions[1].params == ["tile"]
+    assert restrictions[1].indices == [0]
+
+    #compiled restrictions are passed through unchanged
+    assert compile_restrictions(restrictions, tune_params) == restrictions
+
+    assert check_restrictions(restrictions, (2, 2, 64), tune_params.keys(), False)
+    assert not check_restrictions(restrictions, (2, 4, 64), tune_params.keys(), False)
+    assert not check_restrictions(restrictions, (1, 1, 32), tune_params.keys(), False)
+
+    with raises(ValueError):
+        compile_restrictions(["tile =="], tune_params)
+
+
+def test_conditions():
+    tune_params = OrderedDict([("use_unroll", [0, 1]), ("unroll_factor", [1, 2, 4]),
+                               ("use_prefetch", [0, 1]), ("prefetch_depth", [1, 2])])
+    conditions = compile_conditions(OrderedDict([("unroll_factor", "use_unroll == 1"),
+                                                 ("use_prefetch", "unroll_factor > 1"),
+                                                 ("prefetch_depth", "use_prefetch == 1")]), tune_params)
+
+    assert conditions[0].param == "unroll_factor"
+    assert conditions[0].index == 1
+    assert conditions[0].default == 1
+
+    assert apply_conditions(conditions, [1, 4, 1, 2]) == [1, 4, 1, 2]
+    assert apply_conditions(conditions, [1, 4, 0, 2]) == [1, 4, 0, 1]
+    #pinning unroll_factor deactivates the parameters that depend on it
+    assert apply_conditions(conditions, [0, 4, 1, 2]) == [0, 1, 0, 1]
+
+    #the search space only contains the canonical configurations
+    restrictions = compile_restrictions(get_condition_restrictions(conditions), tune_params)
+    space = [p for p in itertools.product(*tune_params.values())
+             if check_restrictions(restrictions, p, tune_params.keys(), False)]
+    canonical = set(tuple(apply_conditions(conditions, p)) for p in itertools.product(*tune_params.values()))
+    assert sorted(space) == sorted(canonical)
+
+    with raises(ValueError):
+        compile_conditions({"unroll": "use_unroll == 1"}, tune_params)
+    with raises(ValueError):
+        compile_conditions({"unroll_factor": "unroll_factor > 1"}, tune_params)
+
+
+def test_get_dead_params():
+    tune_params = OrderedDict([("block_size_x", [32, 64]), ("tile_size_x", [1, 2]), ("tile_size_y", [1, 2]),
+                               ("use_shared", [0, 1]), ("unused", [0, 1])])
+    kernel_string = "__global__ void kernel(float *a) { if (use_shared) { a[0] = tile_size_x; } }"
+
+    dead = get_dead_params(kernel_string, tune_params, "1024", (None, None, None))
+    assert dead == ["tile_size_y", "unused"]
+
+    #parameters used in the problem size or grid divisors can change the kernel
+    dead = get_dead_params(kernel_string, tune_params, ("1024", "tile_size_y*32"), (None, ["unused"], None))
+    assert dead == []
+
+    #nothing is known about the code generated by a function
+    assert get_dead_params(lambda p: kernel_string, tune_params) == []
+
+
+def test_get_dead_params_local_includes(tmpdir):
+    tune_params = OrderedDict([("block_size_x", [32, 64]), ("tile_size_x", [1, 2]), ("unused", [0, 1])])
+    with open(str(tmpdir.join("tile.h")), "w") as f:
+        f.write('#include "inner.h"\n')
+    tmpdir.mkdir("sub")
+    with open(str(tmpdir.join("inner.h")), "w") as f:
+        f.write("#define TILE tile_size_x\n")
+    kernel_file = str(tmpdir.join("kernel.c"))
+    with open(kernel_file, "w") as f:
+        f.write('#include "tile.h"\n#include <stdio.h>\nfloat kernel(float *a) { return TILE; }\n')
+
+    #parameters used in headers included by a kernel file are found next to the file
+    assert get_dead_params(kernel_file, tune_params) == ["unused"]
+
+    #headers included by a kernel string are found with -I
+    kernel_string = '#include "tile.h"\nfloat kernel(float *a) { return TILE; }'
+    assert get_dead_params(kernel_string, tune_params, compiler_options=["-I", str(tmpdir)]) == ["unused"]
+    assert get_local_includes(kernel_string, [str(tmpdir.join("sub")), str(tmpdir)]) == \
+        ([str(tmpdir.join("tile.h")), str(tmpdir.join("inner.h"))], True)
+
+    #all parameters are used when a local header cannot be found
+    assert get_dead_params('#include "missing.h"\n' + kernel_string, tune_params, compiler_options=["-I" + str(tmpdir)]) == []
+
+
 def test_detect_language1():
     lang = None
     kernel_string = "__global__ void vector_add( ... );"
@@ -426,6 +575,86 @@ def test_get_kernel_string_filename_not_found():
     answer = get_kernel_string(bogus_filename)
     assert answer == bogus_filename
 
+def test_get_kernel_string_func_memoized():
+    calls = []
+    def gen_kernel(params):
+        calls.append(params["unroll"])
+        if params["unroll"]:
+            return "kernel %d" % params["block_size_x"]
+        return "kernel"
+
+    generated = dict()
+    params = OrderedDict([("block_size_x", 32), ("unroll", 0), ("other", 1)])
+    assert get_kernel_string(gen_kernel, params, generated) == "kernel"
+    #the generator did not read block_size_x or other
+    params["block_size_x"] = 64
+    params["other"] = 2
+    assert get_kernel_string(gen_kernel, params, generated) == "kernel"
+    assert len(calls) == 1
+
+    params["unroll"] = 1
+    assert get_kernel_string(gen_kernel, params, generated) == "kernel 64"
+    params["block_size_x"] = 128
+    assert get_kernel_string(gen_kernel, params, generated) == "kernel 128"
+    params["other"] = 3
+    assert get_kernel_string(gen_kernel, params, generated) == "kernel 128"
+    assert len(calls) == 3
+
+    #without a dictionary to store the code in, the generator is called every time
+    assert get_kernel_string(gen_kernel, params) == "kernel 128"
+    assert len(calls) == 4
+
+def test_get_kernel_string_func_reads_all_params():
+    import json
+    generators = [lambda p: "// " + str(p), lambda p: "// %s" % p, lambda p: "// " + json.dumps(p),
+                  lambda p: "// " + ",".join(str(p[k]) for k in p), lambda p: "// {}".format(p)]
+    for gen_kernel in generators:
+        generated = dict()
+        params = {"a": 1, "b": 2}
+        first = get_kernel_string(gen_kernel, params, generated)
+        params["b"] = 3
+        second = get_kernel_string(gen_kernel, params, generated)
+        assert first != second
+        assert second == gen_kernel(params)
+
+    #code of a generator that does not read any parameters is not stored
+    generated = dict()
+    assert get_kernel_string(lambda p: "kernel", params, generated) == "kernel"
+    assert not any(generated.values())
+
+def test_read_source_file():
+    filename = get_temp_filename(suffix=".cu")
+    try:
+        write_file(filename, "first version")
+        assert read_source_file(filename) == "first version"
+        assert get_kernel_string(filename) == "first version"
+        #the file is read again when it has been modified
+        write_file(filename, "second version!")
+        assert get_kernel_string(filename) == "second version!"
+    finally:
+        delete_temp_file(filename)
+    assert read_source_file(filename) is None
+
+def test_write_instance_file():
+    first = write_instance_file("kernel.cu", "#define x 1\nkernel")
+    try:
+        assert first.endswith(".cu")
+        #files are private to this process
+        assert str(os.getpid()) in os.path.basename(first)
+        assert read_file(first) == "#define x 1\nkernel"
+        #the same contents are stored under the same name, which is only deleted when no longer used
+        second = write_instance_file("other.cu", "#define x 1\nkernel")
+        assert second == first
+        third = write_instance_file("kernel.cu", "#define x 2\nkernel")
+        assert third != first
+        release_instance_file(third)
+        assert not os.path.isfile(third)
+        release_instance_file(second)
+        assert os.path.isfile(first)
+    finally:
+        release_instance_file(first)
+    assert not os.path.isfile(first)
+
 def test_looks_like_a_filename1():
     string = "filename.c"
     assert looks_like_a_filename(string)
@@ -434,6 +663,34 @@ def test_looks_like_a_filename2():
     string = "__global__ void kernel_name() { //do that kernel thing! }"
     assert not looks_like_a_filename(string)
 
+def test_replace_file(tmpdir):
+    source = str(tmpdir.join("source"))
+    destination = str(tmpdir.join("destination"))
+    for text in ["first", "second"]:
+        write_file(source, text)
+        replace_file(source, destination)
+        assert read_file(destination) == text
+    assert not os.path.exists(source)
+
+def test_finalizer():
+    from kernel_tuner.util import _Finalizer
+    class Owner(object):
+        pass
+    calls = []
+
+    #called once, either explicitly or when the owner is collected
+    owner = Owner()
+    finalizer = _Finalizer(owner, calls.append, 1)
+    finalizer()
+    del owner
+    finalizer()
+    assert calls == [1]
+
+    owner = Owner()
+    _Finalizer(owner, calls.append, 2)
+    del owner
+    assert calls == [1, 2]
+
 def test_read_write_file():
     filename = get_temp_filename()
 